@@ -1,7 +1,10 @@
 
-import json, time, traceback, os
-import pandas as pd
-from sqlalchemy import *
+import argparse, json, sys, time, traceback, os
+from stage_profiler import profiled_stage
+from sql_instrumentation import InstrumentedCursor, instrumentation_settings, write_sql_report
+
+# pandas, sqlalchemy and the helper modules which need them are imported inside the functions using them, so the
+# quick commands of the command line (check-connection, --help) do not pay for importing them
 
 """
 ************************************  General Workflow with (SQLalchemy)Psycopg2:  ************************************
@@ -16,6 +19,50 @@ STEP#3. Commit the SQL language executed by cursor object. Use the connection ob
             db.raw_conn.commit()
 STEP#4. Return the result of SQL query, the data type is pythong list.
             result = db.cur.fetchall()
+        or, for read queries, get the result as a DataFrame (cached between loads when enabled):
+            df = db.query(SQL query, parameters)
+        or, to read a whole table (or some columns / rows of it), stream it with COPY TO STDOUT:
+            df = db.read_table(table name, columns, where clause, parameters)
+
+The surrogate keys are reserved block by block from surrogate_key_sequence_table (see surrogate_keys.py, the block
+size is "surrogate_keys": {"block_size": 10000} in config.json), finalize_load() prints the keys used and the gaps.
+
+Optional: time every statement and capture the plan of the slow ones by adding to config.json
+            "sql_instrumentation": {"enabled": true, "slow_threshold_seconds": 1.0}
+        (see sql_instrumentation.py, the report is written to sql_reports/<run_id>/)
+Optional: export the warehouse to partitioned Parquet files after the load with
+            "parquet_export": {"enabled": true, "path": "parquet_export"}
+        (see parquet_export.py, pyarrow is needed)
+Optional: cache the results of db.query() until the next load completes with
+            "query_cache": {"enabled": true, "max_entries": 256, "disk_dir": "query_cache"}
+        (see query_cache.py)
+Optional: run the extract stage partition by partition (per year) in worker processes with
+            "parallel_etl": {"enabled": true, "workers": 4, "partition": "year"}
+        (see parallel_etl.py)
+Optional: create the fact_table indexes (foreign keys, BRIN on the date key, covering) which speed up the
+analytical queries after the load with
+            "index_advisor": {"enabled": true, "create": true, "min_speedup": 1.2}
+        (see index_advisor.py, the before/after timings are written to index_reports/)
+Optional: print the size of every warehouse table with its compact types (see warehouse_schema.py) and with the
+types pandas would infer after the load with
+            "storage_report": {"enabled": true}
+Optional: profile every stage (cProfile, sampled stacks, tracemalloc) with
+            "stage_profiling": {"enabled": true}
+        (see stage_profiler.py, the profiles are written to profile_reports/<run_id>/)
+
+************************************  Command line:  ************************************
+            python A02_Team_V04.py                         full load: main()
+            python A02_Team_V04.py extract                 etl_source_data()
+            python A02_Team_V04.py dims fact finalize      the given stages, in the order of the full load
+            python A02_Team_V04.py check-connection        test_connection()
+            python A02_Team_V04.py bench dims fact         run the given stages (default: all) and time them
+            python A02_Team_V04.py watch                   load the files dropped in weather_dataset/ and crime_inbox/
+                                                           in micro-batches, after a full load (see watch_mode.py)
+            python perf_regression.py                      time the stages on a synthetic workload and compare them
+                                                           with the previous commits (see perf_regression.py)
+Stages: extract (source table), dims (crime, date, weather, neighbourhood dimensions), fact (fact table),
+finalize (Parquet export, load epoch, SQL report). A partial rerun only redoes the given stages, the earlier
+stages must have run before.
 """
 
 
@@ -25,34 +72,153 @@ def main():
         etl_source_data()
 
         # STEP#2 Respectively ETL the crime, date, weather, neighbourhood data
-        etl_crime_date_data()
-        etl_weather_neighbourhood_data()
+        etl_dimensions()
 
         # STEP#3 ETL fact table
         etl_fact_table()
 
+        # STEP#4 Export, bump the load epoch and write the reports
+        finalize_load()
+
+    except:
+        print(traceback.format_exc())
+
+
+def etl_dimensions():
+    from parallel_etl import parallel_etl_settings
+
+    # The partition-parallel load builds the dimensions in the extract stage (see parallel_etl.py)
+    if parallel_etl_settings() is not None:
+        print("The dimensions were built by the partition-parallel extract stage")
+        return
+    etl_crime_date_data()
+    etl_weather_neighbourhood_data()
+
+
+def finalize_load():
+    """A function which runs the steps following the fact table: the optional Parquet export, the load epoch
+       bump (the cached query results of the previous load are invalidated), the optional event_id Bloom filter
+       rebuild, the indexes suggested by the column statistics, the optional fact_table index advisor and the SQL
+       statement report.
+    """
+
+    try:
+        from column_statistics import build_suggested_indexes
+        from event_bloom import refresh_event_bloom
+        from index_advisor import advise_indexes
+        from parquet_export import export_star_schema
+        from query_cache import bump_load_epoch
+        from surrogate_keys import key_report
+        from warehouse_schema import report_storage
+
+        # STEP#1 Optionally export the star schema to partitioned Parquet files
+        export_star_schema()
+
+        # STEP#2 Bump the load epoch, and optionally rebuild the Bloom filter of the loaded event_id
+        with DbConnection() as db:
+            bump_load_epoch(db)
+            refresh_event_bloom(db)
+
+            # STEP#3 Optionally index the warehouse columns selected by the column statistics
+            build_suggested_indexes(db)
+
+            # Optionally time the analytical workload and keep the fact_table indexes which speed it up
+            advise_indexes(db)
+
+            # Report the high-water mark and the gaps of every surrogate key, and optionally the size of every table
+            key_report(db)
+            report_storage(db)
+
+        # STEP#4 Write the SQL statement report when the instrumentation is enabled
+        write_sql_report()
     except:
         print(traceback.format_exc())
 
 
+def bench(stage_names):
+    """A function which runs the given stages (all when empty) and prints the wall time of each one."""
+
+    timings = []
+    for stage_name in stage_names or list(STAGES):
+        start = time.perf_counter()
+        STAGES[stage_name]()
+        timings.append((stage_name, time.perf_counter() - start))
+
+    print(f"{'stage':12} {'seconds':>10}")
+    for stage_name, seconds in timings:
+        print(f"{stage_name:12} {seconds:10.3f}")
+    print(f"{'total':12} {sum(seconds for _, seconds in timings):10.3f}")
+    return timings
+
+
+def run_command_line(arguments):
+    parser = argparse.ArgumentParser(description="ETL of the crime and weather data warehouse. Without "
+                                                 "arguments the full load (main) runs.")
+    parser.add_argument("command", nargs="?", choices=list(STAGES) + ["check-connection", "bench", "watch"],
+                        help="the first stage to run, check-connection, bench, or watch")
+    parser.add_argument("stages", nargs="*", help="the following stages (or the stages timed by bench)")
+    args = parser.parse_args(arguments)
+
+    if args.command is None:
+        return main()
+    if args.command in ("check-connection", "watch") and args.stages:
+        parser.error(f"{args.command} takes no stages (got {', '.join(args.stages)})")
+    if args.command == "check-connection":
+        return test_connection()
+    if args.command == "watch":
+        from watch_mode import watch
+
+        return watch()
+
+    stage_names = args.stages if args.command == "bench" else [args.command] + args.stages
+    unknown = [stage_name for stage_name in stage_names if stage_name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)} (choose from {', '.join(STAGES)})")
+    # The stages always run in the order of the full load
+    stage_names = sorted(set(stage_names), key=list(STAGES).index)
+    if args.command == "bench":
+        return bench(stage_names)
+    for stage_name in stage_names:
+        STAGES[stage_name]()
+
+
+@profiled_stage
 def etl_fact_table():
     try:
+        from approximate_query import maintain_sketches
+        from bitmap_index import refresh_bitmap_index
+        from parallel_etl import parallel_etl_settings
+        from warehouse_schema import create_table
+
+        # The partition-parallel load builds the fact table in the extract stage (see parallel_etl.py)
+        if parallel_etl_settings() is not None:
+            print("The fact table was built by the partition-parallel extract stage")
+            return
+
         test_connection()
         with DbConnection() as db:
+            # STEP#0 Optionally maintain the approximate-query sketches before the source columns are dropped
+            maintain_sketches(db)
+
             # STEP#1 Remove redundant columns in the fact table
             command1 = """ALTER TABLE crime_weather_source_table
                         DROP COLUMN event_id, DROP COLUMN location_type, DROP COLUMN year,
                         DROP COLUMN month, DROP COLUMN day, DROP COLUMN day_of_year,
                         DROP COLUMN day_of_week, DROP COLUMN crime_type, DROP COLUMN hood_id,
-                        DROP COLUMN neighbourhood_name, DROP COLUMN weather;"""
+                        DROP COLUMN neighbourhood_name, DROP COLUMN climate_id, DROP COLUMN weather;"""
             db.cur.execute(command1)
             db.raw_conn.commit()
 
-            # STEP#2 Add the sum of daily crime number to the fact table
-            command2 = """create table fact_table as
-                            (select date_surrogate_key, event_surrogate_key, climate_surrogate_key, neighbourhood_surrogate_key,
+            # STEP#2 Add the sum of daily crime number to the fact table (typed columns, see warehouse_schema.py)
+            create_table(db, "fact_table")
+            command2 = """insert into fact_table (date_surrogate_key, event_surrogate_key, climate_surrogate_key,
+                            neighbourhood_surrogate_key, crime_number, temperature_mean, temperature_min, temperature_max,
+                            hourly_climate_surrogate_key, temperature_band_key, weather_condition_mask)
+                            select date_surrogate_key, event_surrogate_key, climate_surrogate_key, neighbourhood_surrogate_key,
                             count(date_surrogate_key) over (partition by date_surrogate_key) as crime_number, 
-                            temperature_mean, temperature_min, temperature_max from crime_weather_source_table)"""
+                            temperature_mean, temperature_min, temperature_max, hourly_climate_surrogate_key,
+                            temperature_band_key, weather_condition_mask
+                            from crime_weather_source_table"""
             db.cur.execute(command2)
             db.raw_conn.commit()
 
@@ -70,6 +236,9 @@ def etl_fact_table():
             db.cur.execute(command4)
             db.raw_conn.commit()
 
+            # STEP#6 Optionally rebuild the bitmap index of the fact table (a full load renumbers the surrogate keys)
+            refresh_bitmap_index(db, rebuild=True)
+
 
 
     except:
@@ -91,6 +260,18 @@ def add_foreign_keys():
             db.raw_conn.commit()
 
 
+            # Add foreign key constraints between fact_table and hourly_climate_surrogate_table
+            db.cur.execute(
+                "ALTER TABLE fact_table ADD CONSTRAINT hourly_climate_foreign_key FOREIGN KEY (hourly_climate_surrogate_key) REFERENCES hourly_climate_surrogate_table(hourly_climate_surrogate_key);")
+            db.raw_conn.commit()
+
+            # Add foreign key constraints between fact_table and the temperature band / weather condition tables
+            db.cur.execute(
+                "ALTER TABLE fact_table ADD CONSTRAINT temperature_band_foreign_key FOREIGN KEY (temperature_band_key) REFERENCES temperature_band_dimension_table(temperature_band_key);")
+            db.cur.execute(
+                "ALTER TABLE fact_table ADD CONSTRAINT weather_condition_set_foreign_key FOREIGN KEY (weather_condition_mask) REFERENCES weather_condition_set_table(weather_condition_mask);")
+            db.raw_conn.commit()
+
             # Add foreign key to crime_weather_source_table referencing date_surrogate_table
             command1 = """alter table fact_table
                             ADD 
@@ -123,84 +304,123 @@ def etl_weather_neighbourhood_data():
     except:
         print(traceback.format_exc())
 
-def transform_weather_data():
-    """A function which fetches the crime_weather_source_table data
-       and creates the climate_dimension_table and the climate_surrogate_table.
-       The function also merges the climate_surrogate_key to the crime_weather_source_table.
+def climate_dimension_frame(df_crime_weather):
+    """A function which builds the climate_dimension_table dataframe from the crime_weather_source_table rows:
+       one row per station and day, with the integer coded temperature band and weather conditions
+       (see climate_bands.py). It is shared by transform_weather_data() and the partition workers of
+       parallel_etl.py.
     """
 
-    try:
-        test_connection()
-        with DbConnection() as db:
+    from climate_bands import round_temperatures, temperature_band_keys, weather_condition_masks
 
-            # get the data from crime_weather_source_table
-            db.cur.execute('SELECT * FROM crime_weather_source_table')
-            db.raw_conn.commit()
+    # the columns we want to group by
+    selected_columns = ['climate_id', 'year', 'month', 'day', 'temperature_min', 'temperature_max', 'weather']
 
-            crime_weather_lst = db.cur.fetchall()
+    # the columns we need to build the climate table (keyed by station and date)
+    climate_dimension_table_columns = ['climate_id', 'day', 'month', 'year', 'temperature_mean', 'temperature_min',
+                                       'temperature_max', 'weather']
 
-            # get the columns of crime_weather_source_table
-            crime_weather_table_columns = [col[0] for col in list(db.cur.description)]
+    df_climate = df_crime_weather.groupby(selected_columns).agg({'temperature_mean': 'min'}).reset_index()
+    # half up, like the incremental load in SQL (see climate_bands.py)
+    df_climate['temperature_mean'] = round_temperatures(df_climate['temperature_mean'])
 
-            # create the dataframe for crime_weather_source_table
-            df_crime_weather = pd.DataFrame(crime_weather_lst, columns=crime_weather_table_columns)
+    df_climate = df_climate[climate_dimension_table_columns]
+    df_climate = df_climate.sort_values(['climate_id', 'year', 'month', 'day'])
 
-            # the columns we want to group by
-            selected_columns = ['year', 'month', 'day', 'temperature_min', 'temperature_max', 'weather']
+    # change the colums to integer (since it's temperature, the decimal is irrelevant)
+    df_climate['temperature_mean'] = df_climate['temperature_mean'].astype(int)
+    df_climate['temperature_min'] = df_climate['temperature_min'].astype(int)
+    df_climate['temperature_max'] = df_climate['temperature_max'].astype(int)
 
-            # the columns we need to build the climate table
-            climate_dimension_table_columns = ['day', 'month', 'year', 'temperature_mean', 'temperature_min',
-                                               'temperature_max', 'weather']
+    # Precompute the temperature band and the weather condition bitmask (small integer codes)
+    df_climate['temperature_band_key'] = temperature_band_keys(df_climate['temperature_mean'])
+    df_climate['weather_condition_mask'] = weather_condition_masks(df_climate['weather'])
 
-            df_climate = df_crime_weather.groupby(selected_columns).agg({'temperature_mean': 'min'}).reset_index()
-            df_climate['temperature_mean'] = df_climate['temperature_mean'].round()
+    return df_climate
 
-            df_climate = df_climate[climate_dimension_table_columns]
-            df_climate = df_climate.sort_values(['year', 'month', 'day'])
 
-            # change the colums to integer (since it's temperature, the decimal is irrelevant)
-            df_climate['temperature_mean'] = df_climate['temperature_mean'].astype(int)
-            df_climate['temperature_min'] = df_climate['temperature_min'].astype(int)
-            df_climate['temperature_max'] = df_climate['temperature_max'].astype(int)
+def load_climate_tables(db, df_climate, df_climate_lookup):
+    """A function which loads the climate_dimension_table and the climate_surrogate_table with their keys, and
+       the temperature band and weather condition tables referenced by the codes.
+    """
 
-            # This will be needed for the lookup table
-            year_month_day_columns = df_climate[['year', 'month', 'day']]
+    from climate_bands import load_climate_band_tables
+    from warehouse_schema import create_table
 
-            # Push to PostgreSQL
-            df_climate.to_sql("climate_dimension_table", con=db.engine, if_exists="replace", index=True)
+    # Push to PostgreSQL (into the typed table, see warehouse_schema.py)
+    create_table(db, "climate_dimension_table")
+    df_climate.to_sql("climate_dimension_table", con=db.engine, if_exists="append", index=False)
 
-            # Set the composite PKs
-            db.cur.execute("ALTER TABLE climate_dimension_table ADD PRIMARY KEY(year,month,day);")
-            db.raw_conn.commit()
+    # Set the composite PKs
+    db.cur.execute("ALTER TABLE climate_dimension_table ADD PRIMARY KEY(climate_id,year,month,day);")
+    db.cur.execute(
+        "ALTER TABLE climate_dimension_table ADD CONSTRAINT weather_station_foreign_key FOREIGN KEY (climate_id) REFERENCES weather_station_table(climate_id);")
+    db.raw_conn.commit()
+
+    # Create the temperature band and weather condition tables referenced by the codes
+    load_climate_band_tables(db)
+    db.cur.execute(
+        "ALTER TABLE climate_dimension_table ADD CONSTRAINT temperature_band_foreign_key FOREIGN KEY (temperature_band_key) REFERENCES temperature_band_dimension_table(temperature_band_key);")
+    db.cur.execute(
+        "ALTER TABLE climate_dimension_table ADD CONSTRAINT weather_condition_set_foreign_key FOREIGN KEY (weather_condition_mask) REFERENCES weather_condition_set_table(weather_condition_mask);")
+    db.raw_conn.commit()
+
+    # Push the dataframe to PostgreSQL
+    create_table(db, "climate_surrogate_table")
+    df_climate_lookup.to_sql("climate_surrogate_table", con=db.engine, if_exists="append", index=False)
+
+    # Set the composite PKs
+    db.cur.execute("ALTER TABLE climate_surrogate_table ADD PRIMARY KEY(climate_surrogate_key);")
+    db.raw_conn.commit()
+
+    # Add foreign key constraints between climate_surrogate_table and climate_dimension_table
+    db.cur.execute(
+        "ALTER TABLE climate_surrogate_table ADD CONSTRAINT climate_foreign_key FOREIGN KEY (climate_id,year,month,day) REFERENCES climate_dimension_table(climate_id,year,month,day);")
+    db.raw_conn.commit()
+
+
+@profiled_stage
+def transform_weather_data():
+    """A function which fetches the crime_weather_source_table data
+       and creates the climate_dimension_table and the climate_surrogate_table, with the integer coded
+       temperature band and weather conditions of every day (see climate_bands.py).
+       The function also merges the climate_surrogate_key, the temperature_band_key and the weather_condition_mask
+       to the crime_weather_source_table.
+    """
+
+    try:
+        import pandas as pd
+        from surrogate_keys import allocate_surrogate_keys
+
+        test_connection()
+        with DbConnection() as db:
+
+            # get the data from crime_weather_source_table (streamed with COPY TO STDOUT into typed columns)
+            df_crime_weather = db.read_table("crime_weather_source_table")
+
+            # the climate table (keyed by station and date), with its temperature band and weather conditions
+            df_climate = climate_dimension_frame(df_crime_weather)
 
             # Create the climate_surrogate_table dataframe
-            df_climate_lookup = year_month_day_columns
+            df_climate_lookup = df_climate[['climate_id', 'year', 'month', 'day']]
 
-            df_climate_lookup.insert(0, 'climate_surrogate_key', range(1, len(df_climate_lookup) + 1))
+            # The surrogate keys are one block of the key allocator (see surrogate_keys.py)
+            df_climate_lookup.insert(0, 'climate_surrogate_key', allocate_surrogate_keys(
+                db, "climate_surrogate_key", len(df_climate_lookup), reset=True))
 
             # Set the data to be of type integer
             integer_type_map = {"year": int, "month": int, "day": int, "climate_surrogate_key": int}
 
             df_climate_lookup = df_climate_lookup.astype(integer_type_map)
-            # df_climate_lookup['year'] = df_climate_lookup['year'].astype(int)
-            # df_climate_lookup['month'] = df_climate_lookup['month'].astype(int)
-            # df_climate_lookup['day'] = df_climate_lookup['day'].astype(int)
-            # df_climate_lookup['climate_surrogate_key'] = df_climate_lookup['climate_surrogate_key'].astype(int)
 
-            # Push the dataframe to PostgreSQL
-            df_climate_lookup.to_sql("climate_surrogate_table", con=db.engine, if_exists="replace", index=False)
+            # Push both tables to PostgreSQL
+            load_climate_tables(db, df_climate, df_climate_lookup)
 
-            # Set the composite PKs
-            db.cur.execute("ALTER TABLE climate_surrogate_table ADD PRIMARY KEY(climate_surrogate_key);")
-            db.raw_conn.commit()
-
-            # Add foreign key constraints between climate_surrogate_table and climate_dimension_table
-            db.cur.execute(
-                "ALTER TABLE climate_surrogate_table ADD CONSTRAINT climate_foreign_key FOREIGN KEY (year,month,day) REFERENCES climate_dimension_table(year,month,day);")
-            db.raw_conn.commit()
-
-            # Left join crime_weather_source_table with climate_surrogate_table
-            df_merge = pd.merge(df_crime_weather, df_climate_lookup, on=['year', 'month', 'day'], how='left')
+            # Left join crime_weather_source_table with climate_surrogate_table and the climate codes
+            df_merge = pd.merge(df_crime_weather, df_climate_lookup, on=['climate_id', 'year', 'month', 'day'], how='left')
+            df_merge = pd.merge(df_merge, df_climate[['climate_id', 'year', 'month', 'day', 'temperature_band_key',
+                                                      'weather_condition_mask']],
+                                on=['climate_id', 'year', 'month', 'day'], how='left')
 
             # Push the merged table to PostgreSQL
             df_merge.to_sql("crime_weather_source_table", con=db.engine, if_exists="replace", index=False)
@@ -209,66 +429,89 @@ def transform_weather_data():
         print(traceback.format_exc())
 
 
-def transform_neighbourhood_data():
-    """A function which fetches the crime_weather_source_table data
-       and creates the neighbourhood_dimension_table and the neighbourhood_surrogate_table.
-       The function also merges the neighbourhood_surrogate_key to the crime_weather_source_table.
+def load_neighbourhood_tables(db, df_crime_weather):
+    """A function which merges the neighbourhoods of the crimes into the versioned neighbourhood_dimension_table
+       (SCD type 2) and loads the neighbourhood_surrogate_table, pointing to the current version of every
+       neighbourhood. Returns the neighbourhood_surrogate_table dataframe.
     """
 
-    try:
-        test_connection()
-        with DbConnection() as db:
-            # Get the data from crime_weather_source_table
-            db.cur.execute('SELECT * FROM crime_weather_source_table')
-            db.raw_conn.commit()
-            crime_weather_lst = db.cur.fetchall()
+    import pandas as pd
+    from scd2_merge import ensure_scd2_table, scd2_merge
+    from surrogate_keys import allocate_surrogate_keys
+    from warehouse_schema import column_types, create_table
 
-            # Get the crime_weather_source_table columns
-            crime_weather_table_columns = [col[0] for col in list(db.cur.description)]
+    # Create the neighbourhood table (one row per hood_id)
+    df_neighbourhood = df_crime_weather[['hood_id', 'neighbourhood_name']].drop_duplicates(subset=['hood_id'])
+    df_neighbourhood = df_neighbourhood.sort_values(['hood_id'])
 
-            # Create the crime_weather_source_table dataframe
-            df_crime_weather = pd.DataFrame(crime_weather_lst, columns=crime_weather_table_columns)
+    # Merge it into the versioned neighbourhood_dimension_table through a staging table (SCD type 2: a changed
+    # neighbourhood gets a new version, the previous one is closed, see scd2_merge.py)
+    ensure_scd2_table(db, "neighbourhood_dimension_table", ['hood_id'], ['neighbourhood_name'],
+                      column_types("neighbourhood_dimension_table"))
+    df_neighbourhood.to_sql("neighbourhood_staging_table", con=db.engine, if_exists="replace", index=False)
+    scd2_merge(db, "neighbourhood_dimension_table", "neighbourhood_staging_table", ['hood_id'],
+               ['neighbourhood_name'])
 
-            # Create the neighbourhood_look_up table dataframe
-            df_neighbourhood_lookup = pd.DataFrame(columns=['hood_id'])
-            df_neighbourhood_lookup['hood_id'] = df_crime_weather['hood_id'].unique()
+    # Create the neighbourhood_look_up table dataframe
+    df_neighbourhood_lookup = pd.DataFrame(columns=['hood_id'])
+    df_neighbourhood_lookup['hood_id'] = df_crime_weather['hood_id'].unique()
 
-            # Add the surrogate key column
-            df_neighbourhood_lookup.insert(0, 'neighbourhood_surrogate_key', range(1, len(df_neighbourhood_lookup) + 1))
+    # Add the surrogate key column
+    df_neighbourhood_lookup.insert(0, 'neighbourhood_surrogate_key', allocate_surrogate_keys(
+        db, "neighbourhood_surrogate_key", len(df_neighbourhood_lookup), reset=True))
 
-            # Set the data to be of type integer
-            integer_type_map = {"hood_id": int}
-            df_neighbourhood_lookup = df_neighbourhood_lookup.astype(integer_type_map)
+    # Set the data to be of type integer
+    integer_type_map = {"hood_id": int}
+    df_neighbourhood_lookup = df_neighbourhood_lookup.astype(integer_type_map)
 
-            df_neighbourhood_lookup['hood_id'] = df_neighbourhood_lookup['hood_id'].astype(int)
-            df_neighbourhood_lookup['neighbourhood_surrogate_key'] = df_neighbourhood_lookup[
-                'neighbourhood_surrogate_key'].astype(int)
+    df_neighbourhood_lookup['hood_id'] = df_neighbourhood_lookup['hood_id'].astype(int)
+    df_neighbourhood_lookup['neighbourhood_surrogate_key'] = df_neighbourhood_lookup[
+        'neighbourhood_surrogate_key'].astype(int)
 
-            # Push the neighbourhood_surrogate_table to PostgreSQL
-            df_neighbourhood_lookup.to_sql("neighbourhood_surrogate_table", con=db.engine, if_exists="replace",
-                                           index=False)
+    # The crimes of the load refer to the current version of their neighbourhood
+    db.cur.execute("SELECT hood_id, valid_from FROM neighbourhood_dimension_table WHERE is_current")
+    df_current_version = pd.DataFrame(db.cur.fetchall(), columns=['hood_id', 'valid_from'])
+    df_neighbourhood_lookup = pd.merge(df_neighbourhood_lookup, df_current_version, on='hood_id', how='left')
 
-            # Set the composite PKs
-            db.cur.execute("ALTER TABLE neighbourhood_surrogate_table ADD PRIMARY KEY(neighbourhood_surrogate_key);")
-            db.raw_conn.commit()
-            # Create the neighbourhood table
-            df_neighbourhood = df_crime_weather[['hood_id', 'neighbourhood_name']].drop_duplicates()
-            df_neighbourhood = df_neighbourhood.sort_values(['hood_id'])
+    # Push the neighbourhood_surrogate_table to PostgreSQL
+    create_table(db, "neighbourhood_surrogate_table")
+    df_neighbourhood_lookup.to_sql("neighbourhood_surrogate_table", con=db.engine, if_exists="append",
+                                   index=False)
 
-            # Push the neighbourhood_dimension_table dataframe to PostgreSQL
-            df_neighbourhood.to_sql("neighbourhood_dimension_table", con=db.engine, if_exists="replace", index=False)
+    # Set the composite PKs
+    db.cur.execute("ALTER TABLE neighbourhood_surrogate_table ADD PRIMARY KEY(neighbourhood_surrogate_key);")
+    db.raw_conn.commit()
 
-            # Set the hood_id as the PK
-            db.cur.execute("ALTER TABLE neighbourhood_dimension_table ADD PRIMARY KEY(hood_id);")
-            db.raw_conn.commit()
+    # Add foreign key constraints between neighbourhood_surrogate_table and the version of neighbourhood_dimension_table
+    db.cur.execute(
+        "ALTER TABLE neighbourhood_surrogate_table ADD CONSTRAINT neighbourhood_foreign_key FOREIGN KEY (hood_id,valid_from) REFERENCES neighbourhood_dimension_table(hood_id,valid_from);")
+    db.raw_conn.commit()
 
-            # Add foreign key constraints between neighbourhood_surrogate_table and neighbourhood_dimension_table
-            db.cur.execute(
-                "ALTER TABLE neighbourhood_surrogate_table ADD CONSTRAINT neighbourhood_foreign_key FOREIGN KEY (hood_id) REFERENCES neighbourhood_dimension_table(hood_id);")
-            db.raw_conn.commit()
+    return df_neighbourhood_lookup
+
+
+@profiled_stage
+def transform_neighbourhood_data():
+    """A function which fetches the crime_weather_source_table data
+       and merges the neighbourhoods into the versioned neighbourhood_dimension_table (SCD type 2),
+       then creates the neighbourhood_surrogate_table, pointing to the current version of every neighbourhood.
+       The function also merges the neighbourhood_surrogate_key to the crime_weather_source_table.
+    """
+
+    try:
+        import pandas as pd
+
+        test_connection()
+        with DbConnection() as db:
+            # Get the data from crime_weather_source_table (streamed with COPY TO STDOUT into typed columns)
+            df_crime_weather = db.read_table("crime_weather_source_table")
+
+            # Merge the neighbourhoods and push the neighbourhood_surrogate_table to PostgreSQL
+            df_neighbourhood_lookup = load_neighbourhood_tables(db, df_crime_weather)
 
             # Left join crime_weather_source_table with neighbourhood_surrogate_table
-            df_merge = pd.merge(df_crime_weather, df_neighbourhood_lookup, on='hood_id', how='left')
+            df_merge = pd.merge(df_crime_weather, df_neighbourhood_lookup[['neighbourhood_surrogate_key', 'hood_id']],
+                                on='hood_id', how='left')
             df_merge.to_sql("crime_weather_source_table", con=db.engine, if_exists="replace", index=False)
 
     except:
@@ -294,6 +537,8 @@ class DbConnection:
 
     def __init__(self):
         try:
+            from sqlalchemy import create_engine
+
             with open("./config.json") as jsonfile:
                 config = json.load(jsonfile)
 
@@ -310,6 +555,11 @@ class DbConnection:
                 self.conn = self.engine.connect()
                 self.raw_conn = self.engine.raw_connection()  # Raw connection help invoke the connection from DBAPI(Psycopg2)
                 self.cur = self.raw_conn.cursor()
+
+                # Optionally time every statement and capture the plan of the slow ones
+                sql_instrumentation = instrumentation_settings()
+                if sql_instrumentation is not None:
+                    self.cur = InstrumentedCursor(self.cur, sql_instrumentation)
                 print("Connection to database successfully... \n")
 
         except Exception as e:
@@ -319,6 +569,24 @@ class DbConnection:
     def __enter__(self):
         return self
 
+    def query(self, sql, params=None):
+        """A function which runs a read query and returns its result as a DataFrame, through the query result
+           cache when it is enabled (see query_cache.py).
+        """
+
+        from query_cache import run_query
+
+        return run_query(self.cur, sql, params)
+
+    def read_table(self, table_name, columns=None, where=None, params=None, format="csv"):
+        """A function which reads the given columns (all when None) of the rows of a table matching the WHERE
+           clause with COPY ... TO STDOUT, and returns them as a typed DataFrame (see copy_reader.py).
+        """
+
+        from copy_reader import read_table_copy
+
+        return read_table_copy(self.cur, table_name, columns, where, params, format)
+
     def __exit__(self, type, value, traceback):
         self.conn.close()
         self.raw_conn.close()
@@ -337,54 +605,69 @@ def test_connection():
 
 
 
+@profiled_stage
 def etl_source_data():
     try:
+        import pandas as pd
+        from column_statistics import compact_dtypes, record_profile
+        from crime_normalization import CRIME_NORMALIZATION_SPEC, normalize_frame
+        from external_dedup import external_dedup_settings, read_csv_deduplicated
+        from hourly_climate import attach_hourly_climate_key, build_hourly_climate_tables
+        from parallel_etl import load_source_data_parallel, parallel_etl_settings
+        from surrogate_keys import allocate_surrogate_keys
+        from spatial_resolver import load_resolver, resolve_nsa_neighbourhoods
+        from station_resolver import assign_nearest_station
+        from warehouse_schema import create_table
+
         test_connection()
         with DbConnection() as db:
 
             #STEP#1-1 Data extraction: extract crime source data from crime_dataset.csv file
-            df = pd.read_csv("./crime_dataset.csv")
+            #         (read in chunks and deduplicated out of core when external_dedup is enabled, see external_dedup.py)
+            dedup_settings = external_dedup_settings()
+            if dedup_settings is None:
+                df = pd.read_csv("./crime_dataset.csv")
+            else:
+                df = read_csv_deduplicated("./crime_dataset.csv", ['event_id'], dedup_settings,
+                                           prepare=lambda chunk: chunk.set_axis(chunk.columns.str.lower(), axis=1),
+                                           keep_rows=lambda rows: rows[rows.occurrence_year.isin([2017, 2018, 2019, 2020])])
             print(df.head())
             print(df.shape)
+            # Optionally record the column statistics of the source file (see column_statistics.py)
+            record_profile(db, df, "crime_dataset.csv")
 
             # STEP#2-1 Data transformation(crime data transformation): remove duplicate/noise, handle null, filter data, etc.
             # (1) Unify column name to lower case
-            for column_name in df.columns:
-                df.rename(columns={column_name: column_name.lower()}, inplace=True)
-                print(column_name)
+            df.columns = df.columns.str.lower()
+            print(list(df.columns))
 
-            # (2) Remove duplicated event_id
-            df.drop_duplicates(subset=['event_id'], keep='first', inplace=True)
+            # (2) Remove duplicated event_id (already done out of core when external_dedup is enabled)
+            if dedup_settings is None:
+                df.drop_duplicates(subset=['event_id'], keep='first', inplace=True)
 
             # (3) Remove noise data which is not in span from year 2017 to 2020
             df = df[df.occurrence_year.isin([2017, 2018, 2019, 2020])]
 
-            # (4) Unify text value to lower case
-            df.event_id = df.event_id.str.lower()
-            df.occurrence_month = df.occurrence_month.str.lower()
-            df.location_type = df.location_type.str.lower()
-            df.day_of_week = df.day_of_week.str.lower()
-            df.crime_type = df.crime_type.str.lower()
-            df.neighbourhood_name = df.neighbourhood_name.str.lower()
-
-            # (5) Convert string month to integer
-            month_map = {"january":1, "february":2, "march":3, "april":4, "may":5, "june":6,
-                         "july":7, "august":8, "september":9, "october":10, "november":11, "december":12}
-            df.occurrence_month = df.occurrence_month.map(month_map)
-
-            # (6) Fix noise data in column neighbourhood_name and hood_id
-            df.neighbourhood_name.replace("nsa", "random", inplace=True)
-            df.hood_id.replace("NSA", "0", inplace=True)
-
-            # (7) Unify integer value to integer type
-            integer_type_map = {"occurrence_year": int, "occurrence_month": int,
-                                "occurrence_day": int, "day_of_year": int, "hood_id": int}
-            df = df.astype(integer_type_map)
-
-            # (8) Rename column
-            df.rename(columns={df.columns[2]: 'year', df.columns[3]: 'month', df.columns[4]: 'day'}, inplace=True)
-
-            # STEP#3-1 Data loading(load crime source data)
+            # Optionally run the rest of the load (dimensions and fact table included) partition by partition
+            # (year or month) in worker processes
+            parallel_settings = parallel_etl_settings()
+            if parallel_settings is not None:
+                load_source_data_parallel(db, df, parallel_settings)
+                return
+
+            # (4) Optionally resolve the neighbourhood of the "NSA" crimes from their coordinates
+            resolver, resolver_settings = load_resolver()
+            if resolver is not None:
+                df = resolve_nsa_neighbourhoods(df, resolver, resolver_settings)
+
+            # (5) Unify text value to lower case, convert string month to integer, fix noise data in column
+            #     neighbourhood_name and hood_id, unify integer value to integer type and rename the
+            #     occurrence_year/month/day columns: one pass per column driven by CRIME_NORMALIZATION_SPEC
+            df, normalization_report = normalize_frame(df, CRIME_NORMALIZATION_SPEC)
+            print(normalization_report)
+
+            # STEP#3-1 Data loading(load crime source data, with the dtypes suggested by its column statistics)
+            df = compact_dtypes(df, record_profile(db, df, "crime_source_table"))
             df.to_sql("crime_source_table", con=db.engine, if_exists="replace", index=False)
 
 
@@ -394,60 +677,55 @@ def etl_source_data():
             weather_source_files = os.listdir(path)
             for file_name in weather_source_files:
                 weather_source_path = path + "/" + file_name
-                df_weather_peryear = pd.read_csv(weather_source_path)
+                df_weather_peryear = pd.read_csv(weather_source_path, dtype={"Climate ID": str})
                 weather_df_list.append(df_weather_peryear)
             df_weather = pd.concat(weather_df_list, axis=0, ignore_index=True)
 
             print(df_weather.shape)
             print(df_weather.head)
+            record_profile(db, df_weather, "weather_dataset")
 
             # STEP#2-2 Data transformation(weather data transformation): remove duplicate/noise, handle null, filter data, etc.
-            # (1) Drop irrelevant columns
-            df_weather.drop(columns=["Longitude (x)", "Latitude (y)", "Station Name", "Climate ID", "Date/Time",
-                                     "Temp Flag", "Dew Point Temp (°C)", "Dew Point Temp Flag", "Rel Hum (%)",
-                                     "Rel Hum Flag", "Wind Dir (10s deg)", "Wind Dir Flag", "Wind Spd (km/h)",
-                                     "Wind Spd Flag", "Visibility (km)", "Visibility Flag", "Stn Press (kPa)",
-                                     "Stn Press Flag", "Hmdx", "Hmdx Flag", "Wind Chill", "Wind Chill Flag"
-                                     ], inplace=True)
+            df_weather, df_stations, df_weather_hourly = transform_weather_source(df_weather)
 
-            # (2) Rename column
-            df_weather.rename(columns={df_weather.columns[4]: 'temperature'}, inplace=True)
-
-            # (3) Unify column name to lower case
-            for column_name in df_weather.columns:
-                df_weather.rename(columns={column_name: column_name.lower()}, inplace=True)
-
-            # (4) Remove duplicated event_id
-            df_weather.drop_duplicates(subset=['year', 'month', 'day', 'time'], keep='first', inplace=True)
-
-            # (5) Unify text value to lower case
-            df_weather.weather = df_weather.weather.str.lower()
 
+            # STEP#3-2 Data loading(load weather data, with the dtypes suggested by its column statistics)
+            df_weather = compact_dtypes(df_weather, record_profile(db, df_weather, "weather_source_table"))
+            df_weather.to_sql("weather_source_table", con=db.engine, if_exists="append", index=False)
 
-            # (6) Handle the null value in weahter column
-            df_weather.weather.fillna(value="normal", inplace=True)
 
-            # (7) Calculate mean, min, and max temperature
-            group_date = df_weather.groupby(['year', 'month', 'day'], as_index=False)
-            argg_group_date = group_date.agg( {'temperature': ['mean', 'min', 'max'], 'weather':['max']})
-            argg_group_date.columns = list(map(''.join, argg_group_date.columns.values))
-            df_weather = argg_group_date
-            df_weather.rename(columns={df_weather.columns[3]: 'temperature_mean',
-                                       df_weather.columns[4]: 'temperature_min',
-                                       df_weather.columns[5]: 'temperature_max',
-                                       df_weather.columns[6]: 'weather'}, inplace=True)
+            # STEP#3-3 Data loading(load weather stations, every neighbourhood is attached to its nearest station)
+            create_table(db, "weather_station_table")
+            df_stations.to_sql("weather_station_table", con=db.engine, if_exists="append", index=False)
+            db.cur.execute("ALTER TABLE weather_station_table ADD PRIMARY KEY(climate_id);")
+            db.raw_conn.commit()
 
-            # (8) Unify integer value to integer type
-            integer_type_map = {"year": int, "month": int, "day": int}
-            df_weather = df_weather.astype(integer_type_map)
+            df, df_neighbourhood_station = assign_nearest_station(df, df_stations, resolver_settings["longitude_column"],
+                                                                  resolver_settings["latitude_column"], resolver)
+            print(df_neighbourhood_station.head())
 
+            # STEP#3-4 Data loading(load hourly climate data)
+            df_hourly_climate, df_hourly_climate_lookup = build_hourly_climate_tables(df_weather_hourly)
+            df_hourly_climate_lookup['hourly_climate_surrogate_key'] = allocate_surrogate_keys(
+                db, "hourly_climate_surrogate_key", len(df_hourly_climate_lookup), reset=True)
+            create_table(db, "hourly_climate_dimension_table")
+            df_hourly_climate.to_sql("hourly_climate_dimension_table", con=db.engine, if_exists="append", index=False)
+            db.cur.execute("ALTER TABLE hourly_climate_dimension_table ADD PRIMARY KEY(climate_id,year,month,day,hour);")
+            db.raw_conn.commit()
 
-            # STEP#3-2 Data loading(load weather data)
-            df_weather.to_sql("weather_source_table", con=db.engine, if_exists="append", index=False)
+            create_table(db, "hourly_climate_surrogate_table")
+            df_hourly_climate_lookup.to_sql("hourly_climate_surrogate_table", con=db.engine, if_exists="append",
+                                            index=False)
+            db.cur.execute("ALTER TABLE hourly_climate_surrogate_table ADD PRIMARY KEY(hourly_climate_surrogate_key);")
+            db.cur.execute(
+                "ALTER TABLE hourly_climate_surrogate_table ADD CONSTRAINT hourly_climate_foreign_key FOREIGN KEY (climate_id,year,month,day,hour) REFERENCES hourly_climate_dimension_table(climate_id,year,month,day,hour);")
+            db.raw_conn.commit()
 
+            # Attach the nearest hourly observation to every crime (sorted as-of join on the occurrence timestamp)
+            df = attach_hourly_climate_key(df, df_hourly_climate_lookup)
 
-            # STEP#3-3 Data loading(load joint weather & crime data)
-            df_merge = pd.merge(df, df_weather, on=['year', 'month', 'day'], how='left')
+            # STEP#3-5 Data loading(load joint weather & crime data, on the station of the neighbourhood)
+            df_merge = pd.merge(df, df_weather, on=['climate_id', 'year', 'month', 'day'], how='left')
             df_merge.to_sql("crime_weather_source_table", con=db.engine, if_exists="replace", index=False)
 
 
@@ -455,8 +733,68 @@ def etl_source_data():
         print(traceback.format_exc())
 
 
+def transform_weather_source(df_weather):
+    """A function which cleans the weather source data read from the weather_dataset/*.csv files: remove
+       duplicate/noise, handle null, aggregate the hourly observations per station and day.
+       Returns the daily weather, the weather stations and the hourly weather dataframes.
+    """
+
+    from hourly_climate import hourly_weather_frame
+    from station_resolver import weather_stations
+
+    # (1) Drop irrelevant columns (the station columns are kept to attach every neighbourhood to its nearest station)
+    df_weather.drop(columns=["Date/Time",
+                             "Temp Flag", "Dew Point Temp (°C)", "Dew Point Temp Flag", "Rel Hum (%)",
+                             "Rel Hum Flag", "Wind Dir (10s deg)", "Wind Dir Flag", "Wind Spd (km/h)",
+                             "Wind Spd Flag", "Visibility (km)", "Visibility Flag", "Stn Press (kPa)",
+                             "Stn Press Flag", "Hmdx", "Hmdx Flag", "Wind Chill", "Wind Chill Flag"
+                             ], inplace=True)
+
+    # (2) Rename column
+    df_weather.rename(columns={"Temp (°C)": 'temperature', "Longitude (x)": 'longitude', "Latitude (y)": 'latitude',
+                               "Station Name": 'station_name', "Climate ID": 'climate_id'}, inplace=True)
+
+    # (3) Unify column name to lower case
+    for column_name in df_weather.columns:
+        df_weather.rename(columns={column_name: column_name.lower()}, inplace=True)
+
+    # (4) Remove duplicated event_id
+    df_weather.drop_duplicates(subset=['climate_id', 'year', 'month', 'day', 'time'], keep='first', inplace=True)
+
+    # (5) Unify text value to lower case
+    df_weather.weather = df_weather.weather.str.lower()
+
+
+    # (6) Handle the null value in weahter column
+    df_weather['weather'] = df_weather['weather'].fillna("normal")
+
+    # (7) Keep the weather stations and the hourly grain for the hourly climate dimension
+    df_stations = weather_stations(df_weather)
+    df_weather_hourly = hourly_weather_frame(df_weather)
+
+    # (8) Calculate mean, min, and max temperature per station
+    group_date = df_weather.groupby(['climate_id', 'year', 'month', 'day'], as_index=False)
+    argg_group_date = group_date.agg( {'temperature': ['mean', 'min', 'max'], 'weather':['max']})
+    argg_group_date.columns = list(map(''.join, argg_group_date.columns.values))
+    df_weather = argg_group_date
+    df_weather.rename(columns={'temperaturemean': 'temperature_mean',
+                               'temperaturemin': 'temperature_min',
+                               'temperaturemax': 'temperature_max',
+                               'weathermax': 'weather'}, inplace=True)
+
+    # (9) Unify integer value to integer type
+    integer_type_map = {"year": int, "month": int, "day": int}
+    df_weather = df_weather.astype(integer_type_map)
+
+    return df_weather, df_stations, df_weather_hourly
+
+
+@profiled_stage
 def etl_crime_date_data():
     try:
+        from surrogate_keys import first_surrogate_key
+        from warehouse_schema import create_table
+
         test_connection()
 
         with DbConnection() as db:
@@ -468,26 +806,25 @@ def etl_crime_date_data():
             db.raw_conn.commit()
 
             # STEP#2 Extract date dimension table from date source table by removing duplicate
-            db.cur.execute("create table date_dimension_table as (select distinct * from date_source_table)")
+            create_table(db, "date_dimension_table")
+            db.cur.execute("""insert into date_dimension_table (year, month, day, day_of_year, day_of_week)
+                                select distinct year, month, day, day_of_year, day_of_week from date_source_table""")
             db.raw_conn.commit()
 
             # STEP#3 Add primary key to date dimension table
             db.cur.execute("alter table date_dimension_table add primary key (year, month, day)")
             db.raw_conn.commit()
 
-            # STEP#4 Generate date surrogate table
-            command = """create table date_surrogate_table(
-                                date_surrogate_key SERIAL,
-                                year int,
-                                month int,
-                                day int,
-                                primary key (date_surrogate_key)
-                                )"""
-            db.cur.execute(command)
-
-            command2 = """insert into date_surrogate_table(year, month, day)
-                            select distinct year, month, day from crime_weather_source_table"""
-            db.cur.execute(command2)
+            # STEP#4 Generate date surrogate table (keys reserved from the key allocator, see surrogate_keys.py)
+            create_table(db, "date_surrogate_table")
+            db.cur.execute("alter table date_surrogate_table add primary key (date_surrogate_key)")
+
+            db.cur.execute("select count(*) from date_dimension_table")
+            first_key = first_surrogate_key(db, "date_surrogate_key", db.cur.fetchone()[0], reset=True)
+            command2 = """insert into date_surrogate_table(date_surrogate_key, year, month, day)
+                            select %s - 1 + row_number() over (order by year, month, day), year, month, day
+                            from date_dimension_table"""
+            db.cur.execute(command2, (first_key,))
 
             command3 = """select * from crime_weather_source_table join date_surrogate_table
                             using(year, month, day) order by year, month, day ASC LIMIT 10"""
@@ -499,7 +836,7 @@ def etl_crime_date_data():
 
             # STEP#5 add date_surrogate_key into tmp_crime_weather_source_table
             command4 = """create table tmp_crime_weather_source_table as
-                            (select event_id, location_type, crime_weather_source_table.year, crime_weather_source_table.month, crime_weather_source_table.day, day_of_year, day_of_week, crime_type, hood_id, neighbourhood_name, temperature_mean, temperature_min, temperature_max, weather, date_surrogate_table.date_surrogate_key 
+                            (select event_id, location_type, crime_weather_source_table.year, crime_weather_source_table.month, crime_weather_source_table.day, day_of_year, day_of_week, crime_type, hood_id, neighbourhood_name, climate_id, temperature_mean, temperature_min, temperature_max, weather, hourly_climate_surrogate_key, date_surrogate_table.date_surrogate_key 
                             from crime_weather_source_table join date_surrogate_table
 	                        on crime_weather_source_table.year = date_surrogate_table.year and 
 	                        crime_weather_source_table.month = date_surrogate_table.month and 
@@ -515,25 +852,27 @@ def etl_crime_date_data():
             db.raw_conn.commit()
 
             # STEP#7 Extract crime event dimension table from crime event source table by removing duplicate
-            db.cur.execute(
-                "create table crime_event_dimension_table as (select distinct * from crime_event_source_table)")
+            create_table(db, "crime_event_dimension_table")
+            db.cur.execute("""insert into crime_event_dimension_table (event_id, crime_type, year, month, day,
+                                day_of_year, day_of_week, location_type)
+                                select distinct event_id, crime_type, year, month, day, day_of_year, day_of_week,
+                                location_type from crime_event_source_table""")
             db.raw_conn.commit()
 
             # STEP#8 Add primary key to crime event dimension table
             db.cur.execute("alter table crime_event_dimension_table add primary key (event_id)")
             db.raw_conn.commit()
 
-            # STEP#9 Generate crime event surrogate table
-            command = """create table crime_event_surrogate_table(
-                                event_surrogate_key SERIAL,
-                                event_id text,
-                                primary key (event_surrogate_key)
-                                )"""
-            db.cur.execute(command)
+            # STEP#9 Generate crime event surrogate table (keys reserved from the key allocator)
+            create_table(db, "crime_event_surrogate_table")
+            db.cur.execute("alter table crime_event_surrogate_table add primary key (event_surrogate_key)")
 
-            command2 = """insert into crime_event_surrogate_table(event_id)
-                            select distinct event_id from tmp_crime_weather_source_table"""
-            db.cur.execute(command2)
+            db.cur.execute("select count(*) from crime_event_dimension_table")
+            first_key = first_surrogate_key(db, "event_surrogate_key", db.cur.fetchone()[0], reset=True)
+            command2 = """insert into crime_event_surrogate_table(event_surrogate_key, event_id)
+                            select %s - 1 + row_number() over (order by event_id), event_id
+                            from crime_event_dimension_table"""
+            db.cur.execute(command2, (first_key,))
 
             command3 = """select * from tmp_crime_weather_source_table join crime_event_surrogate_table
                             using(event_id) order by event_id ASC LIMIT 10"""
@@ -545,7 +884,7 @@ def etl_crime_date_data():
 
             # STEP#10 add crime_event_surrogate_key into crime_weather_source_table
             command4 = """create table crime_weather_source_table as
-                            (select tmp_crime_weather_source_table.event_id, location_type, year, month, day, day_of_year, day_of_week, crime_type, hood_id, neighbourhood_name, temperature_mean, temperature_min, temperature_max, weather, date_surrogate_key, event_surrogate_key
+                            (select tmp_crime_weather_source_table.event_id, location_type, year, month, day, day_of_year, day_of_week, crime_type, hood_id, neighbourhood_name, climate_id, temperature_mean, temperature_min, temperature_max, weather, hourly_climate_surrogate_key, date_surrogate_key, event_surrogate_key
                             from tmp_crime_weather_source_table join crime_event_surrogate_table
 	                        on tmp_crime_weather_source_table.event_id = crime_event_surrogate_table.event_id)"""
             db.cur.execute(command4)
@@ -578,5 +917,14 @@ def etl_crime_date_data():
         print(traceback.format_exc())
 
 
+# Stages of the command line, in the order of the full load
+STAGES = {
+    "extract": etl_source_data,
+    "dims": etl_dimensions,
+    "fact": etl_fact_table,
+    "finalize": finalize_load,
+}
+
+
 if __name__ == "__main__":
-    main()
+    run_command_line(sys.argv[1:])
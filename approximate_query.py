@@ -0,0 +1,315 @@
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from pipeline_config import load_section
+
+"""
+************************************  Approximate queries (HyperLogLog + reservoir samples):  ************************************
+When the "approximate_query" section of config.json is enabled, etl_fact_table() maintains a SketchStore while it
+builds the fact table:
+            "approximate_query": {"enabled": true, "path": "approximate_sketches.npz"}
+
+The store has one cell per (year, month, day, hood_id, crime_type), with:
+    - the exact number of crimes of the cell,
+    - a HyperLogLog sketch of the event_id of the cell, kept sparse (only the (register, rank) pairs which are set),
+    - a bottom-k reservoir sample of the cell: the k crimes with the smallest pseudo-random priority.
+Both sketches are mergeable: the HyperLogLog of a union is the register-wise maximum, and the bottom-k sample of a
+union is the k smallest priorities of the union, so stores of several loads (or partitions) are combined by merge().
+
+Queries select cells with equality/list filters on the cell attributes (and the daily weather) and only touch the
+sketches of those cells:
+            store = SketchStore.load("approximate_sketches.npz")
+            store.approx_distinct(group_by=['hood_id', 'year', 'month'])     estimate with 95% bounds per group
+            store.sample(10000, weather_contains="rain")                      uniform sample of the rainy-day crimes
+
+The standard error of a HyperLogLog estimate is 1.04 / sqrt(2 ** precision) (1.6% for the default precision 12);
+the bounds returned are +/- 1.96 standard errors.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "path": "approximate_sketches.npz",
+    "precision": 12,
+    "reservoir_size": 64,
+    "merge_existing": False,
+}
+
+CELL_COLUMNS = ['year', 'month', 'day', 'hood_id', 'crime_type']
+
+SOURCE_COLUMNS = ['event_id', 'year', 'month', 'day', 'hood_id', 'crime_type', 'weather']
+
+SOURCE_QUERY = f"SELECT {', '.join(SOURCE_COLUMNS)} FROM crime_weather_source_table"
+
+# Hash keys (16 bytes) of the two independent hashes of event_id: HyperLogLog and sample priority
+HLL_HASH_KEY = "hyperloglog00000"
+PRIORITY_HASH_KEY = "reservoir0000000"
+
+
+def hash_values(values, hash_key):
+    return pd.util.hash_array(np.asarray(values, dtype=object), hash_key=hash_key, categorize=False)
+
+
+def bit_length(values):
+    """A function which returns the number of significant bits of uint64 values, exactly and vectorized
+       (every 32-bit half converts to float64 without rounding).
+    """
+
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1]).astype(np.int64)
+
+
+def hll_registers(hashes, precision):
+    """A function which splits 64-bit hashes into the HyperLogLog register (first precision bits) and
+       rank (position of the first set bit of the remaining bits)."""
+
+    remaining_bits = 64 - precision
+    registers = (hashes >> np.uint64(remaining_bits)).astype(np.int64)
+    rest = hashes & np.uint64((1 << remaining_bits) - 1)
+    ranks = (remaining_bits - bit_length(rest) + 1).astype(np.uint8)
+    return registers, ranks
+
+
+def max_reduce(keys, ranks):
+    """A function which returns the unique keys and the maximum rank (uint8) of every key, with one sort of
+       the packed (key, rank) values."""
+
+    packed = np.sort(keys.astype(np.int64) * 256 + ranks)
+    keys = packed >> 8
+    last = np.append(keys[1:] != keys[:-1], True)
+    return keys[last], (packed[last] & 255).astype(np.uint8)
+
+
+def factorize_columns(df, columns):
+    """A function which returns the group code of every row of a DataFrame over several columns, and the
+       DataFrame of the distinct groups (one factorize per column instead of hashing row tuples)."""
+
+    codes, uniques = zip(*(pd.factorize(df[column]) for column in columns))
+    sizes = [max(len(values), 1) for values in uniques]
+    groups, group_index = np.unique(np.ravel_multi_index(codes, sizes), return_inverse=True)
+    keys = np.unravel_index(groups, sizes)
+    frame = pd.DataFrame({column: np.asarray(values)[key] for column, values, key in zip(columns, uniques, keys)})
+    return group_index.astype(np.int64), frame
+
+
+def hll_estimate(groups, registers, ranks, group_count, precision):
+    """A function which returns the HyperLogLog estimate of every group from its sparse (register, rank) entries
+       (one entry per set register), with the linear counting correction for small cardinalities.
+       Registers which are not set count as rank 0, so no dense register matrix is needed."""
+
+    m = 1 << precision
+    keys, ranks = max_reduce(groups * m + registers, ranks)
+    groups = keys >> precision
+    zeros = m - np.bincount(groups, minlength=group_count)
+    harmonic_sum = zeros + np.bincount(groups, np.exp2(-ranks.astype(np.float64)), group_count)
+
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / harmonic_sum
+    with np.errstate(divide="ignore"):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class SketchStore:
+    """
+    The class SketchStore holds the cells of the approximate-query subsystem (see the module description):
+    cells (DataFrame of the cell attributes, crime count and weather), the sparse HyperLogLog entries
+    (hll_cell, hll_register, hll_rank) and the reservoir samples (sample_cell, sample_priority, sample_event_id).
+    """
+
+    def __init__(self, cells, hll_cell, hll_register, hll_rank, sample_cell, sample_priority, sample_event_id,
+                 precision=DEFAULT_SETTINGS["precision"], reservoir_size=DEFAULT_SETTINGS["reservoir_size"]):
+        self.cells = cells.reset_index(drop=True)
+        self.hll_cell, self.hll_register, self.hll_rank = hll_cell, hll_register, hll_rank
+        self.sample_cell, self.sample_priority, self.sample_event_id = sample_cell, sample_priority, sample_event_id
+        self.precision = precision
+        self.reservoir_size = reservoir_size
+
+    @classmethod
+    def build(cls, df, precision=DEFAULT_SETTINGS["precision"], reservoir_size=DEFAULT_SETTINGS["reservoir_size"]):
+        """A function which builds the store from crime rows (event_id, year, month, day, hood_id, crime_type,
+           weather), vectorized."""
+
+        cell_index, cells = factorize_columns(df, CELL_COLUMNS)
+        cells['crimes'] = np.bincount(cell_index, minlength=len(cells))
+        cells['weather'] = df['weather'].groupby(cell_index).first().reindex(range(len(cells))).to_numpy()
+        event_ids = df['event_id'].to_numpy(dtype=object)
+
+        # HyperLogLog: keep the maximum rank of every (cell, register) pair
+        registers, ranks = hll_registers(hash_values(event_ids, HLL_HASH_KEY), precision)
+        keys, ranks = max_reduce(cell_index * (1 << precision) + registers, ranks)
+
+        # Reservoir: bottom-k priorities of every cell
+        priorities = hash_values(event_ids, PRIORITY_HASH_KEY).astype(np.float64) / 2.0 ** 64
+        sample = bottom_k(cell_index, priorities, reservoir_size)
+
+        return cls(cells, keys >> precision, (keys & ((1 << precision) - 1)).astype(np.uint16), ranks,
+                   cell_index[sample], priorities[sample], event_ids[sample].astype(str), precision, reservoir_size)
+
+    def merge(self, other):
+        """A function which returns the union of two stores (cells are matched on their attributes)."""
+
+        cells = pd.concat([self.cells, other.cells], ignore_index=True)
+        cell_index, merged = factorize_columns(cells, CELL_COLUMNS)
+        merged['crimes'] = np.bincount(cell_index, cells['crimes'], len(merged)).astype(np.int64)
+        merged['weather'] = cells['weather'].groupby(cell_index).first().reindex(range(len(merged))).to_numpy()
+
+        # re-key the cells of both stores to the merged cells
+        offset = len(self.cells)
+        remap_self, remap_other = cell_index[:offset], cell_index[offset:]
+
+        m = 1 << self.precision
+        keys = np.concatenate([remap_self[self.hll_cell] * m + self.hll_register,
+                               remap_other[other.hll_cell] * m + other.hll_register])
+        keys, ranks = max_reduce(keys, np.concatenate([self.hll_rank, other.hll_rank]))
+
+        sample_cell = np.concatenate([remap_self[self.sample_cell], remap_other[other.sample_cell]])
+        priorities = np.concatenate([self.sample_priority, other.sample_priority])
+        event_ids = np.concatenate([self.sample_event_id, other.sample_event_id])
+        # the same crime loaded twice keeps one sample entry
+        _, unique = np.unique(event_ids, return_index=True)
+        sample_cell, priorities, event_ids = sample_cell[unique], priorities[unique], event_ids[unique]
+        keep = bottom_k(sample_cell, priorities, self.reservoir_size)
+
+        return SketchStore(merged, keys >> self.precision, (keys & (m - 1)).astype(np.uint16), ranks,
+                           sample_cell[keep], priorities[keep], event_ids[keep], self.precision, self.reservoir_size)
+
+    def save(self, path):
+        np.savez(path, **{"cell_" + column: self.cells[column].to_numpy().astype(str if column in
+                          ('crime_type', 'weather') else np.int64) for column in self.cells.columns},
+                 hll_cell=self.hll_cell, hll_register=self.hll_register, hll_rank=self.hll_rank,
+                 sample_cell=self.sample_cell, sample_priority=self.sample_priority,
+                 sample_event_id=self.sample_event_id, settings=np.array([self.precision, self.reservoir_size]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            cells = pd.DataFrame({name[len("cell_"):]: data[name] for name in data.files if name.startswith("cell_")})
+            precision, reservoir_size = (int(value) for value in data["settings"])
+            return cls(cells, data["hll_cell"], data["hll_register"], data["hll_rank"], data["sample_cell"],
+                       data["sample_priority"], data["sample_event_id"], precision, reservoir_size)
+
+    def select_cells(self, weather_contains=None, **filters):
+        """A function which returns the boolean mask of the cells matching the filters: attribute=value or
+           attribute=[values] for the cell attributes, and a substring of the daily weather."""
+
+        mask = np.ones(len(self.cells), dtype=bool)
+        for column, value in filters.items():
+            values = value if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+            mask &= self.cells[column].isin(values).to_numpy()
+        if weather_contains is not None:
+            mask &= self.cells['weather'].astype(str).str.contains(weather_contains, regex=False).to_numpy()
+        return mask
+
+    def count(self, weather_contains=None, **filters):
+        """A function which returns the exact number of crimes of the selected cells."""
+
+        return int(self.cells['crimes'].to_numpy()[self.select_cells(weather_contains, **filters)].sum())
+
+    def approx_distinct(self, group_by=None, weather_contains=None, **filters):
+        """A function which returns the estimated number of distinct event_id of the selected cells (per group
+           of cell attributes when group_by is given) with the 95% bounds of the estimate."""
+
+        start = time.perf_counter()
+        mask = self.select_cells(weather_contains, **filters)
+        group_by = list(group_by or [])
+        if group_by:
+            group_of_cell, groups = factorize_columns(self.cells.loc[mask], group_by)
+        else:
+            group_of_cell, groups = np.zeros(int(mask.sum()), dtype=np.int64), pd.DataFrame(index=[0])
+        cell_group = np.full(len(self.cells), -1, dtype=np.int64)
+        cell_group[np.flatnonzero(mask)] = group_of_cell
+
+        # Union of the cells of every group: register-wise maximum of their sparse entries
+        entry_group = cell_group[self.hll_cell]
+        selected = entry_group >= 0
+        estimate = hll_estimate(entry_group[selected], self.hll_register[selected].astype(np.int64),
+                                self.hll_rank[selected], len(groups), self.precision)
+        m = 1 << self.precision
+        error = 1.04 / np.sqrt(m)
+        result = groups.copy()
+        result['estimate'] = np.round(estimate).astype(np.int64)
+        result['lower_95'] = np.floor(estimate * (1 - 1.96 * error)).astype(np.int64)
+        result['upper_95'] = np.ceil(estimate * (1 + 1.96 * error)).astype(np.int64)
+        result.attrs['standard_error'] = error
+        result.attrs['milliseconds'] = (time.perf_counter() - start) * 1000
+        return result
+
+    def sample(self, size, weather_contains=None, **filters):
+        """A function which returns a uniform random sample (without replacement) of the crimes of the selected
+           cells, as event_id with the cell attributes. Every crime whose priority is below the threshold is in
+           the store, so the sample is the crimes under the smallest threshold which is both the size-th priority
+           and safe for every truncated cell. Fewer rows than requested are returned when the reservoirs are too
+           small, and attrs['complete'] tells whether the threshold covers every crime of the selection."""
+
+        start = time.perf_counter()
+        mask = self.select_cells(weather_contains, **filters)
+        in_selection = mask[self.sample_cell]
+        cells, priorities = self.sample_cell[in_selection], self.sample_priority[in_selection]
+        event_ids = self.sample_event_id[in_selection]
+
+        # A truncated cell (more crimes than reservoir_size) only holds its crimes below its k-th priority
+        counts = np.bincount(cells, minlength=len(self.cells))
+        crimes = self.cells['crimes'].to_numpy()
+        truncated = mask & (crimes > counts) & (counts > 0)
+        safe_threshold = np.inf
+        if truncated.any():
+            kth = pd.Series(priorities).groupby(cells).max()
+            safe_threshold = kth.loc[np.flatnonzero(truncated)].min()
+
+        order = np.argsort(priorities, kind="stable")
+        threshold = priorities[order[size - 1]] if len(order) >= size else np.inf
+        threshold = min(threshold, safe_threshold)
+        chosen = order[priorities[order] <= threshold][:size]
+
+        result = self.cells.loc[cells[chosen], CELL_COLUMNS + ['weather']].reset_index(drop=True)
+        result.insert(0, 'event_id', event_ids[chosen])
+        result.attrs['requested'] = size
+        result.attrs['complete'] = not np.isfinite(safe_threshold)
+        result.attrs['population'] = int(crimes[mask].sum())
+        result.attrs['milliseconds'] = (time.perf_counter() - start) * 1000
+        return result
+
+
+def bottom_k(cell_index, priorities, k):
+    """A function which returns the positions of the k smallest priorities of every cell."""
+
+    order = np.lexsort((priorities, cell_index))
+    sorted_cells = cell_index[order]
+    first = np.searchsorted(sorted_cells, sorted_cells, side="left")
+    rank = np.arange(len(order)) - first
+    return order[rank < k]
+
+
+def maintain_sketches(db, df=None):
+    """A function which builds the SketchStore of the current crime_weather_source_table (called by
+       etl_fact_table() before the source columns are dropped), or of the crime_weather rows given in df
+       (the partition-parallel load, see parallel_etl.py), and merges it into the stored one.
+       It does nothing when the approximate_query section of config.json is disabled.
+    """
+
+    settings = load_section("approximate_query", DEFAULT_SETTINGS)
+    if not settings["enabled"]:
+        return None
+
+    start = time.perf_counter()
+    if df is None:
+        db.cur.execute(SOURCE_QUERY)
+        df = pd.DataFrame(db.cur.fetchall(), columns=[col[0] for col in db.cur.description])
+    else:
+        df = df[SOURCE_COLUMNS]
+    store = SketchStore.build(df, settings["precision"], settings["reservoir_size"])
+    # A full load replaces the store, incremental loads (see watch mode) merge into it
+    if settings["merge_existing"]:
+        try:
+            store = SketchStore.load(settings["path"]).merge(store)
+        except FileNotFoundError:
+            pass
+    store.save(settings["path"])
+    print(f"Approximate-query sketches: {len(store.cells)} cells, {len(store.hll_cell)} HyperLogLog entries, "
+          f"{len(store.sample_cell)} sampled crimes, built in {time.perf_counter() - start:.3f} seconds")
+    return store
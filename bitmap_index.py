@@ -0,0 +1,331 @@
+
+import json, time
+
+import numpy as np
+import pandas as pd
+
+from pipeline_config import load_section
+
+"""
+************************************  Bitmap index over fact_table:  ************************************
+BitmapIndex keeps, for every dimension attribute of fact_table (crime_type, hood_id, weather, year, month, ...),
+one compressed bitmap of fact rows per attribute value. Filters are evaluated with bitwise operations, without
+touching the database:
+            index = BitmapIndex.load("fact_bitmap_index.npz")
+            rows = index.eq("crime_type", "assault") & index.isin("hood_id", [1, 2, 3]) & index.eq("weather", "rain")
+            rows = rows & index.isin("month", [6, 7, 8]) - index.eq("year", 2020)
+            len(rows), rows.to_array(), index.keys_of(rows)
+
+The bitmaps are roaring-style: row ids are split by their high 16 bits into containers; a container holding at most
+4096 rows is a sorted uint16 array, a denser one is a 65536-bit bitmap (1024 uint64 words). AND/OR/ANDNOT work
+container by container, with np.intersect1d/np.union1d on array containers and word-wise operators on bitmaps.
+
+Fact rows are numbered in event_surrogate_key order. The index is persisted to one .npz file and extended
+incrementally after a load with the fact rows above its event_surrogate_key watermark. Enable it in config.json:
+            "bitmap_index": {"enabled": true, "path": "fact_bitmap_index.npz"}
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "path": "fact_bitmap_index.npz",
+}
+
+ARRAY_CONTAINER_LIMIT = 4096
+BITMAP_WORDS = 1024
+
+INDEXED_COLUMNS = ['year', 'month', 'crime_type', 'location_type', 'hood_id', 'weather']
+KEY_COLUMNS = ['event_surrogate_key', 'date_surrogate_key', 'climate_surrogate_key', 'neighbourhood_surrogate_key']
+
+FACT_ROWS_QUERY = """select f.event_surrogate_key, f.date_surrogate_key, f.climate_surrogate_key,
+                        f.neighbourhood_surrogate_key, d.year, d.month, e.crime_type, e.location_type,
+                        n.hood_id, c.weather
+                    from fact_table f
+                    join date_surrogate_table d on d.date_surrogate_key = f.date_surrogate_key
+                    join neighbourhood_surrogate_table n on n.neighbourhood_surrogate_key = f.neighbourhood_surrogate_key
+                    join crime_event_surrogate_table es on es.event_surrogate_key = f.event_surrogate_key
+                    join crime_event_dimension_table e on e.event_id = es.event_id
+                    join climate_surrogate_table cs on cs.climate_surrogate_key = f.climate_surrogate_key
+                    join climate_dimension_table c on c.climate_id = cs.climate_id and c.year = cs.year
+                        and c.month = cs.month and c.day = cs.day
+                    where f.event_surrogate_key > %s
+                    order by f.event_surrogate_key"""
+
+
+def encode_value(value):
+    """A function which writes an attribute value as JSON for the .npz file: numbers and text as they are,
+       timestamps tagged with their type (a null value has no bitmap and is never written).
+    """
+
+    if isinstance(value, pd.Timestamp):
+        return json.dumps({"timestamp": value.isoformat()})
+    if isinstance(value, np.generic):
+        value = value.item()
+    return json.dumps(value)
+
+
+def decode_value(text):
+    value = json.loads(text)
+    if isinstance(value, dict):
+        return pd.Timestamp(value["timestamp"])
+    return value
+
+
+def popcount(words):
+    return int(np.unpackbits(words.view(np.uint8)).sum())
+
+
+def array_to_bitmap(values):
+    words = np.zeros(BITMAP_WORDS, dtype=np.uint64)
+    values = values.astype(np.int64)
+    np.bitwise_or.at(words, values >> 6, np.left_shift(np.uint64(1), (values & 63).astype(np.uint64)))
+    return words
+
+
+def bitmap_to_array(words):
+    bits = np.unpackbits(words.view(np.uint8), bitorder="little")
+    return np.flatnonzero(bits).astype(np.uint16)
+
+
+def normalize_container(container):
+    """A function which returns the compact form of a container: an array when it holds at most
+       ARRAY_CONTAINER_LIMIT rows, a bitmap otherwise, or None when it is empty."""
+
+    if container.dtype == np.uint64:
+        count = popcount(container)
+        if count == 0:
+            return None
+        return bitmap_to_array(container) if count <= ARRAY_CONTAINER_LIMIT else container
+    if len(container) == 0:
+        return None
+    return array_to_bitmap(container) if len(container) > ARRAY_CONTAINER_LIMIT else container
+
+
+def container_operation(left, right, operation):
+    """A function which runs 'and', 'or' or 'andnot' on two containers."""
+
+    if left.dtype == np.uint16 and right.dtype == np.uint16:
+        if operation == "and":
+            return np.intersect1d(left, right, assume_unique=True)
+        if operation == "or":
+            return np.union1d(left, right)
+        return np.setdiff1d(left, right, assume_unique=True)
+
+    if operation == "and" and left.dtype == np.uint16:
+        # array AND bitmap: test the bits of the array values only
+        return left[(right[left >> 6] >> (left & 63).astype(np.uint64)) & np.uint64(1) == 1]
+    if operation == "and" and right.dtype == np.uint16:
+        return container_operation(right, left, "and")
+
+    left_words = left if left.dtype == np.uint64 else array_to_bitmap(left)
+    right_words = right if right.dtype == np.uint64 else array_to_bitmap(right)
+    if operation == "and":
+        return left_words & right_words
+    if operation == "or":
+        return left_words | right_words
+    return left_words & ~right_words
+
+
+class RoaringBitmap:
+    """
+    The class RoaringBitmap is a compressed set of row ids: sorted high 16-bit keys, each with an array or
+    bitmap container of the low 16 bits (see the module description). Supports &, |, - (and not), len().
+    """
+
+    def __init__(self, keys=None, containers=None):
+        self.keys = np.asarray(keys if keys is not None else [], dtype=np.int64)
+        self.containers = list(containers or [])
+
+    @classmethod
+    def from_sorted(cls, row_ids):
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        high = row_ids >> 16
+        keys, starts = np.unique(high, return_index=True)
+        ends = np.append(starts[1:], len(row_ids))
+        containers = [normalize_container((row_ids[start:end] & 0xFFFF).astype(np.uint16))
+                      for start, end in zip(starts, ends)]
+        return cls(keys, containers)
+
+    def append_sorted(self, row_ids):
+        """A function which adds row ids which are all greater than the current maximum row id."""
+
+        other = RoaringBitmap.from_sorted(row_ids)
+        if len(other.keys) and len(self.keys) and other.keys[0] == self.keys[-1]:
+            self.containers[-1] = normalize_container(container_operation(self.containers[-1], other.containers[0], "or"))
+            other.keys, other.containers = other.keys[1:], other.containers[1:]
+        self.keys = np.concatenate([self.keys, other.keys])
+        self.containers.extend(other.containers)
+
+    def __len__(self):
+        return sum(popcount(c) if c.dtype == np.uint64 else len(c) for c in self.containers)
+
+    def combine(self, other, operation):
+        result_keys, result_containers = [], []
+        other_positions = {key: position for position, key in enumerate(other.keys.tolist())}
+        self_positions = {key: position for position, key in enumerate(self.keys.tolist())}
+        if operation == "and":
+            keys = sorted(set(self_positions) & set(other_positions))
+        elif operation == "or":
+            keys = sorted(set(self_positions) | set(other_positions))
+        else:
+            keys = self.keys.tolist()
+
+        for key in keys:
+            left = self.containers[self_positions[key]] if key in self_positions else None
+            right = other.containers[other_positions[key]] if key in other_positions else None
+            if left is None or right is None:
+                container = left if right is None else (right if operation == "or" else None)
+            else:
+                container = normalize_container(container_operation(left, right, operation))
+            if container is not None:
+                result_keys.append(key)
+                result_containers.append(container)
+        return RoaringBitmap(result_keys, result_containers)
+
+    def __and__(self, other):
+        return self.combine(other, "and")
+
+    def __or__(self, other):
+        return self.combine(other, "or")
+
+    def __sub__(self, other):
+        return self.combine(other, "andnot")
+
+    def to_array(self):
+        parts = [(key << 16) + (bitmap_to_array(c) if c.dtype == np.uint64 else c).astype(np.int64)
+                 for key, c in zip(self.keys.tolist(), self.containers)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def size_in_bytes(self):
+        return self.keys.nbytes + sum(c.nbytes for c in self.containers)
+
+
+class BitmapIndex:
+    """
+    The class BitmapIndex holds one RoaringBitmap per (column, value) of INDEXED_COLUMNS over the fact rows,
+    and the fact keys of every row (KEY_COLUMNS) to turn row ids back into fact_table rows.
+    """
+
+    def __init__(self):
+        self.bitmaps = {column: {} for column in INDEXED_COLUMNS}
+        self.keys = {column: np.zeros(0, dtype=np.int32) for column in KEY_COLUMNS}
+        self.row_count = 0
+
+    @property
+    def watermark(self):
+        return int(self.keys['event_surrogate_key'][-1]) if self.row_count else 0
+
+    def extend(self, df):
+        """A function which appends fact rows (ordered by event_surrogate_key, above the watermark)."""
+
+        row_ids = np.arange(self.row_count, self.row_count + len(df), dtype=np.int64)
+        for column in INDEXED_COLUMNS:
+            # the nulls get the code -1 and are left out of every bitmap (and of the values)
+            codes, values = pd.factorize(df[column])
+            # a stable sort groups the row ids by value and keeps every group sorted
+            order = np.argsort(codes, kind="stable")
+            starts = np.searchsorted(codes[order], np.arange(len(values)))
+            ends = np.append(starts[1:], len(order))
+            for value, start, end in zip(values.tolist(), starts, ends):
+                rows = row_ids[order[start:end]]
+                if value in self.bitmaps[column]:
+                    self.bitmaps[column][value].append_sorted(rows)
+                else:
+                    self.bitmaps[column][value] = RoaringBitmap.from_sorted(rows)
+        for column in KEY_COLUMNS:
+            self.keys[column] = np.concatenate([self.keys[column], df[column].to_numpy(dtype=np.int32)])
+        self.row_count += len(df)
+
+    def all_rows(self):
+        return RoaringBitmap.from_sorted(np.arange(self.row_count))
+
+    def eq(self, column, value):
+        return self.bitmaps[column].get(value, RoaringBitmap())
+
+    def isin(self, column, values):
+        result = RoaringBitmap()
+        for value in values:
+            result = result | self.eq(column, value)
+        return result
+
+    def invert(self, bitmap):
+        return self.all_rows() - bitmap
+
+    def keys_of(self, bitmap):
+        """A function which returns the fact keys of the rows of a bitmap as a DataFrame."""
+
+        rows = bitmap.to_array()
+        return pd.DataFrame({column: self.keys[column][rows] for column in KEY_COLUMNS})
+
+    def size_in_bytes(self):
+        return sum(bitmap.size_in_bytes() for values in self.bitmaps.values() for bitmap in values.values())
+
+    def save(self, path):
+        """A function which writes the index to one .npz file: for every bitmap its column, value (as JSON, see
+           encode_value()), keys and containers (concatenated, with their kinds and offsets)."""
+
+        entries, keys, kinds, offsets, data = [], [], [], [0], []
+        for column, values in self.bitmaps.items():
+            for value, bitmap in values.items():
+                entries.append((column, encode_value(value), len(bitmap.keys)))
+                keys.append(bitmap.keys)
+                for container in bitmap.containers:
+                    kinds.append(container.dtype == np.uint64)
+                    data.append(container.view(np.uint8))
+                    offsets.append(offsets[-1] + container.nbytes)
+        np.savez(path, entry_column=np.array([e[0] for e in entries]), entry_value=np.array([e[1] for e in entries]),
+                 entry_key_count=np.array([e[2] for e in entries], dtype=np.int64),
+                 container_keys=np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64),
+                 container_is_bitmap=np.array(kinds, dtype=bool), container_offsets=np.array(offsets, dtype=np.int64),
+                 container_data=np.concatenate(data) if data else np.zeros(0, dtype=np.uint8),
+                 **{"key_" + column: values for column, values in self.keys.items()})
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            container_keys, is_bitmap = data["container_keys"], data["container_is_bitmap"]
+            offsets, raw = data["container_offsets"], data["container_data"]
+            position = 0
+            for column, value, key_count in zip(data["entry_column"], data["entry_value"], data["entry_key_count"]):
+                containers = []
+                for container in range(position, position + key_count):
+                    chunk = raw[offsets[container]:offsets[container + 1]]
+                    containers.append(chunk.view(np.uint64 if is_bitmap[container] else np.uint16).copy())
+                index.bitmaps[str(column)][decode_value(str(value))] = RoaringBitmap(
+                    container_keys[position:position + key_count], containers)
+                position += key_count
+            for column in KEY_COLUMNS:
+                index.keys[column] = data["key_" + column]
+        index.row_count = len(index.keys['event_surrogate_key'])
+        return index
+
+
+def refresh_bitmap_index(db, rebuild=False):
+    """A function which updates the bitmap index configured in config.json after a load: the fact rows above
+       the watermark of the stored index are appended (every row when rebuild is True, e.g. after a full load
+       which renumbers the surrogate keys). It does nothing when the bitmap index is disabled.
+    """
+
+    settings = load_section("bitmap_index", DEFAULT_SETTINGS)
+    if not settings["enabled"]:
+        return None
+
+    start = time.perf_counter()
+    index = BitmapIndex()
+    if not rebuild:
+        try:
+            index = BitmapIndex.load(settings["path"])
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            # an index written with the repr() values of an older version is rebuilt
+            index = BitmapIndex()
+
+    db.cur.execute(FACT_ROWS_QUERY, (index.watermark,))
+    df = pd.DataFrame(db.cur.fetchall(), columns=[col[0] for col in db.cur.description])
+    index.extend(df)
+    index.save(settings["path"])
+    print(f"Bitmap index: {len(df)} fact rows added, {index.row_count} rows, "
+          f"{index.size_in_bytes() / 1e6:.2f} MB of bitmaps, in {time.perf_counter() - start:.3f} seconds")
+    return index
@@ -0,0 +1,178 @@
+
+import numpy as np
+import pandas as pd
+
+"""
+************************************  Temperature band and weather condition dimensions:  ************************************
+Analytic queries bucket temperature_mean into ranges and filter the weather text with LIKE '%rain%'. transform_weather_data()
+precomputes both as small integer codes carried by climate_dimension_table and fact_table:
+    - temperature_band_key (smallint): the TEMPERATURE_BANDS band of the daily mean temperature, described by
+      temperature_band_dimension_table,
+    - weather_condition_mask (smallint): one bit per WEATHER_CONDITIONS condition found in the daily weather (a day
+      can have rain and fog), described by weather_condition_set_table (one row per mask), and
+      weather_condition_bridge_table which links every mask to its conditions in weather_condition_dimension_table.
+
+Grouping or filtering by band or condition is then an equality on a small integer:
+            select b.band_label, count(*) from fact_table f
+            join temperature_band_dimension_table b using (temperature_band_key) group by b.band_label
+            select count(*) from fact_table f
+            join weather_condition_bridge_table c using (weather_condition_mask) where c.weather_condition_key = 1
+or a bit test (weather_condition_mask & 1 <> 0). The set and bridge tables hold every possible mask, so an
+incremental load never meets an unknown one. temperature_band_sql() and weather_condition_mask_sql() give the same
+codes in SQL, for the loads which stay in the database (see watch_mode.py). The daily mean temperature is rounded
+half up on both paths (round_temperatures() and round_temperature_sql()): pandas rounds half to even and PostgreSQL
+round() half away from zero, so -0.5 or 2.5 would otherwise get another value and band in an incremental load.
+"""
+
+
+# Upper bounds (exclusive, degrees Celsius) of the temperature bands, the last band has no upper bound
+TEMPERATURE_BAND_EDGES = [-20, -10, 0, 10, 20, 30]
+
+# (condition name, keywords found in the lower case weather text), the bit of a condition is its position
+WEATHER_CONDITIONS = [
+    ("rain", ("rain",)),
+    ("drizzle", ("drizzle",)),
+    ("snow", ("snow", "ice pellets")),
+    ("thunderstorm", ("thunderstorm",)),
+    ("fog", ("fog",)),
+    ("haze", ("haze", "smoke")),
+    ("freezing", ("freezing",)),
+    ("cloudy", ("cloudy",)),
+    ("clear", ("clear",)),
+]
+
+
+def band_label(band_key):
+    lower = TEMPERATURE_BAND_EDGES[band_key - 2] if band_key > 1 else None
+    upper = TEMPERATURE_BAND_EDGES[band_key - 1] if band_key <= len(TEMPERATURE_BAND_EDGES) else None
+    if lower is None:
+        return f"below {upper}"
+    if upper is None:
+        return f"{lower} and above"
+    return f"{lower} to {upper}"
+
+
+def temperature_band_table():
+    """A function which returns the temperature_band_dimension_table dataframe (keys 1 to len(edges) + 1)."""
+
+    band_keys = range(1, len(TEMPERATURE_BAND_EDGES) + 2)
+    return pd.DataFrame({
+        'temperature_band_key': np.array(band_keys, dtype=np.int16),
+        'band_label': [band_label(band_key) for band_key in band_keys],
+        'lower_bound': pd.array([None] + TEMPERATURE_BAND_EDGES, dtype="Int16"),
+        'upper_bound': pd.array(TEMPERATURE_BAND_EDGES + [None], dtype="Int16"),
+    })
+
+
+def round_temperatures(temperatures):
+    """A function which rounds temperatures half up to whole degrees (vectorized), like round_temperature_sql()."""
+
+    return np.floor(pd.to_numeric(pd.Series(temperatures), errors="coerce") + 0.5)
+
+
+def temperature_band_keys(temperatures):
+    """A function which returns the temperature band key of every temperature (vectorized, null for null)."""
+
+    temperatures = pd.to_numeric(pd.Series(temperatures), errors="coerce")
+    keys = pd.array(np.searchsorted(TEMPERATURE_BAND_EDGES, temperatures.fillna(0).to_numpy(), side="right") + 1,
+                    dtype="Int16")
+    keys[temperatures.isna().to_numpy()] = pd.NA
+    return keys
+
+
+def condition_mask(weather):
+    """A function which returns the condition bitmask of one lower case weather text."""
+
+    mask = 0
+    for bit, (_, keywords) in enumerate(WEATHER_CONDITIONS):
+        if any(keyword in weather for keyword in keywords):
+            mask |= 1 << bit
+    return mask
+
+
+def weather_condition_masks(weather):
+    """A function which returns the condition bitmask of every weather text: the distinct texts are parsed once
+       and the masks expanded back with one take (a null weather has no condition).
+    """
+
+    codes, uniques = pd.factorize(pd.Series(weather).astype("string").str.lower())
+    unique_masks = np.array([condition_mask(text) for text in uniques], dtype=np.int16)
+    return np.where(codes >= 0, unique_masks[np.maximum(codes, 0)] if len(unique_masks) else 0, 0).astype(np.int16)
+
+
+def weather_condition_tables():
+    """A function which returns the weather_condition_dimension_table, weather_condition_set_table and
+       weather_condition_bridge_table dataframes, with every possible mask.
+    """
+
+    df_conditions = pd.DataFrame({
+        'weather_condition_key': np.arange(1, len(WEATHER_CONDITIONS) + 1, dtype=np.int16),
+        'condition_name': [name for name, _ in WEATHER_CONDITIONS],
+        'condition_bit': np.array([1 << bit for bit in range(len(WEATHER_CONDITIONS))], dtype=np.int16),
+    })
+
+    masks = np.arange(2 ** len(WEATHER_CONDITIONS), dtype=np.int16)
+    # (mask, bit) pairs of the bits set in every mask
+    bits = (masks[:, None] >> np.arange(len(WEATHER_CONDITIONS), dtype=np.int16)[None, :]) & 1
+    mask_index, condition_index = np.nonzero(bits)
+    df_bridge = pd.DataFrame({'weather_condition_mask': masks[mask_index],
+                              'weather_condition_key': df_conditions['weather_condition_key'].to_numpy()[condition_index]})
+
+    names = df_conditions['condition_name'].to_numpy()
+    labels = pd.Series(names[condition_index]).groupby(mask_index).agg(",".join)
+    df_sets = pd.DataFrame({'weather_condition_mask': masks,
+                            'conditions': labels.reindex(range(len(masks))).fillna("none").to_numpy(),
+                            'condition_count': bits.sum(axis=1).astype(np.int16)})
+    return df_conditions, df_sets, df_bridge
+
+
+def round_temperature_sql(column):
+    """A function which returns the SQL expression rounding a temperature column half up, like round_temperatures()."""
+
+    return f"floor({column} + 0.5)"
+
+
+def temperature_band_sql(column):
+    """A function which returns the SQL expression of the temperature band key of a temperature column."""
+
+    cases = " ".join(f"WHEN {column} < {edge} THEN {band_key}"
+                     for band_key, edge in enumerate(TEMPERATURE_BAND_EDGES, start=1))
+    return f"(CASE WHEN {column} IS NULL THEN NULL {cases} ELSE {len(TEMPERATURE_BAND_EDGES) + 1} END)::smallint"
+
+
+def weather_condition_mask_sql(column):
+    """A function which returns the SQL expression of the condition bitmask of a weather column."""
+
+    terms = []
+    for bit, (_, keywords) in enumerate(WEATHER_CONDITIONS):
+        test = " OR ".join(f"lower({column}) LIKE '%{keyword}%'" for keyword in keywords)
+        terms.append(f"(CASE WHEN {test} THEN {1 << bit} ELSE 0 END)")
+    return f"({' | '.join(terms)})::smallint"
+
+
+def load_climate_band_tables(db):
+    """A function which creates the temperature band and weather condition tables (replaced at every full load)."""
+
+    from sqlalchemy.types import SmallInteger, Text
+
+    df_bands = temperature_band_table()
+    df_conditions, df_sets, df_bridge = weather_condition_tables()
+
+    db.cur.execute("DROP TABLE IF EXISTS weather_condition_bridge_table, weather_condition_set_table, "
+                   "weather_condition_dimension_table, temperature_band_dimension_table CASCADE")
+    db.raw_conn.commit()
+    for df, table_name in [(df_bands, "temperature_band_dimension_table"),
+                           (df_conditions, "weather_condition_dimension_table"),
+                           (df_sets, "weather_condition_set_table"), (df_bridge, "weather_condition_bridge_table")]:
+        dtypes = {column: Text() if df[column].dtype == object else SmallInteger() for column in df.columns}
+        df.to_sql(table_name, con=db.engine, if_exists="replace", index=False, dtype=dtypes)
+
+    db.cur.execute("ALTER TABLE temperature_band_dimension_table ADD PRIMARY KEY(temperature_band_key);")
+    db.cur.execute("ALTER TABLE weather_condition_dimension_table ADD PRIMARY KEY(weather_condition_key);")
+    db.cur.execute("ALTER TABLE weather_condition_set_table ADD PRIMARY KEY(weather_condition_mask);")
+    db.cur.execute("ALTER TABLE weather_condition_bridge_table ADD PRIMARY KEY(weather_condition_key,weather_condition_mask);")
+    db.cur.execute(
+        "ALTER TABLE weather_condition_bridge_table ADD CONSTRAINT weather_condition_set_foreign_key FOREIGN KEY (weather_condition_mask) REFERENCES weather_condition_set_table(weather_condition_mask);")
+    db.cur.execute(
+        "ALTER TABLE weather_condition_bridge_table ADD CONSTRAINT weather_condition_foreign_key FOREIGN KEY (weather_condition_key) REFERENCES weather_condition_dimension_table(weather_condition_key);")
+    db.raw_conn.commit()
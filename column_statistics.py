@@ -0,0 +1,219 @@
+
+import json, time
+
+import numpy as np
+import pandas as pd
+
+from pipeline_config import load_section
+
+"""
+************************************  Column statistics catalog:  ************************************
+When the "column_statistics" section of config.json is enabled, etl_source_data() profiles every column of the crime
+CSV and of the weather CSVs when they are read, and of the crime_source_table / weather_source_table frames before
+they are loaded:
+            "column_statistics": {"enabled": true}
+
+A profile holds: the dtype, the number of rows and nulls (null rate), the number of distinct values, min, max and
+mean, the top 5 values with their counts (columns with at most TOP_VALUES_MAX_DISTINCT distinct values), the
+memory used and the suggested dtype. Every profile is computed with one vectorized call per statistic over the
+whole frame (isna().sum(), nunique(), min(), max(), mean()), and appended to column_statistics_table with the
+run_id of the pipeline run.
+
+The profiles are used:
+    - by the loaders: compact_dtypes() downcasts the integer and float columns to the suggested dtype before
+      to_sql(), so PostgreSQL gets smallint / integer / real columns instead of bigint / double precision (floats
+      only when they have at most SHORT_FLOAT_DECIMALS decimals, so coordinates keep their precision),
+    - by finalize_load(): build_suggested_indexes() creates a B-tree index on the warehouse columns of
+      INDEX_CANDIDATES whose profile is selective enough (enough distinct values, few nulls).
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "compact_dtypes": True,
+    "index_min_distinct": 16,
+    "index_max_null_rate": 0.5,
+}
+
+STATISTICS_TABLE = "column_statistics_table"
+
+TOP_VALUES_MAX_DISTINCT = 1000
+
+# Decimals of the float columns stored as float32 (temperatures have one)
+SHORT_FLOAT_DECIMALS = 2
+
+# Share of distinct values under which a text column is suggested as a category
+CATEGORY_MAX_DISTINCT_RATIO = 0.5
+
+# Warehouse column indexed when selective enough: (table, column) -> (profiled source, profiled column)
+INDEX_CANDIDATES = {
+    ("crime_event_dimension_table", "crime_type"): ("crime_source_table", "crime_type"),
+    ("crime_event_dimension_table", "location_type"): ("crime_source_table", "location_type"),
+    ("neighbourhood_surrogate_table", "hood_id"): ("crime_source_table", "hood_id"),
+    ("date_dimension_table", "day_of_year"): ("crime_source_table", "day_of_year"),
+    ("neighbourhood_dimension_table", "neighbourhood_name"): ("crime_source_table", "neighbourhood_name"),
+    ("climate_dimension_table", "weather"): ("weather_source_table", "weather"),
+    ("climate_dimension_table", "temperature_mean"): ("weather_source_table", "temperature_mean"),
+}
+
+INTEGER_DTYPES = [(np.int8, "int8"), (np.int16, "int16"), (np.int32, "int32"), (np.int64, "int64")]
+
+# The run id of the current pipeline run, shared by every profile
+_run_id = None
+
+
+def get_run_id():
+    global _run_id
+    if _run_id is None:
+        _run_id = time.strftime("%Y%m%d_%H%M%S")
+    return _run_id
+
+
+def column_statistics_settings():
+    """A function which returns the column_statistics settings of config.json, or None when disabled."""
+
+    settings = load_section("column_statistics", DEFAULT_SETTINGS)
+    return settings if settings["enabled"] else None
+
+
+def suggest_dtype(dtype, rows, distinct, nulls, minimum, maximum, integral, short):
+    """A function which returns the most compact dtype able to hold a column with these statistics."""
+
+    if pd.api.types.is_bool_dtype(dtype):
+        return "bool"
+    if pd.api.types.is_numeric_dtype(dtype):
+        if rows == nulls:
+            return str(dtype)
+        if integral:
+            for integer_type, name in INTEGER_DTYPES:
+                information = np.iinfo(integer_type)
+                if information.min <= minimum and maximum <= information.max:
+                    # integer columns with nulls need the nullable integer dtype
+                    return name.capitalize() if nulls else name
+        return "float32" if short and pd.api.types.is_float_dtype(dtype) else str(dtype)
+    if rows > nulls and distinct <= CATEGORY_MAX_DISTINCT_RATIO * (rows - nulls):
+        return "category"
+    return str(dtype)
+
+
+def profile_frame(df, source):
+    """A function which returns the profile of every column of the dataframe (one row per column)."""
+
+    rows = len(df)
+    nulls = df.isna().sum()
+    distinct = df.nunique(dropna=True)
+    memory = df.memory_usage(deep=True, index=False)
+    numeric = df.select_dtypes(include="number")
+    # integral: every value of the numeric column is a whole number, short: it has at most SHORT_FLOAT_DECIMALS
+    # decimals, so float32 keeps it exactly once rounded
+    filled = numeric.fillna(0).astype(np.float64)
+    integral = (filled % 1 == 0).all()
+    short = pd.Series(np.isclose(filled.round(SHORT_FLOAT_DECIMALS), filled, rtol=0, atol=1e-9).all(axis=0),
+                      index=numeric.columns)
+
+    profiles = []
+    for column in df.columns:
+        values = df[column]
+        minimum = maximum = mean = None
+        if column in numeric.columns:
+            minimum, maximum, mean = values.min(), values.max(), values.mean()
+        elif nulls[column] < rows:
+            try:
+                minimum, maximum = values.min(), values.max()
+            except TypeError:
+                # mixed types cannot be ordered
+                pass
+        top_values = None
+        if distinct[column] <= TOP_VALUES_MAX_DISTINCT:
+            top_values = json.dumps({str(value): int(count) for value, count in values.value_counts().head(5).items()})
+        profiles.append({
+            "run_id": get_run_id(), "source": source, "column_name": column, "dtype": str(values.dtype),
+            "row_count": rows, "null_count": int(nulls[column]),
+            "null_rate": float(nulls[column] / rows) if rows else 0.0, "distinct_count": int(distinct[column]),
+            "min_value": None if minimum is None or pd.isna(minimum) else str(minimum),
+            "max_value": None if maximum is None or pd.isna(maximum) else str(maximum),
+            "mean_value": None if mean is None or pd.isna(mean) else float(mean),
+            "top_values": top_values, "memory_bytes": int(memory[column]),
+            "suggested_dtype": suggest_dtype(values.dtype, rows, distinct[column], nulls[column], minimum, maximum,
+                                             bool(integral.get(column, False)), bool(short.get(column, False))),
+        })
+    return pd.DataFrame(profiles)
+
+
+def record_profile(db, df, source):
+    """A function which profiles a dataframe and appends its profile to column_statistics_table.
+       Returns the profile, or None when the column statistics are disabled.
+    """
+
+    if column_statistics_settings() is None:
+        return None
+    start = time.perf_counter()
+    profile = profile_frame(df, source)
+    profile.to_sql(STATISTICS_TABLE, con=db.engine, if_exists="append", index=False)
+    print(f"Column statistics of {source}: {len(profile)} columns profiled in {time.perf_counter() - start:.3f} seconds")
+    return profile
+
+
+def compact_dtypes(df, profile):
+    """A function which downcasts the integer and float columns of a dataframe to the dtype suggested by its
+       profile (text columns are left as they are: to_sql() writes a category as text anyway).
+    """
+
+    settings = column_statistics_settings()
+    if profile is None or settings is None or not settings["compact_dtypes"]:
+        return df
+    dtypes = {}
+    for row in profile.itertuples():
+        if row.column_name in df.columns and row.suggested_dtype != row.dtype and \
+                row.suggested_dtype.lower().startswith(("int", "float")):
+            dtypes[row.column_name] = row.suggested_dtype
+    return df.astype(dtypes)
+
+
+def latest_profiles(db):
+    """A function which reads the profiles of the latest run from column_statistics_table."""
+
+    db.cur.execute(f"SELECT to_regclass('{STATISTICS_TABLE}') IS NOT NULL")
+    if not db.cur.fetchone()[0]:
+        return pd.DataFrame()
+    db.cur.execute(f"SELECT * FROM {STATISTICS_TABLE} WHERE run_id = (SELECT max(run_id) FROM {STATISTICS_TABLE})")
+    return pd.DataFrame(db.cur.fetchall(), columns=[col[0] for col in db.cur.description])
+
+
+def suggested_indexes(profiles, settings):
+    """A function which returns the (table, column, reason) of the INDEX_CANDIDATES worth a B-tree index."""
+
+    suggestions = []
+    for (table_name, column), (source, source_column) in INDEX_CANDIDATES.items():
+        rows = profiles[(profiles.source == source) & (profiles.column_name == source_column)]
+        if rows.empty:
+            continue
+        profile = rows.iloc[0]
+        if profile.distinct_count >= settings["index_min_distinct"] and \
+                profile.null_rate <= settings["index_max_null_rate"]:
+            suggestions.append((table_name, column, f"{profile.distinct_count} distinct values, "
+                                                    f"{profile.null_rate:.1%} nulls"))
+    return suggestions
+
+
+def build_suggested_indexes(db):
+    """A function which creates the indexes suggested by the profiles of the latest run (finalize step) and
+       returns the ones created. A suggestion which can not be built is reported and skipped. It does nothing
+       when the column statistics are disabled.
+    """
+
+    settings = column_statistics_settings()
+    if settings is None:
+        return []
+    created = []
+    for table_name, column, reason in suggested_indexes(latest_profiles(db), settings):
+        try:
+            db.cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_{column}_index ON {table_name} ({column})")
+            db.raw_conn.commit()
+        except Exception as e:
+            db.raw_conn.rollback()
+            print(f"Index on {table_name}({column}) skipped: {e}")
+            continue
+        print(f"Index on {table_name}({column}): {reason}")
+        created.append((table_name, column, reason))
+    return created
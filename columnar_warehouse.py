@@ -0,0 +1,302 @@
+
+import json, time
+
+import numpy as np
+import pandas as pd
+
+"""
+************************************  Columnar in-memory star schema:  ************************************
+ColumnarWarehouse keeps the finished warehouse in memory for DB-free serving:
+    - fact_table as typed NumPy columns (int32 surrogate keys and counts, float32 temperatures),
+    - every dimension (date, event, climate, neighbourhood) joined to its surrogate table and indexed by its surrogate
+      key: numeric attributes as compact arrays, text attributes dictionary encoded (int32 codes + dictionary), with
+      a direct-address key -> row array for O(1) lookups and __slots__ row views.
+
+            warehouse = ColumnarWarehouse.from_database()
+            warehouse.save("warehouse.cstar")
+            warehouse = ColumnarWarehouse.load("warehouse.cstar")     memory-mapped, shared by every worker process
+            warehouse.dimension("event").row(42).crime_type
+            mask = warehouse.mask(event__crime_type="assault", date__year=[2019, 2020], temperature_mean=(20, None))
+            warehouse.group_by(["neighbourhood.hood_id", "climate.weather"], mask)
+
+The file holds a JSON header describing every array followed by the raw arrays, 64-byte aligned, so load() maps every
+array with np.memmap (read-only): pages are shared through the OS page cache and nothing is copied.
+"""
+
+
+FILE_MAGIC = b"CSTAR001"
+ALIGNMENT = 64
+
+FACT_QUERY = """select date_surrogate_key, event_surrogate_key, climate_surrogate_key, neighbourhood_surrogate_key,
+                    crime_number, temperature_mean, temperature_min, temperature_max from fact_table"""
+
+# name: (surrogate key, query joining the surrogate table to the dimension table)
+DIMENSION_QUERIES = {
+    "date": ("date_surrogate_key", """select s.date_surrogate_key, d.year, d.month, d.day, d.day_of_year, d.day_of_week
+                                        from date_surrogate_table s join date_dimension_table d using (year, month, day)"""),
+    "event": ("event_surrogate_key", """select s.event_surrogate_key, d.event_id, d.crime_type, d.location_type
+                                        from crime_event_surrogate_table s join crime_event_dimension_table d using (event_id)"""),
+    "climate": ("climate_surrogate_key", """select s.climate_surrogate_key, d.climate_id, d.temperature_mean,
+                                        d.temperature_min, d.temperature_max, d.weather
+                                        from climate_surrogate_table s
+                                        join climate_dimension_table d using (climate_id, year, month, day)"""),
+    "neighbourhood": ("neighbourhood_surrogate_key", """select s.neighbourhood_surrogate_key, d.hood_id, d.neighbourhood_name
+                                        from neighbourhood_surrogate_table s
+                                        join neighbourhood_dimension_table d using (hood_id, valid_from)"""),
+}
+
+
+def compact_array(values):
+    """A function which returns the compact typed array of a numeric column: int32 or float32."""
+
+    values = np.asarray(values)
+    if values.dtype.kind in "iub":
+        return values.astype(np.int32)
+    return values.astype(np.float32)
+
+
+class Dimension:
+    """
+    The class Dimension holds one dimension indexed by its surrogate key: numeric columns as arrays, text
+    columns as (codes, dictionary), and the direct-address array position_of_key (-1 for unknown keys).
+    """
+
+    def __init__(self, name, key, numeric, encoded, position_of_key):
+        self.name = name
+        self.key = key
+        self.numeric = numeric
+        self.encoded = encoded
+        self.position_of_key = position_of_key
+        self.columns = [key] + [column for column in list(numeric) + list(encoded) if column != key]
+        self.row_type = type(f"{name.title()}Row", (object,), {"__slots__": tuple(self.columns)})
+
+    @classmethod
+    def from_frame(cls, name, key, df):
+        numeric, encoded = {}, {}
+        for column in df.columns:
+            if df[column].dtype == object or pd.api.types.is_string_dtype(df[column]):
+                codes, dictionary = pd.factorize(df[column].astype(str), sort=True)
+                encoded[column] = (codes.astype(np.int32), np.asarray(dictionary, dtype=str))
+            else:
+                numeric[column] = compact_array(df[column])
+        keys = numeric[key]
+        position_of_key = np.full(int(keys.max()) + 1 if len(keys) else 1, -1, dtype=np.int32)
+        position_of_key[keys] = np.arange(len(keys), dtype=np.int32)
+        return cls(name, key, numeric, encoded, position_of_key)
+
+    def __len__(self):
+        return len(self.numeric[self.key])
+
+    def positions(self, keys):
+        """A function which returns the row positions of surrogate keys (vectorized, -1 when unknown)."""
+
+        keys = np.asarray(keys, dtype=np.int64)
+        inside = (keys >= 0) & (keys < len(self.position_of_key))
+        return np.where(inside, self.position_of_key[np.where(inside, keys, 0)], -1)
+
+    def row(self, key):
+        """A function which returns the __slots__ row view of one surrogate key (None when unknown)."""
+
+        position = int(self.positions([key])[0])
+        if position < 0:
+            return None
+        row = self.row_type()
+        for column, values in self.numeric.items():
+            setattr(row, column, values[position].item())
+        for column, (codes, dictionary) in self.encoded.items():
+            setattr(row, column, str(dictionary[codes[position]]))
+        return row
+
+    def column_values(self, column):
+        """A function which returns the decoded values of a column (dictionary columns are decoded)."""
+
+        if column in self.numeric:
+            return self.numeric[column]
+        codes, dictionary = self.encoded[column]
+        return dictionary[codes]
+
+    def predicate(self, column, condition):
+        """A function which evaluates a condition on the rows of the dimension: a value, a list of values or a
+           (low, high) range (None for an open bound). Text conditions are evaluated on the dictionary only."""
+
+        if column in self.encoded:
+            codes, dictionary = self.encoded[column]
+            values = condition if isinstance(condition, (list, set)) else [condition]
+            matching = np.isin(dictionary, [str(value) for value in values])
+            return matching[codes]
+        return evaluate_condition(self.numeric[column], condition)
+
+
+def evaluate_condition(values, condition):
+    if isinstance(condition, tuple):
+        low, high = condition
+        mask = np.ones(len(values), dtype=bool)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask
+    if isinstance(condition, (list, set)):
+        return np.isin(values, list(condition))
+    return values == condition
+
+
+class ColumnarWarehouse:
+    """
+    The class ColumnarWarehouse holds the fact columns and the Dimension objects of the star schema
+    (see the module description).
+    """
+
+    def __init__(self, fact, dimensions):
+        self.fact = fact
+        self.dimensions = dimensions
+        self.fact_positions = {}
+
+    @classmethod
+    def from_database(cls, db=None):
+        if db is None:
+            from A02_Team_V04 import DbConnection
+            with DbConnection() as db:
+                return cls.from_database(db)
+
+        start = time.perf_counter()
+
+        def read(query):
+            db.cur.execute(query)
+            return pd.DataFrame(db.cur.fetchall(), columns=[col[0] for col in db.cur.description])
+
+        df_fact = read(FACT_QUERY)
+        fact = {column: compact_array(df_fact[column]) for column in df_fact.columns}
+        dimensions = {name: Dimension.from_frame(name, key, read(query))
+                      for name, (key, query) in DIMENSION_QUERIES.items()}
+        print(f"Columnar warehouse: {len(df_fact)} fact rows loaded in {time.perf_counter() - start:.3f} seconds")
+        return cls(fact, dimensions)
+
+    def __len__(self):
+        return len(next(iter(self.fact.values())))
+
+    def dimension(self, name):
+        return self.dimensions[name]
+
+    def positions(self, name):
+        """A function which returns (and caches) the dimension row position of every fact row."""
+
+        if name not in self.fact_positions:
+            dimension = self.dimensions[name]
+            self.fact_positions[name] = dimension.positions(self.fact[dimension.key])
+        return self.fact_positions[name]
+
+    def mask(self, **conditions):
+        """A function which returns the boolean mask of the fact rows matching every condition. Conditions on a
+           dimension attribute are written dimension__column, conditions on fact columns use the column name."""
+
+        mask = np.ones(len(self), dtype=bool)
+        for name, condition in conditions.items():
+            if "__" in name:
+                dimension_name, column = name.split("__", 1)
+                matching = self.dimensions[dimension_name].predicate(column, condition)
+                positions = self.positions(dimension_name)
+                mask &= (positions >= 0) & matching[np.maximum(positions, 0)]
+            else:
+                mask &= evaluate_condition(self.fact[name], condition)
+        return mask
+
+    def attribute_codes(self, attribute):
+        """A function which returns integer codes of an attribute ("dimension.column" or a fact column) for every
+           fact row, with the function decoding them."""
+
+        if "." not in attribute:
+            codes, uniques = pd.factorize(self.fact[attribute], sort=True)
+            return codes, lambda group_codes: np.asarray(uniques)[group_codes]
+
+        dimension_name, column = attribute.split(".", 1)
+        dimension = self.dimensions[dimension_name]
+        positions = np.maximum(self.positions(dimension_name), 0)
+        if column in dimension.encoded:
+            codes, dictionary = dimension.encoded[column]
+            return codes[positions], lambda group_codes: dictionary[group_codes]
+        codes, uniques = pd.factorize(dimension.numeric[column][positions], sort=True)
+        return codes, lambda group_codes: np.asarray(uniques)[group_codes]
+
+    def group_by(self, attributes, mask=None, measures=("temperature_mean",)):
+        """A function which returns the number of fact rows and the mean of the measures per group of attributes,
+           for the fact rows of the mask (all rows when None)."""
+
+        attributes = [attributes] if isinstance(attributes, str) else list(attributes)
+        selected = np.flatnonzero(mask) if mask is not None else np.arange(len(self))
+
+        encoded = [self.attribute_codes(attribute) for attribute in attributes]
+        codes = [code[selected].astype(np.int64) for code, _ in encoded]
+        sizes = [int(code.max()) + 1 if len(code) else 1 for code, _ in encoded]
+        groups, group_index = np.unique(np.ravel_multi_index(codes, sizes), return_inverse=True)
+
+        result = {}
+        for attribute, (_, decode), group_codes in zip(attributes, encoded, np.unravel_index(groups, sizes)):
+            result[attribute] = decode(group_codes)
+        counts = np.bincount(group_index, minlength=len(groups))
+        result["count"] = counts
+        for measure in measures:
+            result[measure] = np.bincount(group_index, self.fact[measure][selected].astype(np.float64),
+                                          len(groups)) / np.maximum(counts, 1)
+        return pd.DataFrame(result).sort_values("count", ascending=False, ignore_index=True)
+
+    def arrays(self):
+        """A function which lists every array of the warehouse with its name in the file."""
+
+        named = [("fact/" + column, values) for column, values in self.fact.items()]
+        for name, dimension in self.dimensions.items():
+            named.append((f"{name}/position_of_key", dimension.position_of_key))
+            named += [(f"{name}/numeric/{column}", values) for column, values in dimension.numeric.items()]
+            for column, (codes, dictionary) in dimension.encoded.items():
+                named += [(f"{name}/codes/{column}", codes), (f"{name}/dictionary/{column}", dictionary)]
+        return named
+
+    def save(self, path):
+        """A function which writes the warehouse to one memory-mappable file (see the module description)."""
+
+        named = self.arrays()
+        descriptors, offset = [], 0
+        for name, values in named:
+            values = np.ascontiguousarray(values)
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            descriptors.append({"name": name, "dtype": values.dtype.str, "shape": list(values.shape), "offset": offset})
+            offset += values.nbytes
+        header = json.dumps({"arrays": descriptors,
+                             "dimensions": {name: dimension.key for name, dimension in self.dimensions.items()}}).encode()
+        data_start = -(-(len(FILE_MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+        with open(path, "wb") as warehouse_file:
+            warehouse_file.write(FILE_MAGIC + np.uint64(len(header)).tobytes() + header)
+            for descriptor, (_, values) in zip(descriptors, named):
+                warehouse_file.seek(data_start + descriptor["offset"])
+                warehouse_file.write(np.ascontiguousarray(values).tobytes())
+            warehouse_file.truncate(data_start + offset)
+
+    @classmethod
+    def load(cls, path):
+        """A function which maps a warehouse file read-only: every array is an np.memmap over the file."""
+
+        with open(path, "rb") as warehouse_file:
+            if warehouse_file.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError(f"{path} is not a columnar warehouse file")
+            header_length = int(np.frombuffer(warehouse_file.read(8), dtype=np.uint64)[0])
+            header = json.loads(warehouse_file.read(header_length))
+        data_start = -(-(len(FILE_MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+        arrays = {}
+        for descriptor in header["arrays"]:
+            shape = tuple(descriptor["shape"])
+            if int(np.prod(shape)) == 0:
+                arrays[descriptor["name"]] = np.zeros(shape, dtype=descriptor["dtype"])
+            else:
+                arrays[descriptor["name"]] = np.memmap(path, dtype=descriptor["dtype"], mode="r",
+                                                       offset=data_start + descriptor["offset"], shape=shape)
+
+        fact = {name[len("fact/"):]: values for name, values in arrays.items() if name.startswith("fact/")}
+        dimensions = {}
+        for name, key in header["dimensions"].items():
+            numeric = {n.split("/", 2)[2]: v for n, v in arrays.items() if n.startswith(f"{name}/numeric/")}
+            encoded = {n.split("/", 2)[2]: (v, arrays[f"{name}/dictionary/{n.split('/', 2)[2]}"])
+                       for n, v in arrays.items() if n.startswith(f"{name}/codes/")}
+            dimensions[name] = Dimension(name, key, numeric, encoded, arrays[f"{name}/position_of_key"])
+        return cls(fact, dimensions)
@@ -0,0 +1,253 @@
+
+import io, struct, tempfile, time
+
+import numpy as np
+import pandas as pd
+
+"""
+************************************  COPY TO STDOUT read path:  ************************************
+Reading a table with SELECT * + fetchall() + pd.DataFrame(list_of_tuples) builds one Python tuple and one Python
+object per value. read_table() streams the rows with COPY (SELECT ...) TO STDOUT into a spooled buffer (in memory up to
+spool_bytes, then on disk) and parses the buffer into typed columns in one pass:
+            df = db.read_table("fact_table", columns=["date_surrogate_key", "crime_number"],
+                               where="date_surrogate_key > %s", params=(100,))
+
+    - format "csv": the buffer is parsed by pd.read_csv (C parser) with the dtypes of the result columns, which are
+      read from the cursor description of the same query with LIMIT 0 (nulls are written as \\N, so an empty string
+      stays an empty string),
+    - format "binary": when every column is fixed width (integers, floats, booleans, dates, timestamps) and no value
+      is null, every tuple of the PGCOPY stream has the same size and the buffer is read with one np.frombuffer over
+      a big-endian structured dtype (no parsing at all). Otherwise the tuples are decoded one by one.
+
+The integer columns without null come back with the NumPy integer dtype of their PostgreSQL type (like fetchall),
+the integer columns with nulls with the nullable Int dtype. benchmark_read_paths() compares the three read paths:
+            python copy_reader.py [rows | table]        (default: a generated table of 1000000 rows)
+"""
+
+
+SPOOL_BYTES = 256 * 2 ** 20
+
+NULL_MARKER = "\\N"
+
+# PostgreSQL epoch of the binary dates and timestamps
+POSTGRES_EPOCH = np.datetime64("2000-01-01")
+
+# type oid: (pandas dtype of the CSV parser, big-endian binary dtype or None for variable width)
+TYPE_OIDS = {
+    16: ("boolean", ">?"),             # bool
+    20: ("Int64", ">i8"),              # int8
+    21: ("Int16", ">i2"),              # int2
+    23: ("Int32", ">i4"),              # int4
+    700: ("float32", ">f4"),           # float4
+    701: ("float64", ">f8"),           # float8
+    1700: ("float64", None),           # numeric
+    1082: ("date", ">i4"),             # date
+    1114: ("timestamp", ">i8"),        # timestamp
+    1184: ("timestamp", ">i8"),        # timestamptz
+}
+
+BINARY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
+def result_columns(cur, select):
+    """A function which returns the (name, type oid) of the result columns of a query, without reading rows."""
+
+    cur.execute(f"SELECT * FROM ({select}) copied LIMIT 0")
+    return [(column[0], column[1]) for column in cur.description]
+
+
+def build_select(table_name, columns=None, where=None):
+    select = f"SELECT {', '.join(columns) if columns else '*'} FROM {table_name}"
+    if where:
+        select += f" WHERE {where}"
+    return select
+
+
+def copy_to_buffer(cur, select, options, spool_bytes=SPOOL_BYTES):
+    """A function which runs COPY (select) TO STDOUT into a spooled temporary buffer, rewound."""
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    cur.copy_expert(f"COPY ({select}) TO STDOUT WITH ({options})", buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def finish_columns(df, types):
+    """A function which gives the integer columns without null the NumPy dtype of their PostgreSQL type."""
+
+    for name, oid in types:
+        if oid in (20, 21, 23) and not df[name].hasnans:
+            df[name] = df[name].to_numpy(dtype=TYPE_OIDS[oid][0].lower())
+    return df
+
+
+def parse_csv(buffer, types):
+    dtypes, dates = {}, []
+    for name, oid in types:
+        dtype = TYPE_OIDS.get(oid, ("str", None))[0]
+        if dtype in ("date", "timestamp"):
+            dates.append(name)
+        else:
+            dtypes[name] = dtype
+    df = pd.read_csv(buffer, dtype=dtypes, parse_dates=dates, keep_default_na=False, na_values=[NULL_MARKER],
+                     true_values=["t"], false_values=["f"])
+    return finish_columns(df, types)
+
+
+def parse_binary(data, types):
+    """A function which parses a PGCOPY binary stream into a dataframe (see the module description)."""
+
+    if not data.startswith(BINARY_SIGNATURE):
+        raise ValueError("not a PGCOPY binary stream")
+    extension_length = struct.unpack_from(">i", data, len(BINARY_SIGNATURE) + 4)[0]
+    offset = len(BINARY_SIGNATURE) + 8 + extension_length
+    body = memoryview(data)[offset:len(data) - 2]     # the stream ends with the int16 -1 trailer
+
+    widths = [TYPE_OIDS.get(oid, (None, None))[1] for _, oid in types]
+    if all(widths):
+        # fixed width without null: field count, then (length, value) per column, the same size for every tuple
+        fields = [("field_count", ">i2")]
+        for index, width in enumerate(widths):
+            fields += [(f"length_{index}", ">i4"), (f"value_{index}", width)]
+        tuple_dtype = np.dtype(fields)
+        if len(body) % tuple_dtype.itemsize == 0:
+            records = np.frombuffer(body, dtype=tuple_dtype)
+            lengths_match = all((records[f"length_{index}"] == np.dtype(width).itemsize).all()
+                                for index, width in enumerate(widths))
+            if lengths_match:
+                return pd.DataFrame({name: binary_values(records[f"value_{index}"], oid)
+                                     for index, (name, oid) in enumerate(types)})
+    return decode_binary_tuples(body, types)
+
+
+def binary_values(values, oid):
+    """A function which converts the big-endian binary values of one column to native NumPy values."""
+
+    values = values.astype(values.dtype.newbyteorder("="))
+    if oid == 1082:
+        return POSTGRES_EPOCH + values.astype("timedelta64[D]")
+    if oid in (1114, 1184):
+        return POSTGRES_EPOCH + values.astype("timedelta64[us]")
+    return values
+
+
+def decode_binary_tuples(body, types):
+    """A function which decodes a PGCOPY binary body tuple by tuple (variable width columns or nulls)."""
+
+    columns = [[] for _ in types]
+    decoders = []
+    for _, oid in types:
+        width = TYPE_OIDS.get(oid, (None, None))[1]
+        if width is not None:
+            decoders.append(lambda raw, dtype=np.dtype(width), oid=oid: binary_values(np.frombuffer(raw, dtype), oid)[0])
+        elif oid == 1700:
+            decoders.append(decode_numeric)
+        else:
+            decoders.append(lambda raw: bytes(raw).decode("utf-8", errors="replace"))
+
+    offset = 0
+    while offset < len(body):
+        field_count = struct.unpack_from(">h", body, offset)[0]
+        offset += 2
+        for index in range(field_count):
+            length = struct.unpack_from(">i", body, offset)[0]
+            offset += 4
+            if length < 0:
+                columns[index].append(None)
+                continue
+            columns[index].append(decoders[index](body[offset:offset + length]))
+            offset += length
+
+    df = pd.DataFrame({name: columns[index] for index, (name, _) in enumerate(types)})
+    for name, oid in types:
+        if oid in (20, 21, 23):
+            df[name] = pd.array(df[name], dtype=TYPE_OIDS[oid][0])
+    return finish_columns(df, types)
+
+
+def decode_numeric(raw):
+    """A function which decodes a binary numeric value (base 10000 digits) to a float."""
+
+    digit_count, weight, sign, _ = struct.unpack_from(">hhHh", raw, 0)
+    if sign == 0xC000:
+        return float("nan")
+    digits = struct.unpack_from(f">{digit_count}h", raw, 8)
+    value = sum(digit * 10000.0 ** (weight - index) for index, digit in enumerate(digits))
+    return -value if sign == 0x4000 else value
+
+
+def read_table_copy(cur, table_name, columns=None, where=None, params=None, format="csv", spool_bytes=SPOOL_BYTES):
+    """A function which reads the projected columns of the rows of a table matching the WHERE clause with
+       COPY TO STDOUT, and returns them as a typed dataframe (see the module description).
+    """
+
+    select = build_select(table_name, columns, where)
+    if params is not None:
+        select = cur.mogrify(select, params).decode("utf-8")
+    types = result_columns(cur, select)
+
+    if format == "csv":
+        buffer = copy_to_buffer(cur, select, f"FORMAT csv, HEADER true, NULL '{NULL_MARKER}'", spool_bytes)
+        with buffer:
+            return parse_csv(io.TextIOWrapper(buffer, encoding="utf-8"), types)
+    if format == "binary":
+        buffer = copy_to_buffer(cur, select, "FORMAT binary", spool_bytes)
+        with buffer:
+            return parse_binary(buffer.read(), types)
+    raise ValueError(f"unknown COPY format {format!r} (csv or binary)")
+
+
+def read_table_fetchall(cur, table_name, columns=None, where=None, params=None):
+    """A function which reads the same rows through SELECT + fetchall() (the reference path of the benchmark)."""
+
+    cur.execute(build_select(table_name, columns, where), params)
+    rows = cur.fetchall()
+    return pd.DataFrame(rows, columns=[col[0] for col in cur.description])
+
+
+def create_benchmark_table(db, table_name="copy_benchmark_table", rows=1000000):
+    """A function which creates a fact-like table of the given number of rows with generate_series."""
+
+    db.cur.execute(f"""DROP TABLE IF EXISTS {table_name};
+                        CREATE TABLE {table_name} AS
+                        SELECT i AS event_surrogate_key, (i % 1461)::int AS date_surrogate_key,
+                               (i % 140)::smallint AS neighbourhood_surrogate_key, (i % 50)::bigint AS crime_number,
+                               (random() * 40 - 15)::real AS temperature_mean, (random() * 30)::float8 AS precipitation,
+                               'crime type ' || (i % 7) AS crime_type
+                        FROM generate_series(1, {int(rows)}) i""")
+    db.raw_conn.commit()
+    return table_name
+
+
+def benchmark_read_paths(db, table_name, columns=None, where=None, params=None, repeat=3):
+    """A function which prints the best time and the rows per second of the fetchall, COPY csv and COPY binary
+       read paths of a table, and returns them.
+    """
+
+    paths = {
+        "fetchall": lambda: read_table_fetchall(db.cur, table_name, columns, where, params),
+        "copy csv": lambda: read_table_copy(db.cur, table_name, columns, where, params, "csv"),
+        "copy binary": lambda: read_table_copy(db.cur, table_name, columns, where, params, "binary"),
+    }
+    results = {}
+    for name, read in paths.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            df = read()
+            timings.append(time.perf_counter() - start)
+        results[name] = {"rows": len(df), "seconds": min(timings), "rows_per_second": len(df) / min(timings),
+                         "memory_bytes": int(df.memory_usage(deep=True).sum())}
+        print(f"{name:12} {len(df):>10} rows {min(timings):8.3f} s {len(df) / min(timings):14,.0f} rows/s "
+              f"{results[name]['memory_bytes'] / 2 ** 20:8.1f} MiB")
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    from A02_Team_V04 import DbConnection
+
+    argument = sys.argv[1] if len(sys.argv) > 1 else "1000000"
+    with DbConnection() as db:
+        table_name = create_benchmark_table(db, rows=int(argument)) if argument.isdigit() else argument
+        benchmark_read_paths(db, table_name)
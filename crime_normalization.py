@@ -0,0 +1,208 @@
+
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+"""
+************************************  Declarative column normalization:  ************************************
+A normalization spec declares, per (lower case) source column, the rules applied to it:
+            "case":     "lower" or "upper", case-fold the text values
+            "map":      dictionary, value map (values not in the map become null, like Series.map)
+            "replace":  dictionary, noise replacement (values not in the dictionary are kept, like Series.replace)
+            "dtype":    final dtype of the column
+            "rename":   final name of the column
+and "column_case" case-folds every column header.
+
+compile_spec() turns the spec into one ColumnPlan per column, using the minimum number of vectorized operations:
+    - a column with a single text rule is transformed directly (one vectorized pass),
+    - a column with several value rules is factorized once, the rules are applied to its distinct values only
+      and the result is expanded back with one take (one pass over the column whatever the number of rules),
+    - the dtype is cast on the distinct values when possible, and every rename is done when the output frame
+      is assembled, so no column is copied by a rename.
+
+normalize_frame() applies the plans and returns the normalized frame with a NormalizationReport holding the
+time spent per rule.
+"""
+
+
+MONTH_MAP = {"january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6,
+             "july": 7, "august": 8, "september": 9, "october": 10, "november": 11, "december": 12}
+
+# The crime cleaning of etl_source_data(), STEP#2-1 (4) to (8)
+CRIME_NORMALIZATION_SPEC = {
+    "column_case": "lower",
+    "columns": {
+        "event_id": {"case": "lower"},
+        "occurrence_year": {"dtype": int, "rename": "year"},
+        "occurrence_month": {"case": "lower", "map": MONTH_MAP, "dtype": int, "rename": "month"},
+        "occurrence_day": {"dtype": int, "rename": "day"},
+        "day_of_year": {"dtype": int},
+        "location_type": {"case": "lower"},
+        "day_of_week": {"case": "lower"},
+        "crime_type": {"case": "lower"},
+        "neighbourhood_name": {"case": "lower", "replace": {"nsa": "random"}},
+        "hood_id": {"replace": {"NSA": "0"}, "dtype": int},
+    },
+}
+
+# The order in which the value rules of one column are applied
+VALUE_RULES = ("case", "map", "replace")
+
+ColumnPlan = namedtuple("ColumnPlan", ["source", "target", "strategy", "rules", "dtype"])
+
+
+class NormalizationReport:
+    """
+    The class NormalizationReport accumulates the time spent by every rule of a normalization run,
+    per column and per rule type, so the expensive rules can be spotted.
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    def add(self, column, rule, seconds):
+        key = (column, rule)
+        self.timings[key] = self.timings.get(key, 0.0) + seconds
+
+    def per_rule(self):
+        totals = OrderedDict()
+        for (column, rule), seconds in self.timings.items():
+            totals[rule] = totals.get(rule, 0.0) + seconds
+        return totals
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def __str__(self):
+        lines = [f"Normalization: {self.total():.4f} seconds"]
+        for rule, seconds in sorted(self.per_rule().items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"    {rule:<10} {seconds:.4f} s")
+        for (column, rule), seconds in sorted(self.timings.items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"    {column + '.' + rule:<34} {seconds:.4f} s")
+        return "\n".join(lines)
+
+
+def fold_case(name, column_case):
+    if column_case == "lower":
+        return name.lower()
+    if column_case == "upper":
+        return name.upper()
+    return name
+
+
+def compile_spec(spec, columns):
+    """A function which compiles a normalization spec against the columns of a frame and returns
+       one ColumnPlan per column, in the column order of the frame.
+    """
+
+    column_case = spec.get("column_case")
+    column_specs = spec.get("columns", {})
+    plans = []
+    for source in columns:
+        name = fold_case(source, column_case)
+        column_spec = column_specs.get(name, {})
+        rules = [(rule, column_spec[rule]) for rule in VALUE_RULES if rule in column_spec]
+
+        if len(rules) > 1 or any(rule != "case" for rule, _ in rules):
+            # Several rules or a value lookup: apply them on the distinct values only
+            strategy = "factorize"
+        elif rules:
+            strategy = "direct"
+        else:
+            strategy = "cast" if "dtype" in column_spec else "keep"
+
+        plans.append(ColumnPlan(source, column_spec.get("rename", name), strategy, rules, column_spec.get("dtype")))
+    return plans
+
+
+def apply_value_rule(values, rule, argument):
+    """A function which applies one value rule to a Series (either a column or its distinct values)."""
+
+    if rule == "case":
+        return values.str.lower() if argument == "lower" else values.str.upper()
+    if rule == "map":
+        return values.map(argument)
+    if rule == "replace":
+        return values.replace(argument)
+    raise ValueError(f"Unknown normalization rule: {rule}")
+
+
+def run_plan(series, plan, report):
+    """A function which runs the ColumnPlan of one column and returns the normalized values."""
+
+    if plan.strategy == "keep":
+        return series
+
+    if plan.strategy == "cast":
+        start = time.perf_counter()
+        values = series if series.dtype == np.dtype(plan.dtype) else series.astype(plan.dtype)
+        report.add(plan.target, "dtype", time.perf_counter() - start)
+        return values
+
+    if plan.strategy == "direct":
+        rule, argument = plan.rules[0]
+        start = time.perf_counter()
+        values = apply_value_rule(series, rule, argument)
+        report.add(plan.target, rule, time.perf_counter() - start)
+        if plan.dtype is not None:
+            start = time.perf_counter()
+            values = values.astype(plan.dtype)
+            report.add(plan.target, "dtype", time.perf_counter() - start)
+        return values
+
+    # factorize: one hash pass over the column, the rules only see the distinct values
+    start = time.perf_counter()
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques)
+    report.add(plan.target, "factorize", time.perf_counter() - start)
+
+    for rule, argument in plan.rules:
+        start = time.perf_counter()
+        uniques = apply_value_rule(uniques, rule, argument)
+        report.add(plan.target, rule, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    has_null = bool((codes < 0).any())
+    if plan.dtype is not None:
+        if has_null and np.issubdtype(np.dtype(plan.dtype), np.integer):
+            raise ValueError(f"Cannot convert null values of column {plan.source} to {plan.dtype}")
+        uniques = uniques.astype(plan.dtype)
+    lookup = uniques.to_numpy()
+    if has_null:
+        # codes of -1 (null values) take the extra null slot at the end of the lookup array
+        lookup = np.append(lookup.astype(object) if lookup.dtype.kind in "iub" else lookup, None)
+    values = pd.Series(lookup.take(codes), index=series.index)
+    report.add(plan.target, "take", time.perf_counter() - start)
+    return values
+
+
+def normalize_frame(df, spec, report=None):
+    """A function which normalizes a DataFrame according to a normalization spec.
+       Every column is transformed in one pass, and the output frame is assembled once with its final
+       column names. Returns the normalized frame and the NormalizationReport of the run.
+    """
+
+    report = report if report is not None else NormalizationReport()
+    plans = compile_spec(spec, df.columns)
+
+    columns = OrderedDict()
+    for plan in plans:
+        columns[plan.target] = run_plan(df[plan.source], plan, report)
+
+    start = time.perf_counter()
+    df = pd.DataFrame(columns, index=df.index)
+    report.add("*", "assemble", time.perf_counter() - start)
+    return df, report
+
+
+def describe_plans(plans):
+    """A function which returns a readable description of compiled ColumnPlans."""
+
+    lines = []
+    for plan in plans:
+        rules = " -> ".join(rule for rule, _ in plan.rules) or "-"
+        dtype = getattr(plan.dtype, "__name__", plan.dtype) if plan.dtype is not None else "-"
+        lines.append(f"{plan.source} -> {plan.target}: {plan.strategy} [{rules}] dtype={dtype}")
+    return "\n".join(lines)
@@ -0,0 +1,224 @@
+
+import time
+
+import numpy as np
+import pandas as pd
+
+"""
+************************************  Crime vs weather analytics over the star schema:  ************************************
+CrimeWeatherAnalytics loads the fact_table keys and the dimension attributes it needs once (one SQL query), keeps them
+as NumPy arrays (text attributes are dictionary encoded: integer codes + labels) and answers every analysis with
+vectorized array operations:
+            analytics = CrimeWeatherAnalytics.from_database()
+            analytics.counts_by_temperature_bin(2.0)              crimes, days and crimes per day per temperature bin
+            analytics.rolling_correlation(30)                     rolling correlation of daily crimes vs temperature
+            analytics.breakdown(['neighbourhood', 'crime_type'])  crimes and mean temperature per group
+
+Intermediate arrays (the daily series, the bins of a temperature column, the group codes) are cached in the object,
+so a sweep over many bin widths or windows only pays for the final bincount. save()/load() keep the loaded arrays in a
+.npz file to skip the database entirely.
+"""
+
+
+ANALYTICS_QUERY = """select f.date_surrogate_key, f.neighbourhood_surrogate_key,
+                        f.temperature_mean, f.temperature_min, f.temperature_max,
+                        d.year, d.month, d.day, n.hood_id, e.crime_type, c.weather
+                    from fact_table f
+                    join date_surrogate_table d on d.date_surrogate_key = f.date_surrogate_key
+                    join neighbourhood_surrogate_table n on n.neighbourhood_surrogate_key = f.neighbourhood_surrogate_key
+                    join crime_event_surrogate_table es on es.event_surrogate_key = f.event_surrogate_key
+                    join crime_event_dimension_table e on e.event_id = es.event_id
+                    join climate_surrogate_table cs on cs.climate_surrogate_key = f.climate_surrogate_key
+                    join climate_dimension_table c on c.climate_id = cs.climate_id and c.year = cs.year
+                        and c.month = cs.month and c.day = cs.day"""
+
+TEMPERATURE_COLUMNS = ('temperature_mean', 'temperature_min', 'temperature_max')
+
+# Dimension attributes available for breakdowns, and the array holding their codes
+GROUP_ATTRIBUTES = {'neighbourhood': 'hood_id', 'crime_type': 'crime_type', 'weather': 'weather',
+                    'year': 'year', 'month': 'month'}
+
+
+class CrimeWeatherAnalytics:
+    """
+    The class CrimeWeatherAnalytics holds one row per crime of fact_table as NumPy arrays (see the module
+    description). Every public method returns a pandas DataFrame (or array) built from cached intermediate arrays.
+    """
+
+    def __init__(self, arrays, labels):
+        self.arrays = arrays
+        self.labels = labels
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @classmethod
+    def from_database(cls, db=None):
+        """A function which loads the analytics arrays with one query over the star schema."""
+
+        if db is None:
+            from A02_Team_V04 import DbConnection
+            with DbConnection() as db:
+                return cls.from_database(db)
+
+        start = time.perf_counter()
+        db.cur.execute(ANALYTICS_QUERY)
+        columns = [col[0] for col in db.cur.description]
+        df = pd.DataFrame(db.cur.fetchall(), columns=columns)
+        print(f"Analytics: {len(df)} fact rows loaded in {time.perf_counter() - start:.3f} seconds")
+        return cls.from_frame(df)
+
+    @classmethod
+    def from_frame(cls, df):
+        """A function which encodes the rows of ANALYTICS_QUERY (as a DataFrame) into typed arrays."""
+
+        arrays, labels = {}, {}
+        for column in ('date_surrogate_key', 'neighbourhood_surrogate_key', 'year', 'month', 'day'):
+            arrays[column] = df[column].to_numpy(dtype=np.int32)
+        for column in TEMPERATURE_COLUMNS:
+            arrays[column] = df[column].to_numpy(dtype=np.float32)
+        for column in ('hood_id', 'crime_type', 'weather'):
+            codes, uniques = pd.factorize(df[column], sort=True)
+            arrays[column] = codes.astype(np.int32)
+            labels[column] = np.asarray(uniques)
+        return cls(arrays, labels)
+
+    def save(self, path):
+        np.savez(path, **self.arrays, **{"labels__" + name: values for name, values in self.labels.items()})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as data:
+            arrays = {name: data[name] for name in data.files if not name.startswith("labels__")}
+            labels = {name[len("labels__"):]: data[name] for name in data.files if name.startswith("labels__")}
+        return cls(arrays, labels)
+
+    def cached(self, key, builder):
+        if key in self.cache:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            self.cache[key] = builder()
+        return self.cache[key]
+
+    def daily(self):
+        """A function which returns the daily series (sorted by date): the date of every day, its crime count,
+           the mean of every temperature column, and the day index of every fact row.
+        """
+
+        def build():
+            day_number = (self.arrays['year'].astype(np.int64) * 10000 + self.arrays['month'] * 100
+                          + self.arrays['day'])
+            days, day_index = np.unique(day_number, return_inverse=True)
+            counts = np.bincount(day_index, minlength=len(days))
+            series = {'date': days, 'crime_count': counts, 'day_index': day_index}
+            for column in TEMPERATURE_COLUMNS:
+                series[column] = np.bincount(day_index, self.arrays[column], len(days)) / np.maximum(counts, 1)
+            return series
+        return self.cached('daily', build)
+
+    def temperature_bins(self, width, column='temperature_mean'):
+        """A function which returns the bin number (floor(temperature / width)) of every fact row."""
+
+        return self.cached(('bins', column, width),
+                           lambda: np.floor(self.arrays[column] / width).astype(np.int64))
+
+    def counts_by_temperature_bin(self, width, column='temperature_mean'):
+        """A function which returns, per temperature bin of the given width: the number of crimes, the number of
+           days whose temperature falls in the bin, and the crimes per day (NaN for a bin without any day: its
+           crimes come from rows whose temperature differs from the daily mean).
+        """
+
+        def build():
+            bins = self.temperature_bins(width, column)
+            daily = self.daily()
+            day_bins = np.floor(daily[column] / width).astype(np.int64)
+            low = min(bins.min(), day_bins.min())
+            crimes = np.bincount(bins - low)
+            days = np.bincount(day_bins - low, minlength=len(crimes))
+            crimes = np.pad(crimes, (0, len(days) - len(crimes)))
+            present = (crimes > 0) | (days > 0)
+            lower = (np.arange(len(crimes)) + low) * width
+            return pd.DataFrame({'temperature_from': lower[present], 'temperature_to': lower[present] + width,
+                                 'crimes': crimes[present], 'days': days[present],
+                                 'crimes_per_day': np.where(days[present] > 0, crimes[present], np.nan) /
+                                                   np.maximum(days[present], 1)})
+        return self.cached(('temperature_bin_counts', column, width), build)
+
+    def rolling_correlation(self, window, column='temperature_mean'):
+        """A function which returns the Pearson correlation between the daily crime count and the daily
+           temperature over a rolling window of days (computed from cumulative sums, NaN for the first days).
+           The window holds at least 2 days.
+        """
+
+        if window < 2:
+            raise ValueError(f"the rolling correlation needs a window of at least 2 days, got {window}")
+
+        def build():
+            daily = self.daily()
+            x = daily['crime_count'].astype(np.float64)
+            y = daily[column].astype(np.float64)
+
+            def window_sums(values):
+                sums = np.cumsum(np.concatenate([[0.0], values]))
+                return sums[window:] - sums[:-window]
+
+            n = float(window)
+            sx, sy = window_sums(x), window_sums(y)
+            sxx, syy, sxy = window_sums(x * x), window_sums(y * y), window_sums(x * y)
+            covariance = sxy - sx * sy / n
+            variance = np.sqrt(np.maximum(sxx - sx * sx / n, 0) * np.maximum(syy - sy * sy / n, 0))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                correlation = np.where(variance > 0, covariance / variance, np.nan)
+            result = np.full(len(x), np.nan)
+            result[window - 1:] = correlation
+            return pd.DataFrame({'date': daily['date'], 'crime_count': daily['crime_count'],
+                                 column: daily[column], 'correlation': result})
+        return self.cached(('rolling_correlation', column, window), build)
+
+    def group_codes(self, by):
+        """A function which combines the codes of several attributes into one group code per fact row."""
+
+        def build():
+            codes = [self.arrays[GROUP_ATTRIBUTES[attribute]] for attribute in by]
+            sizes = [int(code.max()) + 1 if len(code) else 1 for code in codes]
+            combined = np.ravel_multi_index(codes, sizes)
+            return combined, sizes
+        return self.cached(('group_codes', tuple(by)), build)
+
+    def breakdown(self, by, column='temperature_mean', temperature_bin_width=None):
+        """A function which returns the number of crimes and their mean temperature per group of attributes
+           (neighbourhood, crime_type, weather, year, month), optionally also split by temperature bin.
+        """
+
+        by = [by] if isinstance(by, str) else list(by)
+
+        def build():
+            combined, sizes = self.group_codes(by)
+            groups, group_index = np.unique(combined, return_inverse=True)
+            keys = np.unravel_index(groups, sizes)
+            frame = {}
+            for attribute, key in zip(by, keys):
+                array_name = GROUP_ATTRIBUTES[attribute]
+                frame[attribute] = self.labels[array_name][key] if array_name in self.labels else key
+            if temperature_bin_width is not None:
+                bins = self.temperature_bins(temperature_bin_width, column)
+                low = bins.min()
+                cell = group_index.astype(np.int64) * (bins.max() - low + 1) + (bins - low)
+                cells, cell_index = np.unique(cell, return_inverse=True)
+                group_of_cell = cells // (bins.max() - low + 1)
+                frame = {name: np.asarray(values)[group_of_cell] for name, values in frame.items()}
+                frame['temperature_from'] = (cells % (bins.max() - low + 1) + low) * temperature_bin_width
+                group_index, size = cell_index, len(cells)
+            else:
+                size = len(groups)
+            crimes = np.bincount(group_index, minlength=size)
+            frame['crimes'] = crimes
+            frame[column] = np.bincount(group_index, self.arrays[column], size) / np.maximum(crimes, 1)
+            return pd.DataFrame(frame).sort_values('crimes', ascending=False, ignore_index=True)
+        return self.cached(('breakdown', tuple(by), column, temperature_bin_width), build)
+
+    def sweep_temperature_bins(self, widths, column='temperature_mean'):
+        """A function which returns the temperature bin counts for every bin width (no database access)."""
+
+        return {width: self.counts_by_temperature_bin(width, column) for width in widths}
@@ -0,0 +1,176 @@
+
+import math, time
+
+import numpy as np
+import pandas as pd
+
+from pipeline_config import load_section
+
+"""
+************************************  Bloom filter over the loaded event_id:  ************************************
+An incremental load has to know which incoming event_id are already in crime_event_dimension_table. EventBloomFilter
+answers "definitely new" or "probably loaded" for a whole batch with array operations:
+            bloom = EventBloomFilter.load("event_bloom.npz")
+            new_mask = split_new_events(db, bloom, df['event_id'])      True for the events which are not loaded yet
+
+Only the probable hits are verified in the database (one query with an array parameter), the definitely new events
+never reach it. The filter is enabled in config.json:
+            "event_bloom": {"enabled": true, "path": "event_bloom.npz", "false_positive_rate": 0.01}
+
+The filter is a packed bit array of m bits with k hash functions, sized for the capacity (twice the number of loaded
+events, at least MIN_CAPACITY) and the false positive rate:
+            m = -capacity * ln(rate) / ln(2) ** 2        k = m / capacity * ln(2)
+(9.6 bits per event and 7 hashes for 1%). The k positions are derived from two independent 64-bit hashes
+(h1 + i * h2, double hashing). refresh_event_bloom() rebuilds it from crime_event_dimension_table after a full load,
+update_event_bloom() adds the events of an incremental load, and rebuilds it once the capacity is exceeded.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "path": "event_bloom.npz",
+    "false_positive_rate": 0.01,
+}
+
+MIN_CAPACITY = 100000
+
+# Hash keys (16 bytes) of the two hashes of the double hashing
+FIRST_HASH_KEY = "eventbloom000001"
+SECOND_HASH_KEY = "eventbloom000002"
+
+EVENT_ID_QUERY = "SELECT event_id FROM crime_event_dimension_table"
+
+
+class EventBloomFilter:
+    """
+    The class EventBloomFilter is a Bloom filter over event_id kept in a packed NumPy bit array
+    (see the module description).
+    """
+
+    def __init__(self, capacity, false_positive_rate, bits=None, count=0):
+        self.capacity = int(capacity)
+        self.false_positive_rate = float(false_positive_rate)
+        self.bit_count = max(8, int(math.ceil(-self.capacity * math.log(self.false_positive_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / self.capacity * math.log(2))))
+        self.bits = bits if bits is not None else np.zeros((self.bit_count + 7) // 8, dtype=np.uint8)
+        self.count = int(count)
+
+    def positions(self, values):
+        """A function which returns the (n, k) bit positions of the values."""
+
+        values = np.asarray(values, dtype=object).astype(str).astype(object)
+        first = pd.util.hash_array(values, hash_key=FIRST_HASH_KEY, categorize=False)
+        # an odd second hash visits k distinct positions
+        second = pd.util.hash_array(values, hash_key=SECOND_HASH_KEY, categorize=False) | np.uint64(1)
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        return (first[:, None] + steps[None, :] * second[:, None]) % np.uint64(self.bit_count)
+
+    def add(self, values):
+        positions = self.positions(values).ravel()
+        np.bitwise_or.at(self.bits, (positions >> np.uint64(3)).astype(np.int64),
+                         (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+        self.count += len(values)
+
+    def might_contain(self, values):
+        """A function which returns, for every value, False when it was never added and True when it probably was."""
+
+        if len(values) == 0:
+            return np.zeros(0, dtype=bool)
+        positions = self.positions(values)
+        bytes_ = self.bits[(positions >> np.uint64(3)).astype(np.int64)]
+        return ((bytes_ >> (positions & np.uint64(7)).astype(np.uint8)) & 1).all(axis=1).astype(bool)
+
+    def expected_false_positive_rate(self):
+        return (1 - math.exp(-self.hash_count * self.count / self.bit_count)) ** self.hash_count
+
+    def save(self, path):
+        np.savez(path, bits=self.bits, meta=np.array([self.capacity, self.count], dtype=np.int64),
+                 false_positive_rate=np.array([self.false_positive_rate]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            capacity, count = (int(value) for value in data["meta"])
+            return cls(capacity, float(data["false_positive_rate"][0]), data["bits"].copy(), count)
+
+    @classmethod
+    def build(cls, event_ids, false_positive_rate):
+        bloom = cls(max(MIN_CAPACITY, 2 * len(event_ids)), false_positive_rate)
+        bloom.add(event_ids)
+        return bloom
+
+
+def event_bloom_settings():
+    """A function which returns the event_bloom settings of config.json, or None when disabled."""
+
+    settings = load_section("event_bloom", DEFAULT_SETTINGS)
+    return settings if settings["enabled"] else None
+
+
+def loaded_event_ids(db):
+    db.cur.execute(EVENT_ID_QUERY)
+    return np.array([row[0] for row in db.cur.fetchall()], dtype=object)
+
+
+def refresh_event_bloom(db):
+    """A function which rebuilds the Bloom filter from crime_event_dimension_table (after a full load).
+       It does nothing when the event_bloom section of config.json is disabled.
+    """
+
+    settings = event_bloom_settings()
+    if settings is None:
+        return None
+
+    start = time.perf_counter()
+    bloom = EventBloomFilter.build(loaded_event_ids(db), settings["false_positive_rate"])
+    bloom.save(settings["path"])
+    print(f"Event Bloom filter: {bloom.count} events, {bloom.bits.nbytes / 1e6:.2f} MB, {bloom.hash_count} hashes, "
+          f"built in {time.perf_counter() - start:.3f} seconds")
+    return bloom
+
+
+def load_event_bloom(db):
+    """A function which returns the stored Bloom filter (rebuilt when missing), or None when disabled."""
+
+    settings = event_bloom_settings()
+    if settings is None:
+        return None
+    try:
+        return EventBloomFilter.load(settings["path"])
+    except FileNotFoundError:
+        return refresh_event_bloom(db)
+
+
+def update_event_bloom(db, event_ids):
+    """A function which adds the events of an incremental load to the stored Bloom filter, or rebuilds it from
+       the database when its capacity would be exceeded. It does nothing when the filter is disabled.
+    """
+
+    settings = event_bloom_settings()
+    bloom = load_event_bloom(db)
+    if bloom is None:
+        return None
+    if bloom.count + len(event_ids) > bloom.capacity:
+        return refresh_event_bloom(db)
+    bloom.add(event_ids)
+    bloom.save(settings["path"])
+    return bloom
+
+
+def split_new_events(db, bloom, event_ids):
+    """A function which returns the mask of the event_id which are not loaded yet. The definitely new events are
+       decided by the Bloom filter alone; the probable hits are verified in crime_event_dimension_table.
+    """
+
+    event_ids = np.asarray(event_ids, dtype=object)
+    start = time.perf_counter()
+    probable = bloom.might_contain(event_ids)
+    new_mask = ~probable
+    if probable.any():
+        candidates = [str(event_id) for event_id in pd.unique(event_ids[probable])]
+        db.cur.execute("SELECT event_id FROM crime_event_dimension_table WHERE event_id = ANY(%s)", (candidates,))
+        loaded = {row[0] for row in db.cur.fetchall()}
+        new_mask[probable] = ~pd.Series(event_ids[probable]).astype(str).isin(loaded).to_numpy()
+    print(f"Event Bloom filter: {int((~probable).sum())} definitely new, {int(probable.sum())} verified in the "
+          f"database ({int((probable & new_mask).sum())} false positives), {time.perf_counter() - start:.3f} seconds")
+    return new_mask
@@ -0,0 +1,195 @@
+
+import math, os, pickle, shutil, tempfile, time
+
+import numpy as np
+import pandas as pd
+
+from pipeline_config import load_section
+
+"""
+************************************  Out-of-core deduplication of event_id:  ************************************
+df.drop_duplicates(subset=['event_id'], keep='first') needs the whole crime history in memory plus a hash table over
+the event_id column. When the "external_dedup" section of config.json is enabled, etl_source_data() reads the crime
+file in chunks and deduplicates it out of core instead:
+            "external_dedup": {"enabled": true, "memory_budget_mb": 256, "chunk_rows": 100000}
+
+    1. every chunk gets the position of its rows in the input (ROW_ORDER_COLUMN) and is hash partitioned on the key
+       into spill files (one pickle stream per partition, in input order),
+    2. every partition is read back frame by frame: a row is kept when its key was not seen before in the partition,
+       so only the keys of one partition are held in memory, and the first occurrence is kept,
+    3. the kept rows of every partition are spilled again (in input order), and iter_csv_deduplicated() streams them
+       on in input order with a k-way merge of the partitions on ROW_ORDER_COLUMN, one window of chunk_rows input
+       rows at a time (optionally filtered by keep_rows), so the result is the same as drop_duplicates(keep='first')
+       and only one window plus one spilled frame per partition is in memory.
+
+read_csv_deduplicated() concatenates the stream into one dataframe, for the callers which need the whole crime
+history at once (etl_source_data()).
+
+The number of partitions is chosen so that the keys of one partition fit in the memory budget (estimated from the
+size of the input file), or set with "partitions".
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "memory_budget_mb": 256,
+    "chunk_rows": 100000,
+    "partitions": None,
+    "spill_dir": None,
+}
+
+ROW_ORDER_COLUMN = "_row_order"
+
+PARTITION_HASH_KEY = "externaldedup000"
+
+# Estimated memory of one key held in the set of seen keys, per byte of input file (a key of ~15 characters in
+# a row of ~200 bytes takes ~80 bytes as a Python string plus its set slot)
+KEY_MEMORY_PER_INPUT_BYTE = 0.6
+
+
+def external_dedup_settings():
+    """A function which returns the external_dedup settings of config.json, or None when disabled."""
+
+    settings = load_section("external_dedup", DEFAULT_SETTINGS)
+    return settings if settings["enabled"] else None
+
+
+def partition_count(input_bytes, settings):
+    if settings["partitions"]:
+        return int(settings["partitions"])
+    budget = settings["memory_budget_mb"] * 2 ** 20
+    return max(1, math.ceil(input_bytes * KEY_MEMORY_PER_INPUT_BYTE / budget))
+
+
+def key_values(frame, subset):
+    """A function which returns one hashable key per row (a tuple when the subset has several columns)."""
+
+    if len(subset) == 1:
+        return frame[subset[0]].to_numpy(dtype=object)
+    return pd.Series(list(zip(*(frame[column].to_numpy(dtype=object) for column in subset))), dtype=object).to_numpy()
+
+
+def partition_of_rows(frame, subset, partitions):
+    hashes = pd.util.hash_pandas_object(frame[subset], index=False, hash_key=PARTITION_HASH_KEY).to_numpy()
+    return (hashes % np.uint64(partitions)).astype(np.int64)
+
+
+def read_spill_file(path):
+    with open(path, "rb") as spill_file:
+        while True:
+            try:
+                yield pickle.load(spill_file)
+            except EOFError:
+                return
+
+
+def external_drop_duplicates(chunks, subset, settings, input_bytes=0, stats=None):
+    """A function (generator) which removes the rows whose subset columns were already seen, keeping the first
+       occurrence, with a memory use bounded by one chunk plus the keys of one partition. Yields the kept rows
+       in input order (see the module description), every frame carrying the input position of its rows
+       (ROW_ORDER_COLUMN).
+    """
+
+    subset = list(subset)
+    partitions = partition_count(input_bytes, settings)
+    spill_dir = tempfile.mkdtemp(prefix="dedup_", dir=settings["spill_dir"])
+    stats = {} if stats is None else stats
+    stats.update(partitions=partitions, rows_in=0, rows_out=0, spilled_bytes=0)
+    try:
+        # STEP#1 Hash partition the chunks into the spill files
+        spill_files = [open(os.path.join(spill_dir, f"partition_{index:04d}.pkl"), "wb") for index in range(partitions)]
+        try:
+            for frame in chunks:
+                frame = frame.reset_index(drop=True)
+                frame[ROW_ORDER_COLUMN] = np.arange(stats["rows_in"], stats["rows_in"] + len(frame), dtype=np.int64)
+                stats["rows_in"] += len(frame)
+                row_partitions = partition_of_rows(frame, subset, partitions)
+                for index, rows in frame.groupby(row_partitions, sort=False):
+                    pickle.dump(rows, spill_files[index], protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            for spill_file in spill_files:
+                stats["spilled_bytes"] += spill_file.tell()
+                spill_file.close()
+
+        # STEP#2 Deduplicate every partition, frame by frame in input order, into the kept files
+        kept_paths = [os.path.join(spill_dir, f"kept_{index:04d}.pkl") for index in range(partitions)]
+        for index in range(partitions):
+            seen = set()
+            with open(kept_paths[index], "wb") as kept_file:
+                for rows in read_spill_file(os.path.join(spill_dir, f"partition_{index:04d}.pkl")):
+                    keys = key_values(rows, subset)
+                    keep = ~pd.Series(keys).duplicated().to_numpy()
+                    if seen:
+                        keep &= ~pd.Series(keys).isin(seen).to_numpy()
+                    seen.update(keys[keep])
+                    kept_rows = rows[keep]
+                    stats["rows_out"] += len(kept_rows)
+                    if len(kept_rows):
+                        pickle.dump(kept_rows, kept_file, protocol=pickle.HIGHEST_PROTOCOL)
+                stats["spilled_bytes"] += kept_file.tell()
+            os.remove(os.path.join(spill_dir, f"partition_{index:04d}.pkl"))
+
+        # STEP#3 Merge the partitions in input order
+        yield from merge_in_input_order(kept_paths, settings["chunk_rows"], stats["rows_in"])
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def merge_in_input_order(paths, window_rows, rows_in):
+    """A function (generator) which merges spill files whose frames are sorted on ROW_ORDER_COLUMN (k-way merge):
+       every window of window_rows input positions takes the buffered rows of every file below its upper bound.
+    """
+
+    readers = [read_spill_file(path) for path in paths]
+    buffers = [None] * len(readers)
+    for bound in range(window_rows, rows_in + window_rows, window_rows):
+        window = []
+        for index, reader in enumerate(readers):
+            while True:
+                if buffers[index] is None:
+                    buffers[index] = next(reader, None)
+                    if buffers[index] is None:
+                        break
+                rows = buffers[index]
+                below = rows[ROW_ORDER_COLUMN].to_numpy() < bound
+                if below.all():
+                    window.append(rows)
+                    buffers[index] = None
+                    continue
+                window.append(rows[below])
+                buffers[index] = rows[~below]
+                break
+        window = [rows for rows in window if len(rows)]
+        if window:
+            yield pd.concat(window).sort_values(ROW_ORDER_COLUMN, kind="stable")
+
+
+def iter_csv_deduplicated(path, subset, settings, prepare=None, keep_rows=None, stats=None):
+    """A function (generator) which reads a CSV file in chunks and yields its rows without the duplicates (the
+       first occurrence is kept) in input order, without ROW_ORDER_COLUMN. prepare is applied to every chunk before
+       the deduplication (e.g. column renames), keep_rows to the deduplicated rows (e.g. filters).
+    """
+
+    chunks = pd.read_csv(path, chunksize=settings["chunk_rows"])
+    if prepare is not None:
+        chunks = (prepare(chunk) for chunk in chunks)
+    for frame in external_drop_duplicates(chunks, subset, settings, os.path.getsize(path), stats):
+        frame = frame.drop(columns=[ROW_ORDER_COLUMN])
+        if keep_rows is not None:
+            frame = keep_rows(frame)
+        if len(frame):
+            yield frame
+
+
+def read_csv_deduplicated(path, subset, settings, prepare=None, keep_rows=None):
+    """A function which returns the rows of iter_csv_deduplicated() as one dataframe, in input order."""
+
+    start = time.perf_counter()
+    stats = {}
+    frames = list(iter_csv_deduplicated(path, subset, settings, prepare, keep_rows, stats))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    del frames
+    print(f"Out-of-core deduplication of {path}: {stats['rows_in']} rows read, "
+          f"{stats['rows_in'] - stats['rows_out']} duplicates removed, {stats['partitions']} partitions, "
+          f"{stats['spilled_bytes'] / 2 ** 20:.1f} MiB spilled, {time.perf_counter() - start:.3f} seconds")
+    return df
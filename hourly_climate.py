@@ -0,0 +1,166 @@
+
+import numpy as np
+import pandas as pd
+
+"""
+************************************  Hourly climate grain (as-of join):  ************************************
+The daily climate_dimension_table collapses the hourly observations of weather_dataset/*_P1H.csv into daily
+mean/min/max. This module keeps the hourly grain:
+    - hourly_weather_frame() keeps one row per station and observed hour (climate_id, year, month, day, hour,
+      temperature, weather),
+    - build_hourly_climate_tables() creates the hourly_climate_dimension_table and hourly_climate_surrogate_table
+      dataframes,
+    - attach_hourly_climate_key() attaches to every crime the surrogate key of the nearest hourly observation of
+      its occurrence timestamp with a sorted as-of join (asof_join_indices).
+
+The as-of join sorts the crime timestamps once and merges them with the sorted observation timestamps through a
+binary search (np.searchsorted), so its cost is O((n + m) log m) vectorized instead of one lookup per crime.
+Every crime is only joined with the observations of its weather station (climate_id, see station_resolver.py): the
+station is encoded in the high part of the join key, far enough apart that no tolerance crosses two stations.
+
+Crime extracts which do not carry the occurrence hour (see CRIME_HOUR_COLUMNS) get a null hourly key.
+"""
+
+
+# Candidate names of the occurrence hour column of the crime extract (after lower casing the headers)
+CRIME_HOUR_COLUMNS = ("occurrence_hour", "occurrencehour", "occ_hour", "hour")
+
+# Maximum distance between a crime and the hourly observation attached to it
+DEFAULT_TOLERANCE_HOURS = 1
+
+# Distance (in hours) between the join keys of two stations
+STATION_KEY_STRIDE = 2 ** 40
+
+HOURLY_CLIMATE_COLUMNS = ['climate_id', 'year', 'month', 'day', 'hour', 'temperature', 'weather']
+HOURLY_CLIMATE_KEY_COLUMNS = ['climate_id', 'year', 'month', 'day', 'hour']
+
+
+def to_hour_numbers(year, month, day, hour):
+    """A function which converts date parts to the number of hours since the epoch (int64), vectorized."""
+
+    dates = pd.to_datetime(pd.DataFrame({"year": year, "month": month, "day": day}), errors="coerce")
+    hours = dates.to_numpy().astype("datetime64[h]").astype(np.int64) + np.asarray(hour, dtype=np.int64)
+    return hours
+
+
+def asof_join_indices(left_times, right_times, tolerance, direction="nearest"):
+    """A function which returns, for every left timestamp, the index of the matching right timestamp:
+       the nearest one ("nearest"), the last one before ("backward") or the first one after ("forward").
+       right_times must be sorted ascending. -1 is returned when no right timestamp is within the tolerance.
+    """
+
+    left_times = np.asarray(left_times, dtype=np.int64)
+    right_times = np.asarray(right_times, dtype=np.int64)
+    result = np.full(len(left_times), -1, dtype=np.int64)
+    if len(left_times) == 0 or len(right_times) == 0:
+        return result
+
+    # Sort the left side once, the binary search then walks both sorted arrays like a merge
+    order = np.argsort(left_times, kind="stable")
+    sorted_left = left_times[order]
+    after = np.searchsorted(right_times, sorted_left, side="left")
+    before = np.searchsorted(right_times, sorted_left, side="right") - 1
+
+    last = len(right_times) - 1
+    after_valid = after <= last
+    before_valid = before >= 0
+    after_distance = np.where(after_valid, right_times[np.minimum(after, last)] - sorted_left, np.iinfo(np.int64).max)
+    before_distance = np.where(before_valid, sorted_left - right_times[np.maximum(before, 0)], np.iinfo(np.int64).max)
+
+    if direction == "backward":
+        match, distance = before, before_distance
+    elif direction == "forward":
+        match, distance = after, after_distance
+    elif direction == "nearest":
+        # ties go to the earlier observation
+        use_before = before_distance <= after_distance
+        match = np.where(use_before, before, after)
+        distance = np.where(use_before, before_distance, after_distance)
+    else:
+        raise ValueError(f"Unknown as-of join direction: {direction}")
+
+    matched = distance <= tolerance
+    result[order[matched]] = match[matched]
+    return result
+
+
+def hourly_weather_frame(df_weather):
+    """A function which keeps the hourly grain of the cleaned weather source data
+       (columns climate_id, year, month, day, time, temperature, weather). Hours without a temperature are not
+       observations and are dropped. Returns the hourly frame sorted by timestamp.
+    """
+
+    df_hourly = df_weather.dropna(subset=['temperature']).copy()
+    # the files write the hour as HH:MM or H:MM
+    df_hourly['hour'] = df_hourly['time'].astype(str).str.split(':').str[0].astype(int)
+    df_hourly = df_hourly[HOURLY_CLIMATE_COLUMNS]
+    df_hourly = df_hourly.astype({"year": int, "month": int, "day": int})
+    df_hourly = df_hourly.sort_values(HOURLY_CLIMATE_KEY_COLUMNS).reset_index(drop=True)
+    return df_hourly
+
+
+def build_hourly_climate_tables(df_hourly):
+    """A function which creates the hourly_climate_dimension_table and hourly_climate_surrogate_table
+       dataframes from the hourly weather frame.
+    """
+
+    df_hourly_climate = df_hourly[HOURLY_CLIMATE_COLUMNS].reset_index(drop=True)
+    df_hourly_climate['temperature'] = df_hourly_climate['temperature'].round(1)
+
+    df_hourly_climate_lookup = df_hourly_climate[HOURLY_CLIMATE_KEY_COLUMNS].copy()
+    df_hourly_climate_lookup.insert(0, 'hourly_climate_surrogate_key', range(1, len(df_hourly_climate_lookup) + 1))
+    return df_hourly_climate, df_hourly_climate_lookup
+
+
+def find_hour_column(columns):
+    for column_name in CRIME_HOUR_COLUMNS:
+        if column_name in columns:
+            return column_name
+    return None
+
+
+def station_join_keys(climate_ids, hour_numbers, stations):
+    """A function which builds the as-of join key of observations or crimes: the position of their station in
+       the sorted station array times STATION_KEY_STRIDE, plus their hour number. The key is -1 for a station
+       which is not in the array (no hourly observation).
+    """
+
+    climate_ids = np.asarray(climate_ids).astype(str)
+    station_codes = np.minimum(np.searchsorted(stations, climate_ids), max(len(stations) - 1, 0))
+    known = stations[station_codes] == climate_ids if len(stations) else np.zeros(len(climate_ids), dtype=bool)
+    keys = station_codes.astype(np.int64) * STATION_KEY_STRIDE + np.asarray(hour_numbers, dtype=np.int64)
+    return np.where(known, keys, -1)
+
+
+def attach_hourly_climate_key(df, df_hourly_climate_lookup, tolerance_hours=DEFAULT_TOLERANCE_HOURS):
+    """A function which adds the hourly_climate_surrogate_key column to the crime dataframe: the key of the
+       nearest hourly observation of its station at the occurrence timestamp (null when none is within the
+       tolerance or when the crime extract has no occurrence hour).
+    """
+
+    df = df.copy()
+    hour_column = find_hour_column(df.columns)
+    if hour_column is None or len(df_hourly_climate_lookup) == 0:
+        print("No occurrence hour in the crime data: hourly_climate_surrogate_key is left empty")
+        df['hourly_climate_surrogate_key'] = pd.array([pd.NA] * len(df), dtype="Int64")
+        return df
+
+    crime_hours = pd.to_numeric(df[hour_column], errors="coerce")
+    crime_times = to_hour_numbers(df['year'], df['month'], df['day'], crime_hours.fillna(0))
+    observation_times = to_hour_numbers(df_hourly_climate_lookup['year'], df_hourly_climate_lookup['month'],
+                                        df_hourly_climate_lookup['day'], df_hourly_climate_lookup['hour'])
+
+    stations = np.unique(df_hourly_climate_lookup['climate_id'].astype(str))
+    crime_keys = station_join_keys(df['climate_id'], crime_times, stations)
+    observation_keys = station_join_keys(df_hourly_climate_lookup['climate_id'], observation_times, stations)
+    order = np.argsort(observation_keys, kind="stable")
+
+    match = asof_join_indices(crime_keys, observation_keys[order], tolerance_hours)
+    match = np.where(match >= 0, order[np.maximum(match, 0)], -1)
+    match[crime_hours.isna().to_numpy() | (crime_keys < 0)] = -1
+
+    keys = df_hourly_climate_lookup['hourly_climate_surrogate_key'].to_numpy()
+    hourly_keys = pd.array(np.where(match >= 0, keys[np.maximum(match, 0)], 0), dtype="Int64")
+    hourly_keys[match < 0] = pd.NA
+    df['hourly_climate_surrogate_key'] = hourly_keys
+    return df
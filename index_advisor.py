@@ -0,0 +1,249 @@
+
+import json, os, time
+
+from pipeline_config import load_section
+
+"""
+************************************  Workload-driven index advisor for fact_table:  ************************************
+After etl_fact_table() the fact table only has its four-column primary key (date, event, climate, neighbourhood), so
+a join from the neighbourhood or climate dimension scans the whole fact table. When the "index_advisor" section of
+config.json is enabled, finalize_load() measures the analytical queries of WORKLOAD_QUERIES (and the "queries" of the
+section) and tries the CANDIDATE_INDEXES one by one:
+            "index_advisor": {"enabled": true, "create": true, "min_speedup": 1.2}
+
+    1. fact_table is vacuumed and analyzed (the visibility map lets the covering indexes answer with index-only
+       scans), and every query is timed with EXPLAIN (ANALYZE, FORMAT JSON) (best execution time of repeat runs),
+    2. every candidate is created in one explicit transaction (BEGIN, DbConnection runs in autocommit), fact_table
+       is analyzed and the queries are timed again. The candidate is kept when the plan of a query uses it and that
+       query runs min_speedup times faster than with the indexes kept so far, otherwise it is dropped. The BRIN
+       index on date_surrogate_key is only tried when the fact rows are stored in date order (pg_stats correlation
+       >= brin_min_correlation),
+    3. with "create": true the transaction is committed (the kept indexes stay), otherwise it is rolled back and the
+       kept indexes are only proposed.
+
+The before/after time of every query, the indexes kept with their size and the reason of every decision are printed
+and written to index_reports/<run_id>.json. Without config.json the advisor runs on an already loaded warehouse with:
+            python index_advisor.py [create]
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "create": True,
+    "min_speedup": 1.2,
+    "brin_min_correlation": 0.9,
+    "repeat": 3,
+    "queries": {},
+    "report_dir": "index_reports",
+}
+
+# Representative analytical queries: name -> SQL (a dimension filter joined to the fact table)
+WORKLOAD_QUERIES = {
+    "crimes per day of one month": """
+        select d.day, count(*), avg(f.temperature_mean)
+        from fact_table f join date_surrogate_table d on d.date_surrogate_key = f.date_surrogate_key
+        where d.year = 2019 and d.month = 7
+        group by d.day""",
+    "crimes of a date key range": """
+        select count(*), avg(f.temperature_mean), max(f.crime_number)
+        from fact_table f
+        where f.date_surrogate_key between (select min(date_surrogate_key) + 100 from date_surrogate_table)
+                                      and (select min(date_surrogate_key) + 130 from date_surrogate_table)""",
+    "crimes of one neighbourhood per year": """
+        select d.year, count(*)
+        from fact_table f
+        join neighbourhood_surrogate_table n on n.neighbourhood_surrogate_key = f.neighbourhood_surrogate_key
+        join date_surrogate_table d on d.date_surrogate_key = f.date_surrogate_key
+        where n.hood_id = (select min(hood_id) from neighbourhood_surrogate_table)
+        group by d.year""",
+    "crimes of one station in a year": """
+        select cs.month, count(*), avg(f.temperature_mean)
+        from fact_table f join climate_surrogate_table cs on cs.climate_surrogate_key = f.climate_surrogate_key
+        where cs.climate_id = (select min(climate_id) from climate_surrogate_table) and cs.year = 2019
+        group by cs.month""",
+    "daily crimes and temperature of one neighbourhood": """
+        select f.date_surrogate_key, max(f.crime_number), avg(f.temperature_mean)
+        from fact_table f
+        where f.neighbourhood_surrogate_key = (select min(neighbourhood_surrogate_key)
+                                               from neighbourhood_surrogate_table)
+        group by f.date_surrogate_key""",
+}
+
+# Candidate indexes, tried in this order: (index name, kind, definition). date_surrogate_key already has the B-tree
+# of the primary key (its leading column)
+CANDIDATE_INDEXES = [
+    ("fact_table_neighbourhood_key_index", "btree", "ON fact_table (neighbourhood_surrogate_key)"),
+    ("fact_table_climate_key_index", "btree", "ON fact_table (climate_surrogate_key)"),
+    ("fact_table_date_key_brin", "brin", "ON fact_table USING brin (date_surrogate_key)"),
+    ("fact_table_neighbourhood_date_covering", "covering",
+     "ON fact_table (neighbourhood_surrogate_key, date_surrogate_key) INCLUDE (crime_number, temperature_mean)"),
+]
+
+
+def index_advisor_settings():
+    """A function which returns the index_advisor settings of config.json, or None when disabled."""
+
+    settings = load_section("index_advisor", DEFAULT_SETTINGS)
+    return settings if settings["enabled"] else None
+
+
+def vacuum_analyze(db, table_name="fact_table"):
+    """A function which runs VACUUM ANALYZE (it can not run inside a transaction block)."""
+
+    db.raw_conn.commit()
+    autocommit = db.raw_conn.autocommit
+    db.raw_conn.autocommit = True
+    try:
+        db.cur.execute(f"VACUUM ANALYZE {table_name}")
+    finally:
+        db.raw_conn.autocommit = autocommit
+
+
+def plan_indexes(plan):
+    """A function which returns the names of the indexes used by an EXPLAIN (FORMAT JSON) plan."""
+
+    names = set()
+    nodes = [plan.get("Plan", {})]
+    while nodes:
+        node = nodes.pop()
+        if "Index Name" in node:
+            names.add(node["Index Name"])
+        nodes.extend(node.get("Plans", []))
+    return names
+
+
+def time_query(db, sql, repeat):
+    """A function which returns the best execution time (ms) of a query over repeat runs, and the indexes its
+       plan uses.
+    """
+
+    timings, indexes = [], set()
+    for _ in range(repeat):
+        db.cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql)
+        plan = db.cur.fetchone()[0]
+        plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]
+        timings.append(plan["Execution Time"])
+        indexes = plan_indexes(plan)
+    return min(timings), indexes
+
+
+def time_workload(db, queries, repeat):
+    return {name: time_query(db, sql, repeat) for name, sql in queries.items()}
+
+
+def index_exists(db, index_name):
+    db.cur.execute("SELECT to_regclass(%s) IS NOT NULL", (index_name,))
+    return db.cur.fetchone()[0]
+
+
+def date_key_correlation(db):
+    """A function which returns the correlation between the physical order of fact_table and date_surrogate_key."""
+
+    db.cur.execute("""SELECT correlation FROM pg_stats
+                        WHERE tablename = 'fact_table' AND attname = 'date_surrogate_key'""")
+    row = db.cur.fetchone()
+    return row[0] if row and row[0] is not None else 0.0
+
+
+def try_candidate(db, index_name, definition, queries, best, settings):
+    """A function which creates one candidate, times the queries and keeps it when it speeds up a query whose plan
+       uses it (see the module description). Returns (kept, reason, timings with the candidate).
+    """
+
+    start = time.perf_counter()
+    db.cur.execute(f"CREATE INDEX {index_name} {definition}")
+    db.cur.execute("ANALYZE fact_table")
+    build_seconds = time.perf_counter() - start
+    timings = time_workload(db, queries, settings["repeat"])
+
+    gains = {name: best[name][0] / max(milliseconds, 1e-3)
+             for name, (milliseconds, indexes) in timings.items() if index_name in indexes}
+    if not gains:
+        reason = "not used by any query"
+    else:
+        name = max(gains, key=gains.get)
+        reason = f"{name}: {best[name][0]:.2f} ms -> {timings[name][0]:.2f} ms (x{gains[name]:.2f}), " \
+                 f"built in {build_seconds:.2f} s"
+        if gains[name] >= settings["min_speedup"]:
+            return True, reason, timings
+    db.cur.execute(f"DROP INDEX {index_name}")
+    db.cur.execute("ANALYZE fact_table")
+    return False, reason, timings
+
+
+def advise_indexes(db, settings=None):
+    """A function which measures the workload, tries the candidate indexes and keeps (or proposes) the ones which
+       pay off. It does nothing when the advisor is disabled. Returns the report.
+    """
+
+    settings = settings or index_advisor_settings()
+    if settings is None:
+        return None
+
+    queries = dict(WORKLOAD_QUERIES, **settings["queries"])
+    vacuum_analyze(db)
+    before = time_workload(db, queries, settings["repeat"])
+    best = dict(before)
+
+    # the candidates are only kept by the COMMIT: the connection is in autocommit, every CREATE INDEX would
+    # otherwise be committed at once
+    db.cur.execute("BEGIN")
+    try:
+        decisions = []
+        for index_name, kind, definition in CANDIDATE_INDEXES:
+            if index_exists(db, index_name):
+                decisions.append({"index": index_name, "kind": kind, "kept": True, "reason": "already exists"})
+                continue
+            if kind == "brin":
+                correlation = date_key_correlation(db)
+                if abs(correlation) < settings["brin_min_correlation"]:
+                    decisions.append({"index": index_name, "kind": kind, "kept": False,
+                                      "reason": f"fact rows not in date order (correlation {correlation:.2f})"})
+                    continue
+            kept, reason, timings = try_candidate(db, index_name, definition, queries, best, settings)
+            if kept:
+                best = timings
+            decisions.append({"index": index_name, "kind": kind, "kept": kept, "reason": reason})
+
+        kept_names = [decision["index"] for decision in decisions if decision["kept"]]
+        db.cur.execute("SELECT relname, pg_relation_size(oid) FROM pg_class WHERE relname = ANY(%s)", (kept_names,))
+        sizes = dict(db.cur.fetchall())
+        db.cur.execute("COMMIT" if settings["create"] else "ROLLBACK")
+    except:
+        db.cur.execute("ROLLBACK")
+        raise
+
+    report = {
+        "run_id": time.strftime("%Y%m%d_%H%M%S"),
+        "created": settings["create"],
+        "queries": [{"query": name, "before_ms": before[name][0], "after_ms": best[name][0],
+                     "speedup": before[name][0] / max(best[name][0], 1e-3), "indexes": sorted(best[name][1])}
+                    for name in queries],
+        "indexes": [dict(decision, size_bytes=sizes.get(decision["index"])) for decision in decisions],
+    }
+    print_report(report)
+    os.makedirs(settings["report_dir"], exist_ok=True)
+    with open(os.path.join(settings["report_dir"], f"{report['run_id']}.json"), "w") as report_file:
+        json.dump(report, report_file, indent=1)
+    return report
+
+
+def print_report(report):
+    print(f"{'query':52} {'before ms':>10} {'after ms':>10} {'speedup':>8}  indexes")
+    for query in report["queries"]:
+        print(f"{query['query']:52} {query['before_ms']:10.2f} {query['after_ms']:10.2f} "
+              f"{query['speedup']:8.2f}  {', '.join(query['indexes'])}")
+    action = "created" if report["created"] else "proposed"
+    for decision in report["indexes"]:
+        state = action if decision["kept"] else "rejected"
+        size = f" ({decision['size_bytes'] / 2 ** 20:.1f} MiB)" if decision.get("size_bytes") else ""
+        print(f"{decision['index']}{size} {state}: {decision['reason']}")
+
+
+if __name__ == "__main__":
+    import sys
+    from A02_Team_V04 import DbConnection
+
+    with DbConnection() as db:
+        advise_indexes(db, dict(load_section("index_advisor", DEFAULT_SETTINGS), enabled=True,
+                                create="create" in sys.argv[1:]))
@@ -0,0 +1,388 @@
+
+import os, re, time
+from concurrent.futures import ProcessPoolExecutor
+
+from pipeline_config import load_section
+
+"""
+************************************  Partition-parallel load:  ************************************
+The crime and weather data are naturally partitioned by year (and the weather files by month). When the
+"parallel_etl" section of config.json is enabled, etl_source_data() splits its input by year (or month) and runs the
+per-partition work of the whole load in worker processes:
+            "parallel_etl": {"enabled": true, "workers": 4, "partition": "year"}
+
+    1. the parent reads the crime file once, removes the duplicated event_id (over the whole file, so the first
+       occurrence is kept like the serial load), keeps 2017-2020 and splits the crimes by partition,
+    2. every worker (clean_partition) reads the weather files of its partition (weather_YYYY-MM_*.csv, a file
+       without a date in its name is read by every worker and filtered), cleans and aggregates them
+       (transform_weather_source) and cleans its crimes (NSA resolution, normalize_frame),
+    3. the parent merges the weather stations of the partitions (one row per climate_id, ordered by number of
+       observations) and attaches every neighbourhood to its nearest station over all the crimes
+       (station_of_hoods), so a neighbourhood gets the same station as in the serial load, whatever its partition,
+    4. every worker (join_partition) attaches the station and the nearest hourly observation to every crime of its
+       partition, then builds the date, crime event and climate dimensions of the partition and its fact rows
+       (build_partition_star). A day, an event and a station-day belong to one partition only, so the dimensions
+       of the partitions do not overlap and the crime_number of a day is counted within its partition,
+    5. the final merge (merge_partitions) shifts the surrogate keys of every partition (numbered from 1 by the
+       worker) into one block per partition and key, reserved with the KeyAllocator of surrogate_keys.py,
+    6. the parent loads the tables of the extract stage, with the column statistics and compact dtypes of the serial
+       load (see column_statistics.py, the raw weather files are not profiled: no process holds all of them),
+       merges the neighbourhoods into the versioned neighbourhood_dimension_table (SCD type 2 needs the database,
+       the fact rows keep their hood_id until then), loads the dimensions, the sketches and the fact table with
+       the keys and constraints of the serial stages. crime_weather_source_table is not written, the dims and fact
+       stages have nothing left to do.
+
+The partitions share nothing while they run (no database access in the workers), so the load scales with the number
+of cores up to the number of partitions. The surrogate keys differ from the serial load (the event keys are ordered
+by event_id within a partition), the rows and the references do not.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "workers": None,
+    "partition": "year",
+}
+
+WEATHER_FILE_DATE = re.compile(r"(\d{4})-(\d{2})")
+
+DATE_DIMENSION_COLUMNS = ['year', 'month', 'day', 'day_of_year', 'day_of_week']
+EVENT_DIMENSION_COLUMNS = ['event_id', 'crime_type', 'year', 'month', 'day', 'day_of_year', 'day_of_week',
+                           'location_type']
+PARTITION_FACT_COLUMNS = ['date_surrogate_key', 'event_surrogate_key', 'climate_surrogate_key', 'hood_id',
+                          'crime_number', 'temperature_mean', 'temperature_min', 'temperature_max',
+                          'hourly_climate_surrogate_key', 'temperature_band_key', 'weather_condition_mask']
+
+# surrogate key numbered by every partition: the frames holding it (its lookup first)
+PARTITION_KEYS = {
+    "hourly_climate_surrogate_key": ["hourly_climate_lookup", "crime_weather", "fact"],
+    "date_surrogate_key": ["date_lookup", "fact"],
+    "event_surrogate_key": ["event_lookup", "fact"],
+    "climate_surrogate_key": ["climate_lookup", "fact"],
+}
+
+# frames of the partitions concatenated by merge_partitions()
+PARTITION_FRAMES = ["crime", "crime_weather", "weather", "hourly_climate", "hourly_climate_lookup", "date",
+                    "date_lookup", "event", "event_lookup", "climate", "climate_lookup", "fact"]
+
+
+def parallel_etl_settings():
+    """A function which returns the parallel_etl settings of config.json, or None when disabled."""
+
+    settings = load_section("parallel_etl", DEFAULT_SETTINGS)
+    return settings if settings["enabled"] else None
+
+
+def partition_key(year, month, partition):
+    return (int(year), int(month)) if partition == "month" else (int(year),)
+
+
+def split_crimes(df, partition):
+    """A function which splits the cleaned crime rows by year (or year and month) of occurrence."""
+
+    from crime_normalization import MONTH_MAP
+
+    keys = [df['occurrence_year'].astype(int)]
+    if partition == "month":
+        keys.append(df['occurrence_month'].astype(str).str.strip().str.lower().map(MONTH_MAP))
+    return {key if isinstance(key, tuple) else (key,): rows for key, rows in df.groupby(keys, sort=True)}
+
+
+def weather_files_of(key, weather_dir):
+    """A function which returns the weather files of a partition (files without a date belong to every partition)."""
+
+    paths = []
+    for file_name in sorted(os.listdir(weather_dir)):
+        match = WEATHER_FILE_DATE.search(file_name)
+        if match is None or partition_key(match.group(1), match.group(2), "month")[:len(key)] == key:
+            paths.append(os.path.join(weather_dir, file_name))
+    return paths
+
+
+def clean_partition(key, df, weather_paths, partition):
+    """A function (run in a worker process) which cleans the weather and the crimes of one partition.
+       Returns a dictionary of the partition frames and its wall time.
+    """
+
+    import pandas as pd
+    from A02_Team_V04 import transform_weather_source
+    from crime_normalization import CRIME_NORMALIZATION_SPEC, normalize_frame
+    from spatial_resolver import load_resolver, resolve_nsa_neighbourhoods
+
+    start = time.perf_counter()
+
+    # Weather of the partition (the rows of the files are filtered, a file may hold other dates)
+    if not weather_paths:
+        raise ValueError(f"no weather file for the partition {key}")
+    df_weather = pd.concat([pd.read_csv(path, dtype={"Climate ID": str}) for path in weather_paths],
+                           axis=0, ignore_index=True)
+    in_partition = df_weather['Year'].astype(int) == key[0]
+    if partition == "month":
+        in_partition &= df_weather['Month'].astype(int) == key[1]
+    df_weather, df_stations, df_weather_hourly = transform_weather_source(df_weather[in_partition].copy())
+
+    # Crimes of the partition
+    resolver, resolver_settings = load_resolver()
+    if resolver is not None:
+        df = resolve_nsa_neighbourhoods(df, resolver, resolver_settings)
+    df, _ = normalize_frame(df, CRIME_NORMALIZATION_SPEC)
+
+    return {"key": key, "crime": df, "weather": df_weather, "weather_hourly": df_weather_hourly,
+            "stations": df_stations, "station_observations": df_weather_hourly['climate_id'].value_counts(),
+            "seconds": time.perf_counter() - start}
+
+
+def join_partition(key, df, station_of_hood, df_weather, df_weather_hourly):
+    """A function (run in a worker process) which attaches the station (station_of_hood: hood_id -> climate_id,
+       computed over all the crimes) and the hourly observation to every crime of one partition, then builds its
+       dimensions and fact rows (build_partition_star). Returns a dictionary of the partition frames and its wall
+       time.
+    """
+
+    import pandas as pd
+    from hourly_climate import attach_hourly_climate_key, build_hourly_climate_tables
+
+    start = time.perf_counter()
+    df = df.copy()
+    df['climate_id'] = df['hood_id'].map(station_of_hood)
+    df_hourly_climate, df_hourly_climate_lookup = build_hourly_climate_tables(df_weather_hourly)
+    df = attach_hourly_climate_key(df, df_hourly_climate_lookup)
+    df_merge = pd.merge(df, df_weather, on=['climate_id', 'year', 'month', 'day'], how='left')
+
+    frames = build_partition_star(df_merge)
+
+    return dict(frames, key=key, crime_weather=df_merge, hourly_climate=df_hourly_climate,
+                hourly_climate_lookup=df_hourly_climate_lookup, seconds=time.perf_counter() - start)
+
+
+def build_partition_star(df_merge):
+    """A function (run in a worker process) which builds the date, crime event and climate dimensions of one
+       partition, their lookups (keys numbered from 1) and the fact rows of its crimes. The fact rows keep the
+       hood_id: the neighbourhood keys are given by the parent (see load_source_data_parallel).
+    """
+
+    import pandas as pd
+    from A02_Team_V04 import climate_dimension_frame
+
+    date_columns = ['year', 'month', 'day']
+    climate_columns = ['climate_id', 'year', 'month', 'day']
+
+    # the date dimension and its keys, ordered by date like etl_crime_date_data()
+    df_date = df_merge[DATE_DIMENSION_COLUMNS].drop_duplicates(subset=date_columns).sort_values(date_columns)
+    df_date_lookup = df_date[date_columns].reset_index(drop=True)
+    df_date_lookup.insert(0, 'date_surrogate_key', range(1, len(df_date_lookup) + 1))
+
+    # the crime event dimension and its keys, ordered by event_id
+    df_event = df_merge[EVENT_DIMENSION_COLUMNS].drop_duplicates(subset=['event_id']).sort_values('event_id')
+    df_event_lookup = df_event[['event_id']].reset_index(drop=True)
+    df_event_lookup.insert(0, 'event_surrogate_key', range(1, len(df_event_lookup) + 1))
+
+    # the climate dimension (with its temperature band and weather conditions) and its keys
+    df_climate = climate_dimension_frame(df_merge)
+    df_climate_lookup = df_climate[climate_columns].reset_index(drop=True)
+    df_climate_lookup.insert(0, 'climate_surrogate_key', range(1, len(df_climate_lookup) + 1))
+
+    # the fact rows, with the number of crimes of their day (a day belongs to one partition only)
+    df_fact = pd.merge(df_merge, df_date_lookup, on=date_columns, how='left')
+    df_fact = pd.merge(df_fact, df_event_lookup, on='event_id', how='left')
+    df_fact = pd.merge(df_fact, df_climate_lookup, on=climate_columns, how='left')
+    df_fact = pd.merge(df_fact, df_climate[climate_columns + ['temperature_band_key', 'weather_condition_mask']],
+                       on=climate_columns, how='left')
+    df_fact['crime_number'] = df_fact.groupby('date_surrogate_key')['date_surrogate_key'].transform('size')
+
+    return {"date": df_date, "date_lookup": df_date_lookup, "event": df_event, "event_lookup": df_event_lookup,
+            "climate": df_climate, "climate_lookup": df_climate_lookup, "fact": df_fact[PARTITION_FACT_COLUMNS]}
+
+
+def merge_stations(results):
+    """A function which returns one row per weather station of the partitions, ordered by number of observations
+       over all the partitions (like weather_stations() over the whole weather data).
+    """
+
+    import pandas as pd
+
+    observations = pd.concat([result["station_observations"] for result in results]).groupby(level=0).sum()
+    df_stations = pd.concat([result["stations"] for result in results]).drop_duplicates('climate_id')
+    df_stations = df_stations.set_index('climate_id').loc[observations.sort_values(ascending=False, kind="stable").index]
+    return df_stations.rename_axis('climate_id').reset_index()
+
+
+def station_of_hoods(df, df_stations):
+    """A function which returns the hood_id -> climate_id mapping of the nearest stations, computed over all the
+       crimes (the centroid of a neighbourhood does not depend on the partitions).
+    """
+
+    from spatial_resolver import load_resolver
+    from station_resolver import assign_nearest_station
+
+    resolver, resolver_settings = load_resolver()
+    _, df_centroids = assign_nearest_station(df[['hood_id'] + [column for column in (
+        resolver_settings["longitude_column"], resolver_settings["latitude_column"]) if column in df.columns]],
+        df_stations, resolver_settings["longitude_column"], resolver_settings["latitude_column"], resolver)
+    return df_centroids.set_index('hood_id')['climate_id']
+
+
+def consecutive_keys():
+    """A function which returns an allocate(key_name, count) function numbering every key from 1 without the
+       database (the keys of a partition follow the keys of the partitions before it).
+    """
+
+    import numpy as np
+
+    next_keys = {}
+
+    def allocate(key_name, count):
+        first_key = next_keys.get(key_name, 1)
+        next_keys[key_name] = first_key + count
+        return np.arange(first_key, first_key + count, dtype=np.int64)
+
+    return allocate
+
+
+def merge_partitions(results, allocate=None):
+    """A function which concatenates the partitions in key order and shifts the surrogate keys of every partition
+       (numbered from 1) into the consecutive keys allocate(key_name, count) returns for it (consecutive_keys()
+       when None). Returns the frames of the load.
+    """
+
+    import pandas as pd
+
+    allocate = allocate or consecutive_keys()
+    results = sorted(results, key=lambda result: result["key"])
+    for key_name, frame_names in PARTITION_KEYS.items():
+        for result in results:
+            keys = allocate(key_name, len(result[frame_names[0]]))
+            shift = int(keys[0]) - 1 if len(keys) else 0
+            for frame_name in frame_names:
+                result[frame_name][key_name] += shift
+
+    frames = {frame_name: pd.concat([result[frame_name] for result in results], ignore_index=True)
+              for frame_name in PARTITION_FRAMES}
+    frames["stations"] = merge_stations(results)
+    return frames
+
+
+def run_partitions(df, settings, allocate=None, weather_dir="weather_dataset"):
+    """A function which runs every partition in the process pool and merges them (see the module description)."""
+
+    import pandas as pd
+
+    partitions = split_crimes(df, settings["partition"])
+    workers = settings["workers"] or os.cpu_count()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(workers, len(partitions)) or 1) as pool:
+        futures = [pool.submit(clean_partition, key, rows, weather_files_of(key, weather_dir), settings["partition"])
+                   for key, rows in partitions.items()]
+        results = [future.result() for future in futures]
+
+        # the nearest station of every neighbourhood, over the crimes and the stations of all the partitions
+        station_of_hood = station_of_hoods(pd.concat([result["crime"] for result in results], ignore_index=True),
+                                           merge_stations(results))
+
+        futures = [pool.submit(join_partition, result["key"], result["crime"], station_of_hood, result["weather"],
+                               result["weather_hourly"]) for result in results]
+        for result, future in zip(results, futures):
+            joined = future.result()
+            result["seconds"] += joined.pop("seconds")
+            result.update(joined)
+    wall_seconds = time.perf_counter() - start
+
+    for result in sorted(results, key=lambda result: result["key"]):
+        print(f"Partition {'-'.join(str(part) for part in result['key'])}: {len(result['crime_weather'])} crimes, "
+              f"{result['seconds']:.3f} seconds")
+    work_seconds = sum(result["seconds"] for result in results)
+    print(f"{len(results)} partitions on {workers} workers: {wall_seconds:.3f} seconds "
+          f"({work_seconds:.3f} seconds of partition work, speedup {work_seconds / wall_seconds:.2f})")
+    return merge_partitions(results, allocate)
+
+
+def load_dimension_tables(db, dimension_table, df_dimension, surrogate_table, df_lookup):
+    """A function which loads a dimension table and its surrogate table (the key first, then the columns it
+       points to) with the constraints of etl_crime_date_data().
+    """
+
+    from warehouse_schema import create_table
+
+    key_columns = ", ".join(df_lookup.columns[1:])
+    create_table(db, dimension_table)
+    df_dimension.to_sql(dimension_table, con=db.engine, if_exists="append", index=False)
+    db.cur.execute(f"alter table {dimension_table} add primary key ({key_columns})")
+
+    create_table(db, surrogate_table)
+    df_lookup.to_sql(surrogate_table, con=db.engine, if_exists="append", index=False)
+    db.cur.execute(f"alter table {surrogate_table} add primary key ({df_lookup.columns[0]})")
+    db.cur.execute(f"""alter table {surrogate_table}
+                        ADD FOREIGN KEY ({key_columns})
+                        REFERENCES {dimension_table} ({key_columns})
+                        ON DELETE CASCADE""")
+    db.raw_conn.commit()
+
+
+def load_source_data_parallel(db, df, settings):
+    """A function which runs the load partition by partition and loads the tables of the extract, dims and fact
+       stages (see the module description). df holds the deduplicated crimes of 2017-2020 with lower case columns.
+    """
+
+    from A02_Team_V04 import add_foreign_keys, load_climate_tables, load_neighbourhood_tables
+    from approximate_query import maintain_sketches
+    from bitmap_index import refresh_bitmap_index
+    from column_statistics import compact_dtypes, record_profile
+    from surrogate_keys import KeyAllocator
+    from warehouse_schema import create_table
+
+    # every partition gets one block of every key, right after the block of the partition before it
+    allocators = {key_name: KeyAllocator(db, key_name, block_size=1, reset=True) for key_name in PARTITION_KEYS}
+    try:
+        frames = run_partitions(df, settings, lambda key_name, count: allocators[key_name].allocate(count))
+    finally:
+        for allocator in allocators.values():
+            allocator.close()
+
+    # the column statistics and compact dtypes of the serial load (see column_statistics.py)
+    crime_profile = record_profile(db, frames["crime"], "crime_source_table")
+    weather_profile = record_profile(db, frames["weather"], "weather_source_table")
+    frames["crime"] = compact_dtypes(frames["crime"], crime_profile)
+    frames["weather"] = compact_dtypes(frames["weather"], weather_profile)
+    frames["crime_weather"] = compact_dtypes(compact_dtypes(frames["crime_weather"], weather_profile), crime_profile)
+
+    # STEP#1 the tables of the extract stage
+    frames["crime"].to_sql("crime_source_table", con=db.engine, if_exists="replace", index=False)
+    frames["weather"].to_sql("weather_source_table", con=db.engine, if_exists="append", index=False)
+
+    create_table(db, "weather_station_table")
+    frames["stations"].to_sql("weather_station_table", con=db.engine, if_exists="append", index=False)
+    db.cur.execute("ALTER TABLE weather_station_table ADD PRIMARY KEY(climate_id);")
+    db.raw_conn.commit()
+
+    create_table(db, "hourly_climate_dimension_table")
+    frames["hourly_climate"].to_sql("hourly_climate_dimension_table", con=db.engine, if_exists="append", index=False)
+    db.cur.execute("ALTER TABLE hourly_climate_dimension_table ADD PRIMARY KEY(climate_id,year,month,day,hour);")
+    db.raw_conn.commit()
+    create_table(db, "hourly_climate_surrogate_table")
+    frames["hourly_climate_lookup"].to_sql("hourly_climate_surrogate_table", con=db.engine, if_exists="append",
+                                           index=False)
+    db.cur.execute("ALTER TABLE hourly_climate_surrogate_table ADD PRIMARY KEY(hourly_climate_surrogate_key);")
+    db.cur.execute(
+        "ALTER TABLE hourly_climate_surrogate_table ADD CONSTRAINT hourly_climate_foreign_key FOREIGN KEY (climate_id,year,month,day,hour) REFERENCES hourly_climate_dimension_table(climate_id,year,month,day,hour);")
+    db.raw_conn.commit()
+
+    # STEP#2 the dimensions: the neighbourhoods are versioned in the database over the crimes of all the partitions
+    df_neighbourhood_lookup = load_neighbourhood_tables(db, frames["crime_weather"])
+    frames["fact"]['neighbourhood_surrogate_key'] = frames["fact"].pop('hood_id').map(
+        df_neighbourhood_lookup.set_index('hood_id')['neighbourhood_surrogate_key'])
+
+    load_dimension_tables(db, "date_dimension_table", frames["date"], "date_surrogate_table", frames["date_lookup"])
+    load_dimension_tables(db, "crime_event_dimension_table", frames["event"], "crime_event_surrogate_table",
+                          frames["event_lookup"])
+    load_climate_tables(db, frames["climate"], frames["climate_lookup"])
+
+    # STEP#3 the fact table, with the optional approximate-query sketches and bitmap index
+    maintain_sketches(db, frames["crime_weather"])
+    create_table(db, "fact_table")
+    frames["fact"].to_sql("fact_table", con=db.engine, if_exists="append", index=False)
+    db.cur.execute("""ALTER TABLE fact_table ADD PRIMARY KEY
+                        (date_surrogate_key, event_surrogate_key, climate_surrogate_key, neighbourhood_surrogate_key);""")
+    db.raw_conn.commit()
+    add_foreign_keys()
+    refresh_bitmap_index(db, rebuild=True)
+    return frames
@@ -0,0 +1,231 @@
+
+import os, shutil, time
+
+import numpy as np
+import pandas as pd
+
+from pipeline_config import load_section
+
+"""
+************************************  Partitioned Parquet export of the star schema:  ************************************
+When the "parquet_export" section of config.json is enabled, main() exports the warehouse to Parquet files after
+etl_fact_table():
+            "parquet_export": {"enabled": true, "path": "parquet_export"}
+
+    parquet_export/fact_table/year=2019/month=03/part-0.parquet     fact_table partitioned by year/month
+    parquet_export/<dimension or surrogate table>.parquet           one file per dimension and surrogate table
+
+The fact files carry the day and hood_id of every crime (joined from date_surrogate_table and
+neighbourhood_surrogate_table), are sorted by hood_id then day, and are written in row groups of row_group_size rows
+with dictionary encoding and min/max statistics, so the row groups cover narrow hood_id ranges.
+
+ParquetStarReader reads the export back with partition pruning and predicate pushdown:
+            reader = ParquetStarReader("parquet_export")
+            reader.read_fact(date_from="2018-01-01", date_to="2019-12-31", hood_ids=[1, 75])
+            reader.last_scan                          files and row groups read / skipped by the last query
+Only the year/month directories inside the date range are opened, and only the row groups whose day and hood_id
+statistics can match are read. pyarrow is an optional dependency, imported when the export or the reader is used.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "path": "parquet_export",
+    "row_group_size": 50000,
+    "compression": "snappy",
+}
+
+FACT_DIRECTORY = "fact_table"
+PARTITION_COLUMNS = ['year', 'month']
+
+FACT_EXPORT_QUERY = """select f.*, d.year, d.month, d.day, n.hood_id
+                        from fact_table f
+                        join date_surrogate_table d on d.date_surrogate_key = f.date_surrogate_key
+                        join neighbourhood_surrogate_table n on n.neighbourhood_surrogate_key = f.neighbourhood_surrogate_key
+                        order by d.year, d.month, n.hood_id, d.day"""
+
+DIMENSION_TABLES = ['date_dimension_table', 'date_surrogate_table',
+                    'crime_event_dimension_table', 'crime_event_surrogate_table',
+                    'climate_dimension_table', 'climate_surrogate_table', 'weather_station_table',
+                    'hourly_climate_dimension_table', 'hourly_climate_surrogate_table',
+                    'neighbourhood_dimension_table', 'neighbourhood_surrogate_table',
+                    'temperature_band_dimension_table', 'weather_condition_dimension_table',
+                    'weather_condition_set_table', 'weather_condition_bridge_table']
+
+
+def import_pyarrow():
+    """A function which imports pyarrow lazily (optional dependency of the Parquet export)."""
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The Parquet export needs pyarrow: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def partition_path(root, year, month):
+    return os.path.join(root, FACT_DIRECTORY, f"year={int(year)}", f"month={int(month):02d}")
+
+
+def read_table(db, query):
+    db.cur.execute(query)
+    return pd.DataFrame(db.cur.fetchall(), columns=[col[0] for col in db.cur.description])
+
+
+def write_parquet(df, path, settings):
+    pa, pq = import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path, row_group_size=settings["row_group_size"], compression=settings["compression"],
+                   use_dictionary=True, write_statistics=True)
+
+
+def export_star_schema(db=None):
+    """A function which exports fact_table (partitioned by year/month) and every dimension table to Parquet.
+       It does nothing when the parquet_export section of config.json is disabled.
+    """
+
+    settings = load_section("parquet_export", DEFAULT_SETTINGS)
+    if not settings["enabled"]:
+        return None
+    if db is None:
+        from A02_Team_V04 import DbConnection
+        with DbConnection() as db:
+            return export_star_schema(db)
+
+    start = time.perf_counter()
+    root = settings["path"]
+    # Every export is a full snapshot: the previous fact partitions are removed first
+    shutil.rmtree(os.path.join(root, FACT_DIRECTORY), ignore_errors=True)
+
+    df_fact = read_table(db, FACT_EXPORT_QUERY)
+    partitions = 0
+    for (year, month), df_partition in df_fact.groupby(PARTITION_COLUMNS, sort=True):
+        directory = partition_path(root, year, month)
+        os.makedirs(directory, exist_ok=True)
+        df_partition = df_partition.drop(columns=PARTITION_COLUMNS).sort_values(['hood_id', 'day'], kind="stable")
+        write_parquet(df_partition, os.path.join(directory, "part-0.parquet"), settings)
+        partitions += 1
+
+    for table_name in DIMENSION_TABLES:
+        write_parquet(read_table(db, f"select * from {table_name}"), os.path.join(root, table_name + ".parquet"),
+                      settings)
+
+    print(f"Parquet export: {len(df_fact)} fact rows in {partitions} partitions and {len(DIMENSION_TABLES)} "
+          f"dimension tables written to {root} in {time.perf_counter() - start:.3f} seconds")
+    return root
+
+
+def statistics_range(row_group, column_index):
+    """A function which returns the (min, max) statistics of a column chunk, None when they are missing."""
+
+    statistics = row_group.column(column_index).statistics
+    if statistics is None or not statistics.has_min_max:
+        return None
+    return statistics.min, statistics.max
+
+
+class ParquetStarReader:
+    """
+    The class ParquetStarReader reads the Parquet export with partition pruning and row-group predicate
+    pushdown on the date and the neighbourhood (see the module description).
+    """
+
+    def __init__(self, root=DEFAULT_SETTINGS["path"]):
+        self.root = root
+        self.last_scan = {}
+
+    def partitions(self):
+        """A function which lists the (year, month, path) of every fact partition."""
+
+        partitions = []
+        fact_root = os.path.join(self.root, FACT_DIRECTORY)
+        for year_directory in sorted(os.listdir(fact_root)):
+            if not year_directory.startswith("year="):
+                continue
+            for month_directory in sorted(os.listdir(os.path.join(fact_root, year_directory))):
+                if not month_directory.startswith("month="):
+                    continue
+                directory = os.path.join(fact_root, year_directory, month_directory)
+                for file_name in sorted(os.listdir(directory)):
+                    if file_name.endswith(".parquet"):
+                        partitions.append((int(year_directory[len("year="):]), int(month_directory[len("month="):]),
+                                           os.path.join(directory, file_name)))
+        return partitions
+
+    def read_fact(self, date_from=None, date_to=None, hood_ids=None, columns=None, years=None):
+        """A function which returns the fact rows between date_from and date_to (inclusive, anything
+           pd.Timestamp accepts) or inside the inclusive years range, in the given neighbourhoods (hood_id list),
+           with the year and month partition columns added back.
+        """
+
+        _, pq = import_pyarrow()
+        if years is not None:
+            date_from, date_to = f"{years[0]}-01-01", f"{years[1]}-12-31"
+        date_from = pd.Timestamp(date_from) if date_from is not None else None
+        date_to = pd.Timestamp(date_to) if date_to is not None else None
+        hood_ids = None if hood_ids is None else np.unique(np.asarray(hood_ids, dtype=np.int64))
+
+        scan = {"files_read": 0, "files_skipped": 0, "row_groups_read": 0, "row_groups_skipped": 0}
+        frames = []
+        for year, month, path in self.partitions():
+            month_number = year * 12 + month
+            if (date_from is not None and month_number < date_from.year * 12 + date_from.month) or \
+                    (date_to is not None and month_number > date_to.year * 12 + date_to.month):
+                scan["files_skipped"] += 1
+                continue
+
+            # Day range of this partition which can match the date range
+            first_day = date_from.day if date_from is not None and (year, month) == (date_from.year, date_from.month) else 1
+            last_day = date_to.day if date_to is not None and (year, month) == (date_to.year, date_to.month) else 31
+
+            parquet_file = pq.ParquetFile(path)
+            names = parquet_file.metadata.schema.names
+            selected = []
+            for index in range(parquet_file.metadata.num_row_groups):
+                row_group = parquet_file.metadata.row_group(index)
+                if self.row_group_matches(row_group, names, first_day, last_day, hood_ids):
+                    selected.append(index)
+            scan["row_groups_skipped"] += parquet_file.metadata.num_row_groups - len(selected)
+            if not selected:
+                scan["files_skipped"] += 1
+                continue
+
+            scan["files_read"] += 1
+            scan["row_groups_read"] += len(selected)
+            read_columns = None if columns is None else sorted((set(columns) | {'day', 'hood_id'}) - set(PARTITION_COLUMNS))
+            df = parquet_file.read_row_groups(selected, columns=read_columns).to_pandas()
+
+            # The row groups only bound the values: the rows themselves are filtered exactly
+            mask = (df['day'] >= first_day) & (df['day'] <= last_day)
+            if hood_ids is not None:
+                mask &= df['hood_id'].isin(hood_ids)
+            df = df[mask]
+            df.insert(0, 'month', month)
+            df.insert(0, 'year', year)
+            frames.append(df)
+
+        self.last_scan = scan
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(frames, ignore_index=True)
+        return df if columns is None else df[list(columns)]
+
+    def row_group_matches(self, row_group, names, first_day, last_day, hood_ids):
+        """A function which checks with the min/max statistics whether a row group can hold matching rows."""
+
+        day_range = statistics_range(row_group, names.index('day'))
+        if day_range is not None and (day_range[1] < first_day or day_range[0] > last_day):
+            return False
+        if hood_ids is not None:
+            hood_range = statistics_range(row_group, names.index('hood_id'))
+            if hood_range is not None:
+                # any requested hood_id inside [min, max]
+                position = np.searchsorted(hood_ids, hood_range[0])
+                if position == len(hood_ids) or hood_ids[position] > hood_range[1]:
+                    return False
+        return True
+
+    def read_dimension(self, table_name, columns=None):
+        _, pq = import_pyarrow()
+        return pq.read_table(os.path.join(self.root, table_name + ".parquet"), columns=columns).to_pandas()
@@ -0,0 +1,373 @@
+
+import argparse, json, os, platform, statistics, subprocess, sys, time, tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from pipeline_config import load_config, load_section
+
+"""
+************************************  Performance regression tracking:  ************************************
+Runs a fixed synthetic workload through the stages of A02_Team_V04.py and compares it with the previous commits:
+            python perf_regression.py                       run, compare with the baseline, record the run
+            python perf_regression.py --tolerance 0.1 --no-record
+
+The workload is generated from a seed (crime_rows crimes over 2017-2020 plus duplicates and out of range years, the
+hourly observations of `stations` weather stations, written HH:MM or H:MM like the shipped weather files) and is
+written to workdir as crime_dataset.csv, weather_dataset/weather_YYYY-MM_P1H.csv and a config.json pointing at the
+scratch database `database` (on the server of config.json, dropped and created again before every run; it must not
+be the warehouse database). The real stage functions of the command line then run in workdir:
+    extract     etl_source_data()
+    dims        etl_dimensions()
+    fact        etl_fact_table()
+so a change of A02_Team_V04.py or of a helper module which slows a stage down is measured. The stages print their
+errors instead of raising them: a stage which did not build its tables (STAGE_OUTPUTS) stops the run. The optional
+features are switched off unless they are given in "pipeline_sections" (the sections written to the config.json of
+the workload).
+
+Every stage is timed `repeat` times (fastest wall time kept, with the rows per second), then run memory_runs more
+times under tracemalloc for its peak (tracemalloc slows the stages down, so the timed runs do not trace). The run is
+appended to history_path (JSON lines) keyed by the git commit (a later run of the same commit replaces it). The
+baseline of a metric is its median over the last baseline_runs other commits with the same workload; a stage
+regresses when it is slower than the baseline by more than `tolerance` (or hungrier by more than memory_tolerance).
+The regressions are printed and the command exits with status 1.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "history_path": "perf_history.jsonl",
+    "database": "crime_weather_perf",
+    "workdir": "perf_workload",
+    "pipeline_sections": {},
+    "crime_rows": 200000,
+    "stations": 3,
+    "seed": 0,
+    "repeat": 3,
+    "memory_runs": 1,
+    "baseline_runs": 5,
+    "tolerance": 0.2,
+    "memory_tolerance": 0.2,
+}
+
+YEARS = [2017, 2018, 2019, 2020]
+MONTH_NAMES = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October",
+               "November", "December"]
+DAY_NAMES = ["Monday    ", "Tuesday   ", "Wednesday ", "Thursday  ", "Friday    ", "Saturday  ", "Sunday    "]
+CRIME_TYPES = ["Assault", "Break and Enter", "Auto Theft", "Robbery", "Theft Over"]
+LOCATION_TYPES = ["Apartment (Rooming House, Condo)", "Single Home, House (Attach Garage, Cottage, Mobile)",
+                  "Streets, Roads, Highways (Bicycle Path, Private Road)", "Commercial Dwelling Unit (Hotel, Motel, B & B)"]
+WEATHER_TEXTS = ["NA", "Rain", "Snow", "Fog", "Rain,Fog", "Mainly Clear", "Cloudy", "Moderate Rain", "Freezing Rain"]
+WEATHER_DROPPED_COLUMNS = ["Date/Time", "Temp Flag", "Dew Point Temp (°C)", "Dew Point Temp Flag", "Rel Hum (%)",
+                           "Rel Hum Flag", "Wind Dir (10s deg)", "Wind Dir Flag", "Wind Spd (km/h)", "Wind Spd Flag",
+                           "Visibility (km)", "Visibility Flag", "Stn Press (kPa)", "Stn Press Flag", "Hmdx",
+                           "Hmdx Flag", "Wind Chill", "Wind Chill Flag"]
+NEIGHBOURHOODS = 140
+
+CONNECTION_KEYS = ["database", "user", "password", "host", "port"]
+
+# Stages of the workload, in the order of the pipeline (the names of the A02_Team_V04.py command line)
+WORKLOAD_STAGES = ["extract", "dims", "fact"]
+
+# Tables every stage builds (a stage which failed printed its traceback and left them missing)
+STAGE_OUTPUTS = {
+    "extract": ["crime_source_table", "weather_station_table", "hourly_climate_surrogate_table",
+                "crime_weather_source_table"],
+    "dims": ["date_surrogate_table", "crime_event_surrogate_table", "climate_surrogate_table",
+             "neighbourhood_surrogate_table", "crime_weather_source_table"],
+    "fact": ["fact_table"],
+}
+
+# With the partition-parallel load the extract stage builds every table (see parallel_etl.py)
+PARALLEL_STAGE_OUTPUTS = {
+    "extract": ["crime_source_table", "weather_station_table", "hourly_climate_surrogate_table",
+                "date_surrogate_table", "crime_event_surrogate_table", "climate_surrogate_table",
+                "neighbourhood_surrogate_table", "fact_table"],
+    "dims": [],
+    "fact": [],
+}
+
+
+def synthetic_crime_frame(rows, seed=0):
+    """A function which generates a crime extract with the columns of crime_dataset.csv: 5% duplicated event_id,
+       2% crimes outside 2017-2020 and 1% "NSA" neighbourhoods.
+    """
+
+    rng = np.random.default_rng(seed)
+    dates = pd.to_datetime("2016-07-01") + pd.to_timedelta(rng.integers(0, 5 * 365, rows), unit="D")
+    hood_ids = rng.integers(1, NEIGHBOURHOODS + 1, rows)
+    event_ids = np.char.add("GO-", rng.integers(0, 10 ** 9, rows).astype(str))
+    duplicated = rng.random(rows) < 0.05
+    event_ids[duplicated] = event_ids[rng.integers(0, rows, int(duplicated.sum()))]
+    nsa = rng.random(rows) < 0.01
+    df = pd.DataFrame({
+        "event_id": event_ids,
+        "occurrence_year": dates.year,
+        "occurrence_month": np.array(MONTH_NAMES)[dates.month - 1],
+        "occurrence_day": dates.day,
+        "day_of_year": dates.dayofyear,
+        "day_of_week": np.array(DAY_NAMES)[dates.dayofweek],
+        "occurrence_hour": rng.integers(0, 24, rows),
+        "location_type": rng.choice(LOCATION_TYPES, rows),
+        "crime_type": rng.choice(CRIME_TYPES, rows),
+        "hood_id": np.where(nsa, "NSA", hood_ids.astype(str)),
+        "neighbourhood_name": np.where(nsa, "NSA", np.char.add("Neighbourhood ", hood_ids.astype(str))),
+        "long": -79.64 + (hood_ids % 12 + rng.random(rows)) * 0.044,
+        "lat": 43.58 + (hood_ids // 12 + rng.random(rows)) * 0.023,
+    })
+    return df
+
+
+def synthetic_weather_frame(stations, seed=0):
+    """A function which generates the hourly observations of 2017-2020 of the given number of stations, with the
+       columns of the weather_dataset/*_P1H.csv files.
+    """
+
+    rng = np.random.default_rng(seed)
+    hours = pd.date_range("2017-01-01", "2020-12-31 23:00", freq="h")
+    frames = []
+    for station in range(stations):
+        count = len(hours)
+        frame = pd.DataFrame({
+            "Longitude (x)": -79.6 + 0.2 * station, "Latitude (y)": 43.6 + 0.05 * station,
+            "Station Name": f"STATION {station}", "Climate ID": str(6158000 + station),
+            "Year": hours.year, "Month": hours.month, "Day": hours.day,
+            # the November files write the hours H:MM (like weather_2020-11_P1H.csv), the others HH:MM
+            "Time": np.where(hours.month == 11, hours.hour.astype(str) + ":00", hours.strftime("%H:%M")),
+            "Temp (°C)": np.round(8 - 14 * np.cos(2 * np.pi * hours.dayofyear / 365) + rng.normal(0, 3, count), 1),
+            "Weather": rng.choice(WEATHER_TEXTS, count, p=[0.7, 0.08, 0.06, 0.03, 0.03, 0.04, 0.03, 0.02, 0.01]),
+        })
+        for column in WEATHER_DROPPED_COLUMNS:
+            frame[column] = np.nan
+        frame.loc[frame["Weather"] == "NA", "Weather"] = np.nan
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+class Workload:
+    """
+    The class Workload writes the synthetic source data and the config.json of the scratch database to the work
+    directory, and resets the scratch database before every run.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.crime_source = synthetic_crime_frame(settings["crime_rows"], settings["seed"])
+        self.weather_source = synthetic_weather_frame(settings["stations"], settings["seed"])
+        self.rows = len(self.crime_source)
+        self.workdir = os.path.abspath(settings["workdir"])
+        self.connection = {key: value for key, value in load_config().items() if key in CONNECTION_KEYS}
+        if settings["database"] == self.connection.get("database"):
+            raise ValueError(f"the scratch database {settings['database']!r} of the workload is the warehouse "
+                             f"database of config.json, it would be dropped")
+
+    def url(self, database):
+        connection = self.connection
+        return (f"postgresql://{connection['user']}:{connection['password']}@{connection['host']}:"
+                f"{connection['port']}/{database}")
+
+    def write_files(self):
+        """A function which writes the crime file, the monthly weather files and the config.json of the workload."""
+
+        weather_dir = os.path.join(self.workdir, "weather_dataset")
+        os.makedirs(weather_dir, exist_ok=True)
+        self.crime_source.to_csv(os.path.join(self.workdir, "crime_dataset.csv"), index=False)
+        for (year, month), rows in self.weather_source.groupby(["Year", "Month"]):
+            rows.to_csv(os.path.join(weather_dir, f"weather_{year}-{month:02d}_P1H.csv"), index=False)
+        with open(os.path.join(self.workdir, "config.json"), "w") as config_file:
+            json.dump(dict(self.connection, database=self.settings["database"], **self.settings["pipeline_sections"]),
+                      config_file, indent=1)
+
+    def reset_database(self):
+        from sqlalchemy import create_engine, text
+
+        engine = create_engine(self.url(self.connection["database"]), isolation_level="AUTOCOMMIT")
+        with engine.connect() as connection:
+            connection.execute(text(f"DROP DATABASE IF EXISTS {self.settings['database']}"))
+            connection.execute(text(f"CREATE DATABASE {self.settings['database']}"))
+        engine.dispose()
+
+    def check_outputs(self, stage):
+        """A function which raises a RuntimeError when a table of the stage was not built."""
+
+        from sqlalchemy import create_engine, text
+
+        parallel = self.settings["pipeline_sections"].get("parallel_etl", {}).get("enabled", False)
+        engine = create_engine(self.url(self.settings["database"]))
+        with engine.connect() as connection:
+            missing = [table_name for table_name in (PARALLEL_STAGE_OUTPUTS if parallel else STAGE_OUTPUTS)[stage]
+                       if not connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"),
+                                                 {"name": table_name}).scalar()]
+        engine.dispose()
+        if missing:
+            raise RuntimeError(f"stage {stage} did not build {', '.join(missing)} (see its traceback above)")
+
+
+@contextmanager
+def in_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def run_stages(workload, trace_memory=False):
+    """A function which runs the stages of the command line on a fresh scratch database and returns the wall time
+       (trace_memory False) or the tracemalloc peak (trace_memory True) of every stage.
+    """
+
+    from A02_Team_V04 import STAGES
+
+    workload.reset_database()
+    metrics = {}
+    for stage in WORKLOAD_STAGES:
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            STAGES[stage]()
+            metrics[stage] = tracemalloc.get_traced_memory()[1] if trace_memory else time.perf_counter() - start
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        workload.check_outputs(stage)
+    return metrics
+
+
+def run_workload(settings):
+    """A function which runs the workload and returns the metrics of every stage (see the module description)."""
+
+    # the stages import the helper modules lazily, after the move to the work directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workload = Workload(settings)
+    workload.write_files()
+    with in_directory(workload.workdir):
+        timings = [run_stages(workload) for _ in range(settings["repeat"])]
+        peaks = [run_stages(workload, trace_memory=True) for _ in range(settings["memory_runs"])]
+
+    results = {}
+    for stage in WORKLOAD_STAGES:
+        seconds = min(timing[stage] for timing in timings)
+        results[stage] = {"seconds": seconds, "peak_bytes": max((peak[stage] for peak in peaks), default=0),
+                          "rows_per_second": workload.rows / seconds}
+    return results
+
+
+def git_commit():
+    """A function which returns the current git commit ("-dirty" when tracked files are modified)."""
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + "-dirty" if dirty else commit
+
+
+def workload_key(settings):
+    return {name: settings[name] for name in ("crime_rows", "stations", "seed", "pipeline_sections")}
+
+
+def read_history(path):
+    try:
+        with open(path) as history_file:
+            return [json.loads(line) for line in history_file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def record_run(path, entry):
+    """A function which appends the run to the history, replacing the previous run of the same commit and workload."""
+
+    history = [previous for previous in read_history(path)
+               if (previous["commit"], previous["workload"]) != (entry["commit"], entry["workload"])]
+    history.append(entry)
+    with open(path, "w") as history_file:
+        for previous in history:
+            history_file.write(json.dumps(previous) + "\n")
+
+
+def rolling_baseline(history, entry, baseline_runs):
+    """A function which returns the median metrics of every stage over the last baseline_runs other commits
+       with the same workload (None when there is no such run).
+    """
+
+    previous = [run for run in history if run["workload"] == entry["workload"] and run["commit"] != entry["commit"]]
+    previous = previous[-baseline_runs:]
+    if not previous:
+        return None
+    baseline = {}
+    for stage in entry["stages"]:
+        runs = [run["stages"][stage] for run in previous if stage in run["stages"]]
+        if runs:
+            baseline[stage] = {metric: statistics.median(run[metric] for run in runs)
+                               for metric in ("seconds", "peak_bytes", "rows_per_second")}
+    return {"commits": [run["commit"] for run in previous], "stages": baseline}
+
+
+def compare_with_baseline(entry, baseline, settings):
+    """A function which prints the stages against the baseline and returns the regressions."""
+
+    regressions = []
+    print(f"Commit {entry['commit']}, {entry['workload']['crime_rows']} crimes, "
+          + (f"baseline: median of {', '.join(baseline['commits'])}" if baseline else "no baseline yet"))
+    print(f"{'stage':10} {'seconds':>10} {'baseline':>10} {'change':>8} {'peak MiB':>10} {'baseline':>10} "
+          f"{'change':>8} {'rows/s':>12}")
+    for stage, result in entry["stages"].items():
+        reference = (baseline or {"stages": {}})["stages"].get(stage)
+        changes = {}
+        for metric, tolerance in (("seconds", settings["tolerance"]), ("peak_bytes", settings["memory_tolerance"])):
+            if reference and reference[metric]:
+                changes[metric] = result[metric] / reference[metric] - 1
+                if changes[metric] > tolerance:
+                    regressions.append((stage, metric, result[metric], reference[metric], changes[metric], tolerance))
+        print(f"{stage:10} {result['seconds']:10.3f} "
+              f"{reference['seconds'] if reference else float('nan'):10.3f} "
+              f"{changes.get('seconds', float('nan')):+8.1%} {result['peak_bytes'] / 2 ** 20:10.1f} "
+              f"{reference['peak_bytes'] / 2 ** 20 if reference else float('nan'):10.1f} "
+              f"{changes.get('peak_bytes', float('nan')):+8.1%} {result['rows_per_second']:12,.0f}")
+
+    for stage, metric, value, reference, change, tolerance in regressions:
+        unit = (lambda number: f"{number:.3f} s") if metric == "seconds" else (lambda number: f"{number / 2 ** 20:.1f} MiB")
+        print(f"REGRESSION in stage {stage}: {metric} {unit(value)} against a baseline of {unit(reference)} "
+              f"({change:+.1%}, tolerance {tolerance:+.0%})")
+    if not regressions:
+        print("No stage regressed beyond the tolerance")
+    return regressions
+
+
+def check_performance(settings=None, record=True):
+    """A function which runs the workload, compares it with the rolling baseline and records it.
+       Returns the regressions (empty when none).
+    """
+
+    settings = settings or load_section("perf_regression", DEFAULT_SETTINGS)
+    entry = {"commit": git_commit(), "recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+             "python": platform.python_version(), "pandas": pd.__version__, "workload": workload_key(settings),
+             "stages": run_workload(settings)}
+    regressions = compare_with_baseline(entry, rolling_baseline(read_history(settings["history_path"]), entry,
+                                                                settings["baseline_runs"]), settings)
+    if record:
+        record_run(settings["history_path"], entry)
+    return regressions
+
+
+if __name__ == "__main__":
+    settings = load_section("perf_regression", DEFAULT_SETTINGS)
+    parser = argparse.ArgumentParser(description="Run the synthetic workload through the pipeline stages and "
+                                                 "compare it with the rolling baseline of the previous commits.")
+    parser.add_argument("--rows", type=int, default=settings["crime_rows"], help="number of synthetic crimes")
+    parser.add_argument("--repeat", type=int, default=settings["repeat"], help="runs per stage (fastest kept)")
+    parser.add_argument("--tolerance", type=float, default=settings["tolerance"],
+                        help="allowed slow down of a stage against the baseline (0.2 = 20%%)")
+    parser.add_argument("--memory-tolerance", type=float, default=settings["memory_tolerance"],
+                        help="allowed peak memory growth of a stage against the baseline")
+    parser.add_argument("--no-record", action="store_true", help="do not add the run to the history")
+    args = parser.parse_args()
+    settings.update(crime_rows=args.rows, repeat=args.repeat, tolerance=args.tolerance,
+                    memory_tolerance=args.memory_tolerance)
+    sys.exit(1 if check_performance(settings, record=not args.no_record) else 0)
@@ -0,0 +1,33 @@
+
+import json
+
+"""
+Optional pipeline settings shared by the helper modules of A02_Team_V04.py.
+
+The settings live in the same "config.json" file as the database parameters read by DbConnection. Every
+optional section is looked up with load_section(), so a config.json which only holds the connection
+parameters keeps working and every optional feature stays switched off.
+"""
+
+
+CONFIG_PATH = "./config.json"
+
+
+def load_config(path=CONFIG_PATH):
+    """A function which reads the config.json file and returns it as a dictionary.
+       An empty dictionary is returned when the file does not exist.
+    """
+
+    try:
+        with open(path) as jsonfile:
+            return json.load(jsonfile)
+    except FileNotFoundError:
+        return {}
+
+
+def load_section(name, defaults=None, path=CONFIG_PATH):
+    """A function which returns one optional section of config.json merged over its default values."""
+
+    section = dict(defaults or {})
+    section.update(load_config(path).get(name) or {})
+    return section
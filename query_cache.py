@@ -0,0 +1,261 @@
+
+import hashlib, json, os, pickle, re, time
+from collections import OrderedDict
+
+import pandas as pd
+
+from pipeline_config import load_section
+
+"""
+************************************  Load-epoch-aware query result cache:  ************************************
+DbConnection.query(sql, params) runs a read query and returns its result as a DataFrame. When the "query_cache"
+section of config.json is enabled, the results of the read-only SELECT / WITH queries are cached (a query which
+writes, such as WITH ... UPDATE ... RETURNING, SELECT ... INTO or SELECT ... FOR UPDATE, always runs):
+            "query_cache": {"enabled": true, "max_entries": 256, "max_bytes": 67108864, "disk_dir": "query_cache"}
+
+    - the key is the normalized SQL (lower case outside string literals, collapsed white space, no trailing ";"),
+      the parameters and the load epoch,
+    - the memory tier is an LRU bounded by max_entries and max_bytes (pickled size of the results),
+    - the optional disk tier (disk_dir) keeps one pickle file per result, shared by every process of the host.
+
+The load epoch is a counter stored in the pipeline_load_epoch table; main() bumps it with bump_load_epoch() when a
+load completes. Every cached query reads the current epoch first, with one query (the existence of the table is
+only looked up until the first load created it), so the entries of an older load are never returned: they are
+dropped from both tiers as soon as the new epoch is seen. With "epoch_check_seconds": n the epoch is only read
+once every n seconds, which saves that query but serves the results of the previous load for up to n seconds
+after a load.
+
+The loaders read the tables they just wrote with db.cur, never through the cache.
+
+get_query_cache().stats() returns the hit/miss counts and the mean latency of hits and misses.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "max_entries": 256,
+    "max_bytes": 64 * 1024 * 1024,
+    "disk_dir": None,
+    "epoch_check_seconds": 0,
+}
+
+EPOCH_TABLE = "pipeline_load_epoch"
+
+CACHEABLE_STATEMENTS = ("select", "with")
+
+# Clauses which make a SELECT / WITH statement write or lock (outside the string literals)
+WRITING_CLAUSE_PATTERN = re.compile(
+    r"\b(insert|update|delete|merge|into|for\s+(no\s+key\s+)?(update|share|key\s+share))\b")
+
+STRING_LITERAL_PATTERN = re.compile(r"('(?:[^']|'')*')")
+
+# The query cache shared by every DbConnection of the process
+_query_cache = None
+
+
+def normalize_sql(sql):
+    """A function which normalizes a query for the cache key: lower case and collapsed white space outside the
+       string literals, without the trailing semicolon.
+    """
+
+    parts = STRING_LITERAL_PATTERN.split(sql.strip().rstrip(";").strip())
+    # split() keeps the literals at the odd positions
+    return "".join(part if index % 2 else re.sub(r"\s+", " ", part.lower()) for index, part in enumerate(parts))
+
+
+def is_cacheable(sql):
+    """A function which tells whether a query is a read-only SELECT / WITH query."""
+
+    normalized = normalize_sql(sql)
+    if not normalized.startswith(CACHEABLE_STATEMENTS):
+        return False
+    # split() keeps the literals at the odd positions
+    code = " ".join(part for index, part in enumerate(STRING_LITERAL_PATTERN.split(normalized)) if not index % 2)
+    return WRITING_CLAUSE_PATTERN.search(code) is None
+
+
+def bump_load_epoch(db):
+    """A function which increments the load epoch stored in the database (called when main() completes a load).
+       Returns the new epoch.
+    """
+
+    db.cur.execute(f"CREATE TABLE IF NOT EXISTS {EPOCH_TABLE} (id integer PRIMARY KEY, epoch bigint NOT NULL, "
+                   f"loaded_at timestamp NOT NULL)")
+    db.cur.execute(f"""INSERT INTO {EPOCH_TABLE} (id, epoch, loaded_at) VALUES (1, 1, now())
+                        ON CONFLICT (id) DO UPDATE SET epoch = {EPOCH_TABLE}.epoch + 1, loaded_at = now()
+                        RETURNING epoch""")
+    epoch = db.cur.fetchone()[0]
+    db.raw_conn.commit()
+    print(f"Load epoch is now {epoch}")
+    return epoch
+
+
+def read_load_epoch(cur, table_exists=False):
+    """A function which returns the current load epoch (0 before the first completed load) and whether the epoch
+       table exists. The table is never dropped once created, so a caller which saw it passes table_exists=True
+       and the epoch is read with one query.
+    """
+
+    if not table_exists:
+        cur.execute(f"SELECT to_regclass('{EPOCH_TABLE}') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return 0, False
+    cur.execute(f"SELECT epoch FROM {EPOCH_TABLE} WHERE id = 1")
+    row = cur.fetchone()
+    return (row[0] if row else 0), True
+
+
+class QueryResultCache:
+    """
+    The class QueryResultCache keeps query results (columns, rows) in a size-bounded LRU memory tier and an
+    optional disk tier, both keyed by the normalized query, its parameters and the load epoch.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.entries = OrderedDict()  # key -> (size in bytes, columns, rows)
+        self.total_bytes = 0
+        self.epoch = None
+        self.epoch_checked_at = 0.0
+        self.epoch_table_exists = False
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "evictions": 0,
+                         "invalidations": 0}
+        self.latency = {"hit": 0.0, "miss": 0.0}
+        if settings["disk_dir"]:
+            os.makedirs(settings["disk_dir"], exist_ok=True)
+
+    def refresh_epoch(self, cur):
+        """A function which reads the load epoch (at most every epoch_check_seconds) and drops every entry of
+           an older epoch when it changed.
+        """
+
+        now = time.monotonic()
+        if self.epoch is not None and now - self.epoch_checked_at < self.settings["epoch_check_seconds"]:
+            return self.epoch
+        epoch, self.epoch_table_exists = read_load_epoch(cur, self.epoch_table_exists)
+        self.epoch_checked_at = now
+        if epoch != self.epoch:
+            if self.epoch is not None:
+                self.counters["invalidations"] += 1
+            self.entries.clear()
+            self.total_bytes = 0
+            self.prune_disk(epoch)
+            self.epoch = epoch
+        return epoch
+
+    def cache_key(self, sql, params):
+        text = json.dumps([normalize_sql(sql), params], default=str)
+        return f"{self.epoch}_{hashlib.sha256(text.encode()).hexdigest()}"
+
+    def disk_path(self, key):
+        return os.path.join(self.settings["disk_dir"], key + ".pkl")
+
+    def prune_disk(self, epoch):
+        if not self.settings["disk_dir"]:
+            return
+        for file_name in os.listdir(self.settings["disk_dir"]):
+            if file_name.endswith(".pkl") and not file_name.startswith(f"{epoch}_"):
+                try:
+                    os.remove(os.path.join(self.settings["disk_dir"], file_name))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            _, columns, rows = self.entries[key]
+            return columns, rows
+        if self.settings["disk_dir"]:
+            try:
+                with open(self.disk_path(key), "rb") as cache_file:
+                    payload = cache_file.read()
+            except FileNotFoundError:
+                return None
+            columns, rows = pickle.loads(payload)
+            self.counters["disk_hits"] += 1
+            self.put_memory(key, columns, rows, len(payload))
+            return columns, rows
+        return None
+
+    def put_memory(self, key, columns, rows, size):
+        if size > self.settings["max_bytes"]:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[0]
+        self.entries[key] = (size, columns, rows)
+        self.total_bytes += size
+        while len(self.entries) > self.settings["max_entries"] or self.total_bytes > self.settings["max_bytes"]:
+            _, (evicted_size, _, _) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.counters["evictions"] += 1
+
+    def put(self, key, columns, rows):
+        payload = pickle.dumps((columns, rows), protocol=pickle.HIGHEST_PROTOCOL)
+        self.put_memory(key, columns, rows, len(payload))
+        if self.settings["disk_dir"]:
+            # write then rename, so a concurrent reader never sees a partial file
+            temporary_path = self.disk_path(key) + f".{os.getpid()}.tmp"
+            with open(temporary_path, "wb") as cache_file:
+                cache_file.write(payload)
+            os.replace(temporary_path, self.disk_path(key))
+
+    def query(self, cur, sql, params=None):
+        """A function which returns the (columns, rows) of a query, from the cache when possible."""
+
+        start = time.perf_counter()
+        if not is_cacheable(sql):
+            self.counters["bypassed"] += 1
+            return execute_query(cur, sql, params)
+
+        self.refresh_epoch(cur)
+        key = self.cache_key(sql, params)
+        result = self.get(key)
+        if result is not None:
+            self.latency["hit"] += time.perf_counter() - start
+            return result
+
+        columns, rows = execute_query(cur, sql, params)
+        self.put(key, columns, rows)
+        self.counters["misses"] += 1
+        self.latency["miss"] += time.perf_counter() - start
+        return columns, rows
+
+    def stats(self):
+        """A function which returns the hit/miss counters, the mean latencies (seconds) and the memory use."""
+
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        lookups = hits + self.counters["misses"]
+        return dict(self.counters, epoch=self.epoch, entries=len(self.entries), bytes=self.total_bytes,
+                    hit_rate=hits / lookups if lookups else 0.0,
+                    mean_hit_seconds=self.latency["hit"] / hits if hits else 0.0,
+                    mean_miss_seconds=self.latency["miss"] / self.counters["misses"] if self.counters["misses"] else 0.0)
+
+
+def execute_query(cur, sql, params=None):
+    cur.execute(sql, params)
+    return [col[0] for col in cur.description], cur.fetchall()
+
+
+def get_query_cache():
+    """A function which returns the query cache of the process, or None when the query_cache section of
+       config.json is disabled.
+    """
+
+    global _query_cache
+    if _query_cache is None:
+        settings = load_section("query_cache", DEFAULT_SETTINGS)
+        if not settings["enabled"]:
+            return None
+        _query_cache = QueryResultCache(settings)
+    return _query_cache
+
+
+def run_query(cur, sql, params=None):
+    """A function which runs a read query through the query cache (directly when it is disabled) and returns
+       the result as a DataFrame.
+    """
+
+    cache = get_query_cache()
+    columns, rows = cache.query(cur, sql, params) if cache is not None else execute_query(cur, sql, params)
+    return pd.DataFrame(rows, columns=columns)
@@ -0,0 +1,97 @@
+
+import datetime
+
+"""
+************************************  Slowly changing dimension (type 2) merge:  ************************************
+transform_neighbourhood_data() keeps the history of neighbourhood_dimension_table instead of rebuilding it: every
+version of a neighbourhood is one row
+            hood_id, neighbourhood_name, attribute_hash, valid_from, valid_to, is_current
+with the primary key (hood_id, valid_from). valid_to is null and is_current true for the current version.
+
+A load is merged in one set-based pass:
+    1. the neighbourhoods of the load are written to a staging table and their attribute hash is computed in SQL
+       (md5 of the attribute columns), the same expression as the stored hashes,
+    2. one UPDATE ... FROM closes the current versions whose hash differs from the staging row,
+    3. one INSERT ... SELECT adds a version for every staging row without a current version (new or just closed).
+Both statements are sent as one query string, so PostgreSQL applies them in one transaction, and their cost only
+depends on the staging table and the changed rows. Neighbourhoods missing from a load keep their current version
+(a load only holds the neighbourhoods with crimes).
+
+A dimension table created before the history was kept (primary key on the business key only) is converted in place
+by ensure_scd2_table(): its rows become the current versions, valid from HISTORY_START.
+"""
+
+
+HISTORY_START = datetime.datetime(1900, 1, 1)
+
+def attribute_hash_sql(attribute_columns, alias):
+    """A function which returns the SQL expression of the attribute hash of a row."""
+
+    values = ", ".join(f"coalesce({alias}.{column}::text, '')" for column in attribute_columns)
+    return f"md5(concat_ws('|', {values}))"
+
+
+def table_columns(db, table_name):
+    db.cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table_name,))
+    return [row[0] for row in db.cur.fetchall()]
+
+
+def ensure_scd2_table(db, table_name, key_columns, attribute_columns, column_types):
+    """A function which creates the versioned dimension table when it does not exist, or converts a dimension
+       table without history (see the module description).
+    """
+
+    columns = table_columns(db, table_name)
+    key_list = ", ".join(key_columns)
+    if not columns:
+        definitions = ", ".join(f"{column} {column_types[column]}" for column in key_columns + attribute_columns)
+        db.cur.execute(f"""CREATE TABLE {table_name} ({definitions}, attribute_hash text NOT NULL,
+                            valid_from timestamp NOT NULL, valid_to timestamp, is_current boolean NOT NULL,
+                            PRIMARY KEY ({key_list}, valid_from))""")
+    elif "is_current" not in columns:
+        # the dependent foreign keys are recreated by the caller with the new primary key
+        db.cur.execute(f"""ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {table_name}_pkey CASCADE,
+                            ADD COLUMN attribute_hash text, ADD COLUMN valid_from timestamp,
+                            ADD COLUMN valid_to timestamp, ADD COLUMN is_current boolean""")
+        db.cur.execute(f"""UPDATE {table_name} t SET attribute_hash = {attribute_hash_sql(attribute_columns, 't')},
+                            valid_from = %s, is_current = true""", (HISTORY_START,))
+        db.cur.execute(f"""ALTER TABLE {table_name} ALTER COLUMN attribute_hash SET NOT NULL,
+                            ALTER COLUMN valid_from SET NOT NULL, ALTER COLUMN is_current SET NOT NULL,
+                            ADD PRIMARY KEY ({key_list}, valid_from)""")
+    db.cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_current_index ON {table_name} ({key_list}) WHERE is_current")
+    db.raw_conn.commit()
+
+
+def scd2_merge(db, table_name, staging_table, key_columns, attribute_columns, load_time=None):
+    """A function which merges the staging table into the versioned dimension table (see the module description).
+       Returns the number of closed versions and the number of inserted versions.
+    """
+
+    load_time = load_time or datetime.datetime.now()
+    key_match = " AND ".join(f"d.{column} = s.{column}" for column in key_columns)
+    column_list = ", ".join(key_columns + attribute_columns)
+    staging_columns = ", ".join(f"s.{column}" for column in key_columns + attribute_columns)
+
+    # STEP#1 Hash the attributes of the staging rows
+    db.cur.execute(f"ALTER TABLE {staging_table} ADD COLUMN IF NOT EXISTS attribute_hash text")
+    db.cur.execute(f"UPDATE {staging_table} s SET attribute_hash = {attribute_hash_sql(attribute_columns, 's')}")
+    db.raw_conn.commit()
+
+    # STEP#2 Close the changed versions and insert the new ones (one query string: one transaction)
+    db.cur.execute(f"""UPDATE {table_name} d SET valid_to = %(load_time)s, is_current = false
+                        FROM {staging_table} s
+                        WHERE {key_match} AND d.is_current AND d.attribute_hash <> s.attribute_hash;
+                        INSERT INTO {table_name} ({column_list}, attribute_hash, valid_from, valid_to, is_current)
+                        SELECT {staging_columns}, s.attribute_hash, %(load_time)s, NULL, true
+                        FROM {staging_table} s
+                        LEFT JOIN {table_name} d ON {key_match} AND d.is_current
+                        WHERE d.{key_columns[0]} IS NULL""", {"load_time": load_time})
+    inserted = db.cur.rowcount
+    db.raw_conn.commit()
+
+    db.cur.execute(f"SELECT count(*) FROM {table_name} WHERE valid_to = %s", (load_time,))
+    closed = db.cur.fetchone()[0]
+    db.cur.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    db.raw_conn.commit()
+    print(f"SCD2 merge of {table_name}: {closed} versions closed, {inserted} versions inserted")
+    return closed, inserted
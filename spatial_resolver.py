@@ -0,0 +1,300 @@
+
+import json, time
+
+import numpy as np
+
+from pipeline_config import load_section
+
+"""
+************************************  Spatial neighbourhood resolution (optional):  ************************************
+etl_source_data() maps the crimes without neighbourhood ("NSA") to hood_id 0. When the "spatial_resolver" section of
+config.json points to a local GeoJSON file of the neighbourhood polygons, those crimes get the hood_id of the polygon
+which contains their coordinates instead:
+            "spatial_resolver": {"geojson_path": "neighbourhoods.geojson",
+                                 "id_property": "AREA_SHORT_CODE", "name_property": "AREA_NAME",
+                                 "longitude_column": "long", "latitude_column": "lat"}
+
+NeighbourhoodResolver builds a uniform grid over the polygons once:
+    - a cell which no polygon edge crosses lies entirely inside one polygon (or outside all of them), its owner is
+      found once from the cell centre and every point of the cell is resolved with one array lookup,
+    - a cell crossed by edges keeps the list of candidate polygons, and only its points are tested with a vectorized
+      even-odd ray casting test against the edges of the candidates.
+
+Run this file to print the throughput benchmark (points per second) on synthetic neighbourhoods.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "geojson_path": None,
+    "id_property": "AREA_SHORT_CODE",
+    "name_property": "AREA_NAME",
+    "longitude_column": "long",
+    "latitude_column": "lat",
+    "grid_size": 256,
+}
+
+# Maximum size of one point x edge matrix of the ray casting test
+PIP_CHUNK_ELEMENTS = 4000000
+
+
+def load_neighbourhood_polygons(geojson_path, id_property, name_property):
+    """A function which reads a GeoJSON FeatureCollection of (multi)polygons and returns the list of
+       (hood_id, name, rings), every ring being an (n, 2) array of longitude/latitude.
+    """
+
+    with open(geojson_path) as geojson_file:
+        collection = json.load(geojson_file)
+
+    polygons = []
+    for feature in collection["features"]:
+        geometry = feature["geometry"]
+        properties = feature.get("properties", {})
+        if geometry["type"] == "Polygon":
+            parts = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            parts = geometry["coordinates"]
+        else:
+            continue
+        rings = [np.asarray(ring, dtype=np.float64)[:, :2] for part in parts for ring in part]
+        polygons.append((int(properties[id_property]), properties.get(name_property), rings))
+    return polygons
+
+
+def points_in_edges(px, py, edges):
+    """A function which runs the even-odd ray casting test of points against the edges (x1, y1, x2, y2)
+       of one polygon, all rings included so that holes are handled. Returns a boolean array.
+    """
+
+    inside = np.zeros(len(px), dtype=bool)
+    x1, y1, x2, y2 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    chunk = max(1, PIP_CHUNK_ELEMENTS // max(len(edges), 1))
+    for start in range(0, len(px), chunk):
+        cx = px[start:start + chunk, None]
+        cy = py[start:start + chunk, None]
+        crosses = (y1 > cy) != (y2 > cy)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_intersection = x1 + (cy - y1) * (x2 - x1) / (y2 - y1)
+        inside[start:start + chunk] = np.logical_xor.reduce(crosses & (cx < x_intersection), axis=1)
+    return inside
+
+
+class NeighbourhoodResolver:
+    """
+    The class NeighbourhoodResolver assigns points to the neighbourhood polygon which contains them with a
+    uniform grid index (see the module description). resolve() returns the polygon position of every point,
+    -1 for points outside every polygon.
+    """
+
+    def __init__(self, polygons, grid_size=DEFAULT_SETTINGS["grid_size"]):
+        self.hood_ids = np.array([hood_id for hood_id, _, _ in polygons], dtype=np.int64)
+        self.names = [name for _, name, _ in polygons]
+
+        # STEP#1 Flatten the rings of every polygon to one edge array per polygon
+        self.edges = []
+        for _, _, rings in polygons:
+            ring_edges = [np.hstack([ring[:-1], ring[1:]]) if np.array_equal(ring[0], ring[-1])
+                          else np.hstack([ring, np.roll(ring, -1, axis=0)]) for ring in rings]
+            self.edges.append(np.vstack(ring_edges))
+        bounds = np.array([[e[:, [0, 2]].min(), e[:, [1, 3]].min(), e[:, [0, 2]].max(), e[:, [1, 3]].max()]
+                           for e in self.edges])
+
+        # STEP#2 Uniform grid over the bounding box of all the polygons
+        self.grid_size = grid_size
+        self.min_x, self.min_y = bounds[:, 0].min(), bounds[:, 1].min()
+        self.cell_width = (bounds[:, 2].max() - self.min_x) / grid_size or 1.0
+        self.cell_height = (bounds[:, 3].max() - self.min_y) / grid_size or 1.0
+
+        # STEP#3 Candidate polygons of every cell (cells overlapping the polygon bounding box)
+        cell_lists = [[] for _ in range(grid_size * grid_size)]
+        for polygon, (x0, y0, x1, y1) in enumerate(bounds):
+            ix0, iy0 = self.cell_of(x0, y0)
+            ix1, iy1 = self.cell_of(x1, y1)
+            for iy in range(iy0, iy1 + 1):
+                for ix in range(ix0, ix1 + 1):
+                    cell_lists[iy * grid_size + ix].append(polygon)
+
+        # STEP#4 Cells crossed by an edge are boundary cells
+        boundary = np.zeros(grid_size * grid_size, dtype=bool)
+        for polygon_edges in self.edges:
+            ix0, iy0 = self.cell_of(np.minimum(polygon_edges[:, 0], polygon_edges[:, 2]),
+                                    np.minimum(polygon_edges[:, 1], polygon_edges[:, 3]))
+            ix1, iy1 = self.cell_of(np.maximum(polygon_edges[:, 0], polygon_edges[:, 2]),
+                                    np.maximum(polygon_edges[:, 1], polygon_edges[:, 3]))
+            # expand every edge bounding box to the cells it covers, vectorized
+            widths, heights = ix1 - ix0 + 1, iy1 - iy0 + 1
+            counts = widths * heights
+            edge = np.repeat(np.arange(len(counts)), counts)
+            offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            cells = (iy0[edge] + offset // widths[edge]) * grid_size + ix0[edge] + offset % widths[edge]
+            boundary[cells] = True
+
+        # Owner of the cells which no edge crosses: one vectorized test of the cell centres per polygon
+        self.cell_owner = np.full(grid_size * grid_size, -1, dtype=np.int64)
+        for polygon, (x0, y0, x1, y1) in enumerate(bounds):
+            (ix0, ix1), (iy0, iy1) = self.cell_of([x0, x1], [y0, y1])
+            ix, iy = np.meshgrid(np.arange(ix0, ix1 + 1), np.arange(iy0, iy1 + 1))
+            cells = (iy * grid_size + ix).ravel()
+            cells = cells[~boundary[cells] & (self.cell_owner[cells] < 0)]
+            centre_x = self.min_x + (cells % grid_size + 0.5) * self.cell_width
+            centre_y = self.min_y + (cells // grid_size + 0.5) * self.cell_height
+            self.cell_owner[cells[points_in_edges(centre_x, centre_y, self.edges[polygon])]] = polygon
+
+        # Candidate polygons of the boundary cells, stored as a CSR (cell_start, cell_candidates) array pair
+        self.cell_start = np.zeros(grid_size * grid_size + 1, dtype=np.int64)
+        boundary_candidates = []
+        for cell, candidates in enumerate(cell_lists):
+            if boundary[cell]:
+                boundary_candidates.extend(candidates)
+            self.cell_start[cell + 1] = len(boundary_candidates)
+        self.cell_candidates = np.array(boundary_candidates, dtype=np.int64)
+        self.boundary = boundary
+
+    def cell_of(self, x, y):
+        ix = np.clip(((np.asarray(x) - self.min_x) / self.cell_width).astype(np.int64), 0, self.grid_size - 1)
+        iy = np.clip(((np.asarray(y) - self.min_y) / self.cell_height).astype(np.int64), 0, self.grid_size - 1)
+        return ix, iy
+
+    def resolve(self, longitude, latitude):
+        """A function which returns the polygon position of every point (-1 when outside every polygon)."""
+
+        px = np.asarray(longitude, dtype=np.float64)
+        py = np.asarray(latitude, dtype=np.float64)
+        result = np.full(len(px), -1, dtype=np.int64)
+
+        valid = np.isfinite(px) & np.isfinite(py)
+        valid &= (px >= self.min_x) & (px <= self.min_x + self.cell_width * self.grid_size)
+        valid &= (py >= self.min_y) & (py <= self.min_y + self.cell_height * self.grid_size)
+        points = np.flatnonzero(valid)
+        ix, iy = self.cell_of(px[points], py[points])
+        cells = iy * self.grid_size + ix
+
+        # Interior cells: one array lookup
+        result[points] = self.cell_owner[cells]
+
+        # Boundary cells: expand (point, candidate polygon) pairs and test them grouped by polygon
+        on_boundary = self.boundary[cells]
+        points, cells = points[on_boundary], cells[on_boundary]
+        counts = self.cell_start[cells + 1] - self.cell_start[cells]
+        pair_point = np.repeat(points, counts)
+        pair_offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_polygon = self.cell_candidates[np.repeat(self.cell_start[cells], counts) + pair_offset]
+
+        order = np.argsort(pair_polygon, kind="stable")
+        pair_point, pair_polygon = pair_point[order], pair_polygon[order]
+        polygons, starts = np.unique(pair_polygon, return_index=True)
+        ends = np.append(starts[1:], len(pair_polygon))
+        for polygon, start, end in zip(polygons, starts, ends):
+            candidates = pair_point[start:end]
+            inside = points_in_edges(px[candidates], py[candidates], self.edges[polygon])
+            result[candidates[inside]] = polygon
+        return result
+
+
+def resolve_nsa_neighbourhoods(df, resolver, settings):
+    """A function which replaces the "NSA" hood_id and neighbourhood_name of the crimes which have coordinates
+       by the neighbourhood whose polygon contains them. Neighbourhood names are taken from the crimes already
+       assigned to the same hood_id, so that neighbourhood_dimension_table keeps one name per hood_id.
+    """
+
+    nsa = (df['hood_id'].astype(str) == "NSA").to_numpy()
+    if not nsa.any():
+        return df
+
+    longitude = df[settings["longitude_column"]].to_numpy(dtype=np.float64)[nsa]
+    latitude = df[settings["latitude_column"]].to_numpy(dtype=np.float64)[nsa]
+    start = time.perf_counter()
+    polygon = resolver.resolve(longitude, latitude)
+    resolved = polygon >= 0
+    print(f"Spatial resolver: {resolved.sum()} of {nsa.sum()} NSA crimes resolved "
+          f"in {time.perf_counter() - start:.3f} seconds")
+
+    known_names = df.loc[~nsa, ['hood_id', 'neighbourhood_name']].astype({'hood_id': str})
+    known_names = known_names.drop_duplicates('hood_id').set_index('hood_id')['neighbourhood_name']
+
+    rows = np.flatnonzero(nsa)[resolved]
+    hood_ids = resolver.hood_ids[polygon[resolved]].astype(str)
+    names = [known_names.get(hood_id, resolver.names[p]) for hood_id, p in zip(hood_ids, polygon[resolved])]
+
+    df = df.copy()
+    df['hood_id'] = df['hood_id'].astype(object)
+    df.iloc[rows, df.columns.get_loc('hood_id')] = hood_ids
+    df.iloc[rows, df.columns.get_loc('neighbourhood_name')] = names
+    return df
+
+
+def load_resolver():
+    """A function which builds the NeighbourhoodResolver configured in config.json, or returns None
+       when the spatial resolver is not configured.
+    """
+
+    settings = load_section("spatial_resolver", DEFAULT_SETTINGS)
+    if not settings["geojson_path"]:
+        return None, settings
+    polygons = load_neighbourhood_polygons(settings["geojson_path"], settings["id_property"],
+                                           settings["name_property"])
+    return NeighbourhoodResolver(polygons, settings["grid_size"]), settings
+
+
+def synthetic_neighbourhoods(count_per_side=12, vertices_per_side=50, seed=0):
+    """A function which generates a count_per_side x count_per_side tiling of wiggly neighbourhood polygons
+       over the Toronto bounding box, for the benchmark.
+    """
+
+    rng = np.random.default_rng(seed)
+    x_edges = np.linspace(-79.64, -79.11, count_per_side + 1)
+    y_edges = np.linspace(43.58, 43.86, count_per_side + 1)
+    amplitude = (x_edges[1] - x_edges[0]) * 0.05
+    steps = np.linspace(0.0, 1.0, vertices_per_side, endpoint=False)
+
+    # Shared wiggles on every internal border, so that neighbouring polygons tile without gaps
+    horizontal = rng.uniform(-amplitude, amplitude, (count_per_side + 1, count_per_side, vertices_per_side))
+    vertical = rng.uniform(-amplitude, amplitude, (count_per_side + 1, count_per_side, vertices_per_side))
+    horizontal[[0, -1]] = 0.0
+    vertical[[0, -1]] = 0.0
+    horizontal[:, :, 0] = 0.0
+    vertical[:, :, 0] = 0.0
+
+    polygons = []
+    for j in range(count_per_side):
+        for i in range(count_per_side):
+            x0, x1, y0, y1 = x_edges[i], x_edges[i + 1], y_edges[j], y_edges[j + 1]
+            bottom = np.column_stack([x0 + steps * (x1 - x0), y0 + horizontal[j, i]])
+            right = np.column_stack([x1 + vertical[i + 1, j], y0 + steps * (y1 - y0)])
+            # walking a shared border backwards meets its wiggles in reverse order, starting from the corner
+            top = np.column_stack([x1 - steps * (x1 - x0), y1 + np.roll(horizontal[j + 1, i][::-1], 1)])
+            left = np.column_stack([x0 + np.roll(vertical[i, j][::-1], 1), y1 - steps * (y1 - y0)])
+            ring = np.vstack([bottom, right, top, left, bottom[:1]])
+            polygons.append((j * count_per_side + i + 1, f"neighbourhood ({j * count_per_side + i + 1})", [ring]))
+    return polygons
+
+
+def benchmark_resolver(point_counts=(100000, 1000000, 4000000), grid_size=DEFAULT_SETTINGS["grid_size"], seed=0):
+    """A function which prints the index build time and the resolution throughput (points per second and per
+       minute) of NeighbourhoodResolver on synthetic neighbourhoods, and returns the measurements.
+    """
+
+    polygons = synthetic_neighbourhoods(seed=seed)
+    start = time.perf_counter()
+    resolver = NeighbourhoodResolver(polygons, grid_size)
+    build_seconds = time.perf_counter() - start
+    edges = sum(len(edges) for edges in resolver.edges)
+    print(f"Index: {len(polygons)} polygons, {edges} edges, {grid_size}x{grid_size} grid, "
+          f"{resolver.boundary.mean():.1%} boundary cells, built in {build_seconds:.3f} seconds")
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for count in point_counts:
+        longitude = rng.uniform(-79.64, -79.11, count)
+        latitude = rng.uniform(43.58, 43.86, count)
+        start = time.perf_counter()
+        resolved = resolver.resolve(longitude, latitude)
+        seconds = time.perf_counter() - start
+        results.append({"points": count, "seconds": seconds, "points_per_second": count / seconds,
+                        "resolved": float((resolved >= 0).mean())})
+        print(f"{count:>10} points: {seconds:.3f} s, {count / seconds:,.0f} points/s, "
+              f"{count / seconds * 60:,.0f} points/min, {(resolved >= 0).mean():.2%} resolved")
+    return {"build_seconds": build_seconds, "runs": results}
+
+
+if __name__ == "__main__":
+    benchmark_resolver()
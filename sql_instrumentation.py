@@ -0,0 +1,269 @@
+
+import json, os, re, time
+
+from pipeline_config import load_section
+
+"""
+************************************  SQL statement instrumentation (opt-in):  ************************************
+Every statement executed through DbConnection.cur is timed when the "sql_instrumentation" section of config.json
+is enabled:
+            "sql_instrumentation": {"enabled": true, "slow_threshold_seconds": 1.0}
+
+Statements slower than the threshold get the plan of their own execution captured with the auto_explain module of
+PostgreSQL. The instrumented connection loads it for its session:
+            LOAD 'auto_explain';
+            SET auto_explain.log_min_duration = <slow_threshold_seconds in ms>;
+            SET auto_explain.log_analyze = on; SET auto_explain.log_buffers = on;
+            SET auto_explain.log_format = json; SET auto_explain.log_level = notice;
+so the server sends the (ANALYZE, BUFFERS) plan of every slow statement, "CREATE TABLE ... AS" included, back as a
+notice which execute() attaches to the statement. log_analyze times every node of every statement of the session,
+which slows the whole load down a little. LOAD of a library outside $libdir/plugins needs a superuser (or
+auto_explain in session_preload_libraries of postgresql.conf); without it the slow statements are only timed.
+
+With "explain_slow_statements": true the plan of the slow statements is still taken when auto_explain can not be
+loaded, by re-running the statement under EXPLAIN (ANALYZE, BUFFERS) inside a transaction which is rolled back (the
+warehouse is left untouched). Every slow statement then runs twice, so a 10 minutes CREATE TABLE AS costs 20
+minutes; for "CREATE TABLE ... AS (SELECT ...)" only the SELECT part is re-run, because the table already exists.
+
+Output (one directory per pipeline run):
+            sql_reports/<run_id>/statements.jsonl     one JSON line per statement, slow ones carry their plan
+            sql_reports/<run_id>/report.txt           summary written by write_sql_report() at the end of main()
+
+The plan is flagged when it shows a sequential scan over a large table or a hash join whose hash did not fit in
+work_mem (more than one batch, i.e. it spilled to disk). Sorts spilling to disk are flagged as well.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "slow_threshold_seconds": 1.0,
+    "large_table_rows": 100000,
+    "report_dir": "sql_reports",
+    "auto_explain": True,
+    "explain_slow_statements": False,
+}
+
+AUTO_EXPLAIN_PATTERN = re.compile(r"duration: ([0-9.]+) ms\s+plan:\s*(\{.*\})\s*$", re.DOTALL)
+
+# Statements which can be prefixed by EXPLAIN
+EXPLAINABLE_STATEMENTS = ("select", "insert", "update", "delete", "with", "values")
+
+CTAS_PATTERN = re.compile(r"^\s*create\s+table\s+\S+\s+as\s*(.*)$", re.IGNORECASE | re.DOTALL)
+
+# The statement log of the current run, shared by every DbConnection opened during the run
+_run_log = None
+
+
+class SqlStatementLog:
+    """
+    The class SqlStatementLog collects the timing of every instrumented statement of one pipeline run and
+    appends it to the statements.jsonl file of the run directory.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.run_id = time.strftime("%Y%m%d_%H%M%S")
+        self.run_dir = os.path.join(settings["report_dir"], self.run_id)
+        self.entries = []
+        os.makedirs(self.run_dir, exist_ok=True)
+
+    def record(self, entry):
+        self.entries.append(entry)
+        with open(os.path.join(self.run_dir, "statements.jsonl"), "a") as log_file:
+            log_file.write(json.dumps(entry, default=str) + "\n")
+
+
+def get_run_log(settings):
+    global _run_log
+    if _run_log is None:
+        _run_log = SqlStatementLog(settings)
+    return _run_log
+
+
+def instrumentation_settings():
+    """A function which returns the sql_instrumentation settings of config.json, or None when disabled."""
+
+    settings = load_section("sql_instrumentation", DEFAULT_SETTINGS)
+    return settings if settings["enabled"] else None
+
+
+class InstrumentedCursor:
+    """
+    The class InstrumentedCursor wraps a Psycopg2 cursor. execute() is timed and slow statements get the plan
+    auto_explain captured during their execution. Every other attribute (fetchall, description, ...) is forwarded
+    to the wrapped cursor, so the pipeline code does not change.
+    """
+
+    def __init__(self, cursor, settings):
+        self._cursor = cursor
+        self._settings = settings
+        self._log = get_run_log(settings)
+        self._auto_explain = settings["auto_explain"] and load_auto_explain(cursor, settings)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - start
+            entry = {"statement": " ".join(str(query).split()), "seconds": round(elapsed, 6),
+                     "rowcount": self._cursor.rowcount}
+            plan = self.auto_explain_plan() if self._auto_explain else None
+            if elapsed >= self._settings["slow_threshold_seconds"]:
+                entry["slow"] = True
+                if plan is None and not self._auto_explain and self._settings["explain_slow_statements"]:
+                    plan = self.explain_analyze(query, vars)
+                if plan is not None:
+                    entry["plan"] = plan
+                    entry["flags"] = find_plan_flags(plan, self._settings["large_table_rows"])
+            self._log.record(entry)
+
+    def auto_explain_plan(self):
+        """A function which takes the auto_explain notices of the last statement out of the connection notices and
+           returns the plan of the slowest one (None when the statement was faster than log_min_duration).
+        """
+
+        notices = self._cursor.connection.notices
+        plans = []
+        for notice in [notice for notice in notices if "plan:" in notice]:
+            notices.remove(notice)
+            found = AUTO_EXPLAIN_PATTERN.search(notice)
+            if found:
+                plan = json.loads(found.group(2))
+                plan["Execution Time"] = float(found.group(1))
+                plans.append(plan)
+        return max(plans, key=lambda plan: plan["Execution Time"]) if plans else None
+
+    def explain_analyze(self, query, vars=None):
+        """A function which re-runs the statement under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) inside a
+           transaction which is rolled back, and returns the plan (None when the statement can not be explained).
+           The statement runs a second time, see the module description.
+        """
+
+        explained_query = explainable_query(str(query))
+        if explained_query is None:
+            return None
+
+        # A separate cursor is used so the result of the instrumented statement stays readable by the caller
+        connection = self._cursor.connection
+        cursor = connection.cursor()
+        autocommit = connection.autocommit
+        try:
+            cursor.execute("BEGIN" if autocommit else "SAVEPOINT explain_analyze")
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + explained_query, vars)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return plan[0]
+        except Exception as e:
+            return {"error": str(e)}
+        finally:
+            try:
+                cursor.execute("ROLLBACK" if autocommit else "ROLLBACK TO SAVEPOINT explain_analyze")
+            except Exception:
+                connection.rollback()
+            cursor.close()
+
+
+def load_auto_explain(cursor, settings):
+    """A function which loads auto_explain for the session of the cursor (see the module description). Returns
+       False when the module can not be loaded.
+    """
+
+    connection = cursor.connection
+    try:
+        cursor.execute("LOAD 'auto_explain'")
+        cursor.execute(f"""SET auto_explain.log_min_duration = {int(settings["slow_threshold_seconds"] * 1000)};
+                            SET auto_explain.log_analyze = on;
+                            SET auto_explain.log_buffers = on;
+                            SET auto_explain.log_format = json;
+                            SET auto_explain.log_level = notice""")
+        if not connection.autocommit:
+            connection.commit()
+        return True
+    except Exception as e:
+        connection.rollback()
+        fallback = "re-run under EXPLAIN ANALYZE" if settings["explain_slow_statements"] else "only timed"
+        print(f"auto_explain could not be loaded ({e}), the slow statements are {fallback} \n")
+        return False
+
+
+def explainable_query(query):
+    """A function which returns the part of a statement which can be prefixed by EXPLAIN ANALYZE,
+       or None for DDL such as ALTER TABLE or DROP TABLE.
+    """
+
+    ctas = CTAS_PATTERN.match(query)
+    if ctas:
+        query = ctas.group(1).strip()
+        # "create table x as (select ...)" keeps its SELECT in parentheses
+        if query.startswith("(") and query.endswith(")"):
+            query = query[1:-1]
+
+    first_word = query.strip().split(None, 1)[0].lower() if query.strip() else ""
+    return query if first_word in EXPLAINABLE_STATEMENTS else None
+
+
+def find_plan_flags(plan, large_table_rows):
+    """A function which walks an EXPLAIN (FORMAT JSON) plan and returns the list of suspicious nodes:
+       sequential scans over large tables and hash joins or sorts which spilled to disk.
+    """
+
+    flags = []
+    nodes = [(plan.get("Plan", {}), None)]
+    while nodes:
+        node, parent = nodes.pop()
+        node_type = node.get("Node Type")
+        rows = node.get("Actual Rows", 0) * max(node.get("Actual Loops", 1), 1)
+
+        if node_type == "Seq Scan" and rows >= large_table_rows:
+            flags.append(f"seq scan on {node.get('Relation Name')} ({rows} rows)")
+
+        if node_type == "Hash" and max(node.get("Hash Batches", 1), node.get("Original Hash Batches", 1)) > 1:
+            join = parent.get("Node Type") if parent else "hash"
+            flags.append(f"{join.lower()} spilled to disk ({node.get('Hash Batches')} batches, "
+                         f"{node.get('Peak Memory Usage')} kB in memory)")
+
+        if node.get("Sort Space Type") == "Disk":
+            flags.append(f"sort spilled to disk ({node.get('Sort Space Used')} kB, {node.get('Sort Method')})")
+
+        for child in node.get("Plans", []):
+            nodes.append((child, node))
+    return flags
+
+
+def write_sql_report():
+    """A function which writes the summary report.txt of the current run: the statements sorted from the
+       slowest, with the flags found in their plans. It does nothing when the instrumentation is disabled.
+    """
+
+    if _run_log is None:
+        return None
+
+    entries = sorted(_run_log.entries, key=lambda entry: entry["seconds"], reverse=True)
+    lines = [f"SQL statement report for run {_run_log.run_id}",
+             f"statements: {len(entries)}, total: {sum(entry['seconds'] for entry in entries):.3f} seconds, "
+             f"slow (>= {_run_log.settings['slow_threshold_seconds']} s): {sum(1 for e in entries if e.get('slow'))}",
+             ""]
+    for entry in entries:
+        lines.append(f"{entry['seconds']:10.3f} s  {entry['statement'][:200]}")
+        plan = entry.get("plan")
+        if plan and "error" not in plan:
+            planned = f", {plan['Planning Time']} ms planned" if "Planning Time" in plan else ""
+            lines.append(f"{'':14}plan: {plan.get('Execution Time')} ms executed{planned}")
+        elif plan:
+            lines.append(f"{'':14}plan not captured: {plan['error']}")
+        for flag in entry.get("flags", []):
+            lines.append(f"{'':14}FLAG: {flag}")
+
+    report_path = os.path.join(_run_log.run_dir, "report.txt")
+    with open(report_path, "w") as report_file:
+        report_file.write("\n".join(lines) + "\n")
+    print(f"SQL statement report written to {report_path} \n")
+    return report_path
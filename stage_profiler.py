@@ -0,0 +1,207 @@
+
+import cProfile, functools, io, json, os, pstats, sys, threading, time, tracemalloc
+from collections import Counter
+
+from pipeline_config import load_section
+
+"""
+************************************  Per-stage profiling hooks (opt-in):  ************************************
+The stages of A02_Team_V04.py (etl_source_data, etl_crime_date_data, transform_weather_data,
+transform_neighbourhood_data, etl_fact_table) are decorated with @profiled_stage. When the "stage_profiling" section
+of config.json is enabled, every call of a stage is profiled:
+            "stage_profiling": {"enabled": true, "cpu": true, "memory": true}
+
+Output (one directory per pipeline run):
+            profile_reports/<run_id>/<stage>.pstats        cProfile statistics (python -m pstats <file>)
+            profile_reports/<run_id>/<stage>.txt           top functions by cumulative and own time
+            profile_reports/<run_id>/<stage>.collapsed     sampled call stacks, one "frame;frame;frame count" per
+                                                           line (input of flamegraph.pl / speedscope)
+            profile_reports/<run_id>/<stage>.memory.txt    tracemalloc peak and top allocation sites of the stage
+            profile_reports/<run_id>/stages.jsonl          wall time, CPU time and peak memory of every stage
+
+cProfile only records caller/callee pairs, so the collapsed stacks come from a sampling thread reading the stack of
+the profiled thread every sample_interval_seconds. Two runs are compared with:
+            python stage_profiler.py profile_reports/<run_a> profile_reports/<run_b>
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "cpu": True,
+    "memory": True,
+    "report_dir": "profile_reports",
+    "sample_interval_seconds": 0.005,
+    "top_functions": 40,
+    "top_allocations": 25,
+    "tracemalloc_frames": 10,
+}
+
+# The run directory of the current run, shared by every profiled stage
+_run_dir = None
+
+
+def get_run_dir(settings):
+    global _run_dir
+    if _run_dir is None:
+        _run_dir = os.path.join(settings["report_dir"], time.strftime("%Y%m%d_%H%M%S"))
+        os.makedirs(_run_dir, exist_ok=True)
+    return _run_dir
+
+
+class StackSampler:
+    """
+    The class StackSampler samples the call stack of one thread from a background thread and counts the
+    collapsed stacks ("outer;...;inner").
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, "w") as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write(f"{stack} {count}\n")
+
+
+def write_pstats_text(profile, path, top_functions):
+    stream = io.StringIO()
+    statistics = pstats.Stats(profile, stream=stream)
+    statistics.sort_stats("cumulative").print_stats(top_functions)
+    statistics.sort_stats("tottime").print_stats(top_functions)
+    with open(path, "w") as text_file:
+        text_file.write(stream.getvalue())
+    return statistics.total_tt
+
+
+def write_memory_report(stage, start_snapshot, end_snapshot, peak, path, top_allocations):
+    lines = [f"Stage {stage}: peak traced memory {peak / 2 ** 20:.1f} MiB", "",
+             f"Top {top_allocations} allocation sites still alive at the end of the stage (by size):"]
+    lines += [str(statistic) for statistic in end_snapshot.statistics("lineno")[:top_allocations]]
+    lines += ["", f"Top {top_allocations} differences against the start of the stage:"]
+    lines += [str(statistic) for statistic in end_snapshot.compare_to(start_snapshot, "lineno")[:top_allocations]]
+    with open(path, "w") as memory_file:
+        memory_file.write("\n".join(lines) + "\n")
+
+
+def profile_call(stage, function, args, kwargs, settings):
+    """A function which runs one stage under cProfile, the stack sampler and tracemalloc and writes its files."""
+
+    run_dir = get_run_dir(settings)
+    entry = {"stage": stage, "started_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    started_tracing = False
+    if settings["memory"]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(settings["tracemalloc_frames"])
+            started_tracing = True
+        tracemalloc.reset_peak()
+        start_snapshot = tracemalloc.take_snapshot()
+
+    profile = cProfile.Profile() if settings["cpu"] else None
+    sampler = StackSampler(threading.get_ident(), settings["sample_interval_seconds"]) if settings["cpu"] else None
+    start = time.perf_counter()
+    try:
+        if profile is not None:
+            with sampler:
+                profile.enable()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    profile.disable()
+        return function(*args, **kwargs)
+    finally:
+        entry["wall_seconds"] = round(time.perf_counter() - start, 6)
+        # The memory of the stage is captured before the profile files are written
+        if settings["memory"]:
+            end_snapshot = tracemalloc.take_snapshot()
+            entry["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        if profile is not None:
+            profile.dump_stats(os.path.join(run_dir, stage + ".pstats"))
+            entry["cpu_seconds"] = round(write_pstats_text(profile, os.path.join(run_dir, stage + ".txt"),
+                                                           settings["top_functions"]), 6)
+            sampler.write(os.path.join(run_dir, stage + ".collapsed"))
+            entry["stack_samples"] = sum(sampler.stacks.values())
+        if settings["memory"]:
+            write_memory_report(stage, start_snapshot, end_snapshot, entry["peak_bytes"],
+                                os.path.join(run_dir, stage + ".memory.txt"), settings["top_allocations"])
+            if started_tracing:
+                tracemalloc.stop()
+        with open(os.path.join(run_dir, "stages.jsonl"), "a") as stages_file:
+            stages_file.write(json.dumps(entry) + "\n")
+        print(f"Profiled stage {stage}: {entry['wall_seconds']:.3f} seconds, report in {run_dir}")
+
+
+def profiled_stage(function):
+    """A decorator which profiles every call of a pipeline stage when stage profiling is enabled
+       (the settings are read at call time, the stage runs unchanged otherwise).
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        settings = load_section("stage_profiling", DEFAULT_SETTINGS)
+        if not settings["enabled"]:
+            return function(*args, **kwargs)
+        return profile_call(function.__name__, function, args, kwargs, settings)
+    return wrapper
+
+
+def read_stages(run_dir):
+    stages = {}
+    with open(os.path.join(run_dir, "stages.jsonl")) as stages_file:
+        for line in stages_file:
+            entry = json.loads(line)
+            stages[entry["stage"]] = entry
+    return stages
+
+
+def compare_runs(run_dir_a, run_dir_b, top_functions=10):
+    """A function which prints the wall time / peak memory of every stage of two runs, and the functions whose
+       cumulative time changed the most.
+    """
+
+    stages_a, stages_b = read_stages(run_dir_a), read_stages(run_dir_b)
+    print(f"{'stage':32} {'wall a':>10} {'wall b':>10} {'change':>8} {'peak a MiB':>11} {'peak b MiB':>11}")
+    for stage in list(stages_a) + [stage for stage in stages_b if stage not in stages_a]:
+        a, b = stages_a.get(stage, {}), stages_b.get(stage, {})
+        wall_a, wall_b = a.get("wall_seconds"), b.get("wall_seconds")
+        change = f"{(wall_b - wall_a) / wall_a * 100:+.1f}%" if wall_a and wall_b else ""
+        peak_a = f"{a['peak_bytes'] / 2 ** 20:.1f}" if "peak_bytes" in a else ""
+        peak_b = f"{b['peak_bytes'] / 2 ** 20:.1f}" if "peak_bytes" in b else ""
+        print(f"{stage:32} {wall_a or '':>10} {wall_b or '':>10} {change:>8} {peak_a:>11} {peak_b:>11}")
+
+        paths = [os.path.join(run_dir, stage + ".pstats") for run_dir in (run_dir_a, run_dir_b)]
+        if all(os.path.exists(path) for path in paths):
+            cumulative = [{function: values[3] for function, values in pstats.Stats(path).stats.items()}
+                          for path in paths]
+            deltas = sorted(((cumulative[1].get(function, 0.0) - cumulative[0].get(function, 0.0), function)
+                             for function in set(cumulative[0]) | set(cumulative[1])),
+                            key=lambda delta: -abs(delta[0]))
+            for delta, (file_name, line, name) in [delta for delta in deltas if delta[0] != 0][:top_functions]:
+                print(f"    {delta:+10.3f}s  {name} ({os.path.basename(file_name)}:{line})")
+
+
+if __name__ == '__main__':
+    compare_runs(sys.argv[1], sys.argv[2])
@@ -0,0 +1,174 @@
+
+import numpy as np
+import pandas as pd
+
+"""
+************************************  Nearest weather station per neighbourhood:  ************************************
+The weather ingestion keeps the station of every observation (climate_id, station_name, longitude, latitude), so
+several Environment Canada stations can be loaded at once. Every neighbourhood is attached to the station nearest to
+its centroid and the crimes of the neighbourhood get the daily climate of that station.
+
+The station coordinates are projected to kilometres (equirectangular projection around the mean latitude, accurate
+at the scale of a city) and indexed once in a KDTree, then every neighbourhood centroid is resolved with a nearest
+neighbour query.
+
+The centroid of a neighbourhood is the centroid of its polygon when the spatial resolver is configured (see
+spatial_resolver.py), otherwise the mean coordinates of its crimes. Neighbourhoods without any coordinates get the
+station with the most observations.
+"""
+
+
+KM_PER_DEGREE_LATITUDE = 110.574
+KM_PER_DEGREE_LONGITUDE_AT_EQUATOR = 111.320
+
+STATION_COLUMNS = ['climate_id', 'station_name', 'longitude', 'latitude']
+
+
+def project_to_km(longitude, latitude, reference_latitude):
+    """A function which projects longitude/latitude degrees to x/y kilometres (equirectangular)."""
+
+    x = np.asarray(longitude, dtype=np.float64) * KM_PER_DEGREE_LONGITUDE_AT_EQUATOR * np.cos(np.radians(reference_latitude))
+    y = np.asarray(latitude, dtype=np.float64) * KM_PER_DEGREE_LATITUDE
+    return np.column_stack([x, y])
+
+
+class KDTree:
+    """
+    The class KDTree is a static 2-d tree stored in flat arrays: node i keeps the point index, the split axis and
+    the indexes of its left and right children (-1 when absent). It is built once by median splits and answers
+    nearest neighbour queries by branch-and-bound.
+    """
+
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=np.float64)
+        count = len(self.points)
+        self.point = np.full(count, -1, dtype=np.int64)
+        self.axis = np.zeros(count, dtype=np.int64)
+        self.left = np.full(count, -1, dtype=np.int64)
+        self.right = np.full(count, -1, dtype=np.int64)
+        self.size = 0
+        self.root = self.build(np.arange(count), 0)
+
+    def build(self, indices, depth):
+        if len(indices) == 0:
+            return -1
+        axis = depth % self.points.shape[1]
+        indices = indices[np.argsort(self.points[indices, axis], kind="stable")]
+        median = len(indices) // 2
+
+        node = self.size
+        self.size += 1
+        self.point[node] = indices[median]
+        self.axis[node] = axis
+        self.left[node] = self.build(indices[:median], depth + 1)
+        self.right[node] = self.build(indices[median + 1:], depth + 1)
+        return node
+
+    def query_one(self, target):
+        best_index, best_distance = -1, np.inf
+        stack = [self.root] if self.root >= 0 else []
+        while stack:
+            node = stack.pop()
+            point = self.points[self.point[node]]
+            distance = float(np.sum((point - target) ** 2))
+            if distance < best_distance:
+                best_index, best_distance = self.point[node], distance
+
+            difference = target[self.axis[node]] - point[self.axis[node]]
+            near, far = (self.left[node], self.right[node]) if difference < 0 else (self.right[node], self.left[node])
+            # the far side can only hold a nearer point if the splitting plane is closer than the best distance
+            if far >= 0 and difference * difference < best_distance:
+                stack.append(far)
+            if near >= 0:
+                stack.append(near)
+        return best_index, np.sqrt(best_distance)
+
+    def query(self, targets):
+        """A function which returns the index of the nearest point and its distance for every target."""
+
+        targets = np.asarray(targets, dtype=np.float64)
+        indices = np.empty(len(targets), dtype=np.int64)
+        distances = np.empty(len(targets), dtype=np.float64)
+        for i, target in enumerate(targets):
+            indices[i], distances[i] = self.query_one(target)
+        return indices, distances
+
+
+def weather_stations(df_weather):
+    """A function which returns one row per weather station (climate_id, station_name, longitude, latitude),
+       ordered from the station with the most observations.
+    """
+
+    counts = df_weather['climate_id'].value_counts()
+    df_stations = df_weather[STATION_COLUMNS].drop_duplicates('climate_id').set_index('climate_id')
+    df_stations = df_stations.loc[counts.index].reset_index()
+    return df_stations
+
+
+def polygon_centroid(edges):
+    """A function which returns the area-weighted (shoelace) centroid of a polygon given as its edge array
+       [x1, y1, x2, y2] (holes oriented against the outer ring are subtracted), or the mean of its vertices when
+       its area is zero.
+    """
+
+    # relative to the first vertex, so the cross products of longitudes and latitudes keep their precision
+    origin = edges[0, :2]
+    x1, y1 = edges[:, 0] - origin[0], edges[:, 1] - origin[1]
+    x2, y2 = edges[:, 2] - origin[0], edges[:, 3] - origin[1]
+    cross = x1 * y2 - x2 * y1
+    area = cross.sum() / 2
+    if abs(area) < 1e-15:
+        return edges[:, :2].mean(axis=0)
+    return origin + np.array([((x1 + x2) * cross).sum(), ((y1 + y2) * cross).sum()]) / (6 * area)
+
+
+def neighbourhood_centroids(df, longitude_column, latitude_column, resolver=None):
+    """A function which returns the centroid (longitude, latitude) of every hood_id of the crime dataframe:
+       the polygon centroid when a NeighbourhoodResolver is given, otherwise the mean coordinates of the crimes.
+    """
+
+    df_centroids = pd.DataFrame({'hood_id': df['hood_id'].unique()})
+    df_centroids['longitude'] = np.nan
+    df_centroids['latitude'] = np.nan
+
+    if longitude_column in df.columns and latitude_column in df.columns:
+        coordinates = df[['hood_id', longitude_column, latitude_column]]
+        # (0, 0) is used by the open data for hidden locations
+        coordinates = coordinates[(coordinates[longitude_column] != 0) & (coordinates[latitude_column] != 0)]
+        means = coordinates.groupby('hood_id')[[longitude_column, latitude_column]].mean()
+        df_centroids['longitude'] = df_centroids['hood_id'].map(means[longitude_column])
+        df_centroids['latitude'] = df_centroids['hood_id'].map(means[latitude_column])
+
+    if resolver is not None:
+        polygon_centroids = {int(hood_id): polygon_centroid(edges)
+                             for hood_id, edges in zip(resolver.hood_ids, resolver.edges)}
+        for row, hood_id in enumerate(df_centroids['hood_id']):
+            if int(hood_id) in polygon_centroids:
+                df_centroids.loc[row, ['longitude', 'latitude']] = polygon_centroids[int(hood_id)]
+    return df_centroids
+
+
+def assign_nearest_station(df, df_stations, longitude_column, latitude_column, resolver=None):
+    """A function which adds the climate_id column of the nearest weather station to every crime, through the
+       centroid of its neighbourhood. Returns the crime dataframe and the hood_id -> climate_id mapping.
+    """
+
+    df_centroids = neighbourhood_centroids(df, longitude_column, latitude_column, resolver)
+    df_centroids['climate_id'] = df_stations['climate_id'].iloc[0]
+    df_centroids['station_distance_km'] = np.nan
+
+    located = df_centroids['longitude'].notna().to_numpy()
+    if len(df_stations) > 1 and located.any():
+        reference_latitude = df_stations['latitude'].astype(float).mean()
+        tree = KDTree(project_to_km(df_stations['longitude'], df_stations['latitude'], reference_latitude))
+        nearest, distances = tree.query(project_to_km(df_centroids.loc[located, 'longitude'],
+                                                      df_centroids.loc[located, 'latitude'], reference_latitude))
+        df_centroids.loc[located, 'climate_id'] = df_stations['climate_id'].to_numpy()[nearest]
+        df_centroids.loc[located, 'station_distance_km'] = distances
+
+    print(f"Nearest station: {len(df_centroids)} neighbourhoods over {df_centroids['climate_id'].nunique()} of "
+          f"{len(df_stations)} stations, {int((~located).sum())} without coordinates")
+
+    df = df.copy()
+    df['climate_id'] = df['hood_id'].map(df_centroids.set_index('hood_id')['climate_id'])
+    return df, df_centroids
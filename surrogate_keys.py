@@ -0,0 +1,190 @@
+
+import os, socket
+
+import numpy as np
+
+from pipeline_config import load_section
+
+"""
+************************************  Block-reserving surrogate key allocator:  ************************************
+Every surrogate key of the warehouse is handed out by one row of SEQUENCE_TABLE per key (its next free key). A loader
+reserves a contiguous block of keys with one atomic statement and then assigns them locally, in bulk:
+            allocator = KeyAllocator(db, "climate_surrogate_key")
+            keys = allocator.allocate(len(df))          np.arange(first, first + len(df))
+            allocator.close()                           records how many keys of the blocks were used
+or, for one bulk assignment:
+            keys = allocate_surrogate_keys(db, "climate_surrogate_key", len(df))
+
+The reservation is an UPDATE ... RETURNING of the sequence row (the row is locked for one statement only), so several
+loader processes can reserve blocks at the same time and never get the same key, and the keys are assigned without
+a SERIAL default or a max() + row_number() computed by every loader. A block holds at least block_size keys (config.json
+"surrogate_keys": {"block_size": 10000}), or the whole request, so a bulk assignment always gets consecutive keys.
+allocate_surrogate_keys() reserves exactly the keys of its one assignment (the full load); the allocators of the
+watch mode live as long as the watch process and hand out the keys of many micro-batches from blocks of block_size.
+
+Every block is recorded in BLOCK_TABLE with its owner and the number of keys used. key_report() prints, per key, the
+high-water mark (last reserved key), the keys in use in the surrogate table, the keys reserved but not used and the
+gaps. A full load starts the keys of the tables it replaces from 1 again (reset=True).
+"""
+
+
+DEFAULT_SETTINGS = {
+    "block_size": 10000,
+}
+
+SEQUENCE_TABLE = "surrogate_key_sequence_table"
+BLOCK_TABLE = "surrogate_key_block_table"
+
+# key name: surrogate table holding the key
+SURROGATE_TABLES = {
+    "date_surrogate_key": "date_surrogate_table",
+    "event_surrogate_key": "crime_event_surrogate_table",
+    "climate_surrogate_key": "climate_surrogate_table",
+    "neighbourhood_surrogate_key": "neighbourhood_surrogate_table",
+    "hourly_climate_surrogate_key": "hourly_climate_surrogate_table",
+}
+
+
+def ensure_key_tables(db):
+    db.cur.execute(f"""CREATE TABLE IF NOT EXISTS {SEQUENCE_TABLE} (key_name text PRIMARY KEY, next_key bigint NOT NULL);
+                        CREATE TABLE IF NOT EXISTS {BLOCK_TABLE} (key_name text NOT NULL, first_key bigint NOT NULL,
+                            block_size integer NOT NULL, used_count integer NOT NULL, owner text,
+                            reserved_at timestamp NOT NULL, PRIMARY KEY (key_name, first_key))""")
+    db.raw_conn.commit()
+
+
+def ensure_key_sequence(db, key_name, reset=False):
+    """A function which creates the sequence row of a key (after the keys already in its surrogate table), or
+       starts it again from 1 when reset is True (full load).
+    """
+
+    ensure_key_tables(db)
+    if reset:
+        db.cur.execute(f"""INSERT INTO {SEQUENCE_TABLE} (key_name, next_key) VALUES (%s, 1)
+                            ON CONFLICT (key_name) DO UPDATE SET next_key = 1;
+                            DELETE FROM {BLOCK_TABLE} WHERE key_name = %s""", (key_name, key_name))
+        db.raw_conn.commit()
+        return
+
+    db.cur.execute(f"INSERT INTO {SEQUENCE_TABLE} (key_name, next_key) VALUES (%s, 1) ON CONFLICT DO NOTHING", (key_name,))
+    table_name = SURROGATE_TABLES[key_name]
+    db.cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+    if db.cur.fetchone()[0]:
+        # keys assigned before the allocator (or by a full load) are never handed out again
+        db.cur.execute(f"""UPDATE {SEQUENCE_TABLE} SET next_key = greatest(next_key,
+                                (SELECT coalesce(max({key_name}), 0) + 1 FROM {table_name}))
+                            WHERE key_name = %s""", (key_name,))
+    db.raw_conn.commit()
+
+
+def key_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def reserve_block(db, key_name, size):
+    """A function which reserves `size` consecutive keys (one atomic statement) and returns the first one."""
+
+    db.cur.execute(f"""WITH reserved AS (
+                            UPDATE {SEQUENCE_TABLE} SET next_key = next_key + %(size)s WHERE key_name = %(key_name)s
+                            RETURNING next_key - %(size)s AS first_key)
+                        INSERT INTO {BLOCK_TABLE} (key_name, first_key, block_size, used_count, owner, reserved_at)
+                        SELECT %(key_name)s, first_key, %(size)s, 0, %(owner)s, now() FROM reserved
+                        RETURNING first_key""", {"key_name": key_name, "size": int(size), "owner": key_owner()})
+    row = db.cur.fetchone()
+    db.raw_conn.commit()
+    if row is None:
+        raise KeyError(f"no key sequence {key_name!r}, call ensure_key_sequence() first")
+    return row[0]
+
+
+class KeyAllocator:
+    """
+    The class KeyAllocator hands out the keys of the blocks it reserved, block by block
+    (see the module description).
+    """
+
+    def __init__(self, db, key_name, block_size=None, reset=False):
+        self.db = db
+        self.key_name = key_name
+        self.block_size = block_size or load_section("surrogate_keys", DEFAULT_SETTINGS)["block_size"]
+        self.blocks = []
+        ensure_key_sequence(db, key_name, reset)
+
+    def allocate(self, count):
+        """A function which returns `count` consecutive keys. The rest of the current block is left unused (a gap)
+           when it is too small.
+        """
+
+        count = int(count)
+        if count == 0:
+            return np.zeros(0, dtype=np.int64)
+        if not self.blocks or self.blocks[-1][1] - self.blocks[-1][2] < count:
+            size = max(count, self.block_size)
+            self.blocks.append([reserve_block(self.db, self.key_name, size), size, 0])
+        block = self.blocks[-1]
+        first = block[0] + block[2]
+        block[2] += count
+        return np.arange(first, first + count, dtype=np.int64)
+
+    def close(self):
+        """A function which records the number of keys used in every block of the allocator."""
+
+        for first_key, _, used_count in self.blocks:
+            self.db.cur.execute(f"UPDATE {BLOCK_TABLE} SET used_count = %s WHERE key_name = %s AND first_key = %s",
+                                (used_count, self.key_name, first_key))
+        self.db.raw_conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def allocate_surrogate_keys(db, key_name, count, reset=False):
+    """A function which returns `count` consecutive keys of one block (one bulk assignment). reset starts the keys
+       from 1 again (a full load replacing the surrogate table).
+    """
+
+    with KeyAllocator(db, key_name, block_size=1, reset=reset) as allocator:
+        return allocator.allocate(count)
+
+
+def first_surrogate_key(db, key_name, count, reset=False):
+    """A function which reserves `count` consecutive keys and returns the first one, for the set-based inserts
+       (first - 1 + row_number() over (...)).
+    """
+
+    keys = allocate_surrogate_keys(db, key_name, count, reset)
+    return int(keys[0]) if len(keys) else 1
+
+
+def key_report(db):
+    """A function which prints, per key, the high-water mark, the keys in use, the reserved but unused keys and the
+       gaps of the surrogate table, and returns the rows.
+    """
+
+    db.cur.execute(f"SELECT to_regclass('{SEQUENCE_TABLE}') IS NOT NULL")
+    if not db.cur.fetchone()[0]:
+        return []
+    db.cur.execute(f"""SELECT s.key_name, s.next_key - 1, count(b.first_key), coalesce(sum(b.block_size), 0),
+                               coalesce(sum(b.used_count), 0)
+                        FROM {SEQUENCE_TABLE} s LEFT JOIN {BLOCK_TABLE} b USING (key_name)
+                        GROUP BY s.key_name, s.next_key ORDER BY s.key_name""")
+    rows = []
+    for key_name, high_water, blocks, reserved, used in db.cur.fetchall():
+        keys_in_table, max_key = 0, 0
+        table_name = SURROGATE_TABLES.get(key_name)
+        db.cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+        if table_name and db.cur.fetchone()[0]:
+            db.cur.execute(f"SELECT count(*), coalesce(max({key_name}), 0) FROM {table_name}")
+            keys_in_table, max_key = db.cur.fetchone()
+        rows.append({"key_name": key_name, "high_water": high_water, "blocks": blocks, "reserved": int(reserved),
+                     "unused": int(reserved - used), "keys_in_table": keys_in_table, "max_key": max_key,
+                     "gaps": max_key - keys_in_table})
+
+    print(f"{'key':30} {'high water':>11} {'blocks':>7} {'reserved':>10} {'unused':>8} {'in table':>10} {'gaps':>8}")
+    for row in rows:
+        print(f"{row['key_name']:30} {row['high_water']:11} {row['blocks']:7} {row['reserved']:10} {row['unused']:8} "
+              f"{row['keys_in_table']:10} {row['gaps']:8}")
+    return rows
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bitmap_index import BitmapIndex, RoaringBitmap
+
+"""
+Checks the roaring-style bitmaps and the fact_table bitmap index against NumPy set operations and pandas filters:
+            python -m pytest -q
+"""
+
+
+def random_rows(rng, count, high):
+    return np.unique(rng.integers(0, high, count))
+
+
+@pytest.mark.parametrize("count", [10, 3000, 60000])
+def test_roaring_operations_match_numpy_sets(count):
+    rng = np.random.default_rng(count)
+    # sparse and dense containers, and keys present on one side only
+    left, right = random_rows(rng, count, 300000), random_rows(rng, count, 200000)
+    left_bitmap, right_bitmap = RoaringBitmap.from_sorted(left), RoaringBitmap.from_sorted(right)
+
+    assert ((left_bitmap & right_bitmap).to_array() == np.intersect1d(left, right)).all()
+    assert ((left_bitmap | right_bitmap).to_array() == np.union1d(left, right)).all()
+    assert ((left_bitmap - right_bitmap).to_array() == np.setdiff1d(left, right)).all()
+    assert len(left_bitmap) == len(left)
+
+
+def test_append_sorted_across_a_container():
+    rng = np.random.default_rng(6)
+    rows = random_rows(rng, 20000, 140000)
+    bitmap = RoaringBitmap.from_sorted(rows[:9000])
+
+    bitmap.append_sorted(rows[9000:])
+
+    assert (bitmap.to_array() == rows).all()
+
+
+def fact_rows(start, count, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "event_surrogate_key": np.arange(start, start + count), "date_surrogate_key": rng.integers(1, 1000, count),
+        "climate_surrogate_key": rng.integers(1, 3000, count), "neighbourhood_surrogate_key": rng.integers(1, 141, count),
+        "year": rng.integers(2017, 2021, count), "month": rng.integers(1, 13, count),
+        "crime_type": rng.choice(["assault", "robbery", "theft over"], count),
+        "location_type": rng.choice(["apartment", "streets"], count), "hood_id": rng.integers(1, 141, count),
+        "weather": rng.choice(["rain", "snow", None], count),
+    })
+
+
+def test_index_filters_match_pandas_and_survive_save_and_load(tmp_path):
+    df = pd.concat([fact_rows(1, 50000, 7), fact_rows(50001, 30000, 8)], ignore_index=True)
+    index = BitmapIndex()
+    # an incremental load extends the index above its watermark
+    index.extend(df.iloc[:50000])
+    index.extend(df.iloc[50000:])
+    index.save(str(tmp_path / "fact_bitmap_index.npz"))
+    loaded = BitmapIndex.load(str(tmp_path / "fact_bitmap_index.npz"))
+
+    for bitmap_index in (index, loaded):
+        rows = (bitmap_index.eq("crime_type", "assault") & bitmap_index.isin("hood_id", [1, 2, 3])
+                & bitmap_index.eq("weather", "rain")) - bitmap_index.eq("year", 2020)
+        expected = df[(df.crime_type == "assault") & df.hood_id.isin([1, 2, 3]) & (df.weather == "rain")
+                      & (df.year != 2020)]
+        assert (bitmap_index.keys_of(rows)['event_surrogate_key'] == expected['event_surrogate_key'].to_numpy()).all()
+        # the null weathers are in no bitmap
+        assert len(bitmap_index.invert(bitmap_index.isin("weather", ["rain", "snow"]))) == df.weather.isna().sum()
+    assert loaded.watermark == index.watermark == 80000
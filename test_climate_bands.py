@@ -0,0 +1,72 @@
+import re, sqlite3
+
+import numpy as np
+import pandas as pd
+
+from climate_bands import TEMPERATURE_BAND_EDGES, WEATHER_CONDITIONS, round_temperature_sql, round_temperatures, \
+    temperature_band_keys, temperature_band_sql, weather_condition_mask_sql, weather_condition_masks, \
+    weather_condition_tables
+
+"""
+Checks that the SQL expressions of the temperature bands and weather conditions (the incremental loads) give the
+codes of the pandas functions (the full load), evaluated on an in-memory SQLite database:
+            python -m pytest -q
+"""
+
+
+WEATHER_TEXTS = ["Rain", "rain,fog", "Freezing Rain,Fog", "Ice Pellets", "Snow Showers", "Thunderstorms,Heavy Rain",
+                 "Haze", "Smoke", "Mostly Cloudy", "Clear", "normal", "", None]
+
+
+def evaluate_sql(expression, column, values):
+    """A function which evaluates a SQL expression of one column over values, without the PostgreSQL casts."""
+
+    connection = sqlite3.connect(":memory:")
+    connection.execute(f"CREATE TABLE t ({column})")
+    connection.executemany("INSERT INTO t VALUES (?)", [(value,) for value in values])
+    expression = re.sub(r"::\w+", "", expression)
+    return [row[0] for row in connection.execute(f"SELECT {expression} FROM t ORDER BY rowid")]
+
+
+def temperatures():
+    edges = np.array(TEMPERATURE_BAND_EDGES, dtype=float)
+    return np.concatenate([edges - 0.5, edges, edges + 0.5, [-2.5, -0.5, 0.5, 2.5, -45.0, 45.0], np.arange(-30, 40, 0.7)])
+
+
+def test_rounding_is_half_up_on_both_paths():
+    values = temperatures()
+
+    rounded = round_temperatures(values)
+
+    assert rounded.tolist() == evaluate_sql(round_temperature_sql("temperature"), "temperature", values.tolist())
+    assert round_temperatures([-0.5, 2.5, -2.5]).tolist() == [0.0, 3.0, -2.0]
+
+
+def test_temperature_bands_match_the_sql_expression():
+    values = list(temperatures()) + [None]
+
+    keys = temperature_band_keys(values)
+
+    expected = evaluate_sql(temperature_band_sql("temperature"), "temperature", values)
+    assert [None if pd.isna(key) else int(key) for key in keys] == expected
+    assert int(keys[0]) == 1 and int(keys[-2]) == len(TEMPERATURE_BAND_EDGES) + 1
+
+
+def test_weather_condition_masks_match_the_sql_expression():
+    masks = weather_condition_masks(WEATHER_TEXTS)
+
+    assert masks.tolist() == evaluate_sql(weather_condition_mask_sql("weather"), "weather", WEATHER_TEXTS)
+    rain, fog, freezing = (1 << bit for bit, (name, _) in enumerate(WEATHER_CONDITIONS)
+                           if name in ("rain", "fog", "freezing"))
+    assert masks[2] == rain | fog | freezing
+    assert masks[-1] == masks[-2] == masks[-3] == 0
+
+
+def test_weather_condition_tables_hold_every_mask():
+    df_conditions, df_sets, df_bridge = weather_condition_tables()
+
+    assert df_sets['weather_condition_mask'].tolist() == list(range(2 ** len(WEATHER_CONDITIONS)))
+    bits = df_bridge.merge(df_conditions, on='weather_condition_key').groupby('weather_condition_mask')['condition_bit'].sum()
+    assert (bits.index == bits.to_numpy()).all()
+    assert (df_sets.set_index('weather_condition_mask').loc[bits.index, 'condition_count']
+            == df_bridge.groupby('weather_condition_mask').size()).all()
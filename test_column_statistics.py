@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from column_statistics import DEFAULT_SETTINGS, INDEX_CANDIDATES, profile_frame, suggested_indexes
+from warehouse_schema import TABLE_SCHEMAS
+
+"""
+Checks the column profiles, their suggested dtypes and the index candidates of the column statistics catalog:
+            python -m pytest -q
+"""
+
+
+def test_index_candidates_name_existing_columns():
+    for (table_name, column), (source, source_column) in INDEX_CANDIDATES.items():
+        assert column in dict(TABLE_SCHEMAS[table_name]), (table_name, column)
+        assert source in ("crime_source_table", "weather_source_table")
+
+
+def test_profile_suggests_the_most_compact_dtype():
+    rng = np.random.default_rng(10)
+    df = pd.DataFrame({
+        "hood_id": rng.integers(1, 141, 1000),
+        "year": np.where(rng.random(1000) < 0.1, np.nan, rng.integers(2017, 2021, 1000)),
+        "event_number": rng.integers(0, 10 ** 6, 1000),
+        "temperature": rng.integers(-300, 350, 1000) / 10,
+        "longitude": rng.uniform(-79.6, -79.1, 1000),
+        "crime_type": rng.choice(["assault", "robbery"], 1000),
+        "event_id": [f"go-{number}" for number in range(1000)],
+    })
+
+    profile = profile_frame(df, "crime_source_table").set_index('column_name')
+
+    assert profile['suggested_dtype'].to_dict() == {
+        "hood_id": "int16", "year": "Int16", "event_number": "int32", "temperature": "float32",
+        "longitude": "float64", "crime_type": "category", "event_id": str(df['event_id'].dtype)}
+    assert profile.loc['year', 'null_count'] == df['year'].isna().sum()
+    assert profile.loc['crime_type', 'distinct_count'] == 2
+    # the suggested dtypes keep every value
+    for column in ("hood_id", "year", "event_number"):
+        assert (df[column].astype(profile.loc[column, 'suggested_dtype']).astype("float64")
+                .equals(df[column].astype("float64")))
+    assert np.allclose(df['temperature'].astype("float32").astype("float64").round(2), df['temperature'])
+
+
+def test_suggested_indexes_need_selective_columns():
+    profiles = pd.DataFrame([
+        {"source": "crime_source_table", "column_name": "crime_type", "distinct_count": 6, "null_rate": 0.0},
+        {"source": "crime_source_table", "column_name": "hood_id", "distinct_count": 140, "null_rate": 0.0},
+        {"source": "crime_source_table", "column_name": "neighbourhood_name", "distinct_count": 140, "null_rate": 0.9},
+        {"source": "weather_source_table", "column_name": "temperature_mean", "distinct_count": 600, "null_rate": 0.01},
+    ])
+
+    suggestions = suggested_indexes(profiles, DEFAULT_SETTINGS)
+
+    assert [(table_name, column) for table_name, column, _ in suggestions] == [
+        ("neighbourhood_surrogate_table", "hood_id"), ("climate_dimension_table", "temperature_mean")]
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from crime_normalization import CRIME_NORMALIZATION_SPEC, MONTH_MAP, compile_spec, normalize_frame
+
+"""
+Checks the declarative crime normalization against the column by column cleaning it replaced:
+            python -m pytest -q
+"""
+
+
+def crime_frame(rows=500, seed=0):
+    rng = np.random.default_rng(seed)
+    months = np.array([month.capitalize() for month in MONTH_MAP] + ["MARCH", "june"])
+    hood_ids = rng.integers(1, 141, rows).astype(str).astype(object)
+    nsa = rng.random(rows) < 0.1
+    hood_ids[nsa] = "NSA"
+    return pd.DataFrame({
+        "Event_ID": np.char.add("GO-", rng.integers(0, 10 ** 6, rows).astype(str)),
+        "Occurrence_Year": rng.integers(2017, 2021, rows),
+        "Occurrence_Month": months[rng.integers(0, len(months), rows)],
+        "Occurrence_Day": rng.integers(1, 29, rows),
+        "Day_of_Year": rng.integers(1, 366, rows),
+        "Day_of_Week": rng.choice(["Monday    ", "Friday    "], rows),
+        "Location_Type": rng.choice(["Apartment", "Streets, Roads"], rows),
+        "Crime_Type": rng.choice(["Assault", "Auto Theft", "Robbery"], rows),
+        "Neighbourhood_Name": np.where(nsa, "NSA", rng.choice(["Annex", "High Park"], rows)),
+        "Hood_ID": hood_ids,
+    })
+
+
+def reference_normalization(df):
+    """The crime cleaning of etl_source_data() before the normalization spec (STEP#2-1 (4) to (8))."""
+
+    df = df.rename(columns=str.lower)
+    for column_name in ["event_id", "occurrence_month", "location_type", "day_of_week", "crime_type",
+                        "neighbourhood_name"]:
+        df[column_name] = df[column_name].str.lower()
+    df['occurrence_month'] = df['occurrence_month'].map(MONTH_MAP)
+    df['neighbourhood_name'] = df['neighbourhood_name'].replace("nsa", "random")
+    df['hood_id'] = df['hood_id'].replace("NSA", "0")
+    df = df.astype({"occurrence_year": int, "occurrence_month": int, "occurrence_day": int, "day_of_year": int,
+                    "hood_id": int})
+    return df.rename(columns={"occurrence_year": 'year', "occurrence_month": 'month', "occurrence_day": 'day'})
+
+
+def test_normalize_frame_matches_column_by_column_cleaning():
+    df = crime_frame()
+    df_normalized, report = normalize_frame(df, CRIME_NORMALIZATION_SPEC)
+
+    pd.testing.assert_frame_equal(df_normalized, reference_normalization(df), check_dtype=False)
+    assert df_normalized['month'].between(1, 12).all()
+    assert (df_normalized.loc[df['Hood_ID'] == "NSA", 'hood_id'] == 0).all()
+    assert report.total() > 0
+
+
+def test_compile_spec_strategies():
+    plans = {plan.target: plan for plan in compile_spec(CRIME_NORMALIZATION_SPEC, crime_frame(1).columns)}
+
+    assert plans["event_id"].strategy == "direct"
+    assert plans["year"].strategy == "cast"
+    assert plans["month"].strategy == "factorize"
+    assert plans["hood_id"].strategy == "factorize"
+
+
+def test_unmapped_month_cannot_become_an_integer():
+    df = crime_frame(20)
+    df.loc[3, "Occurrence_Month"] = "Smarch"
+
+    with pytest.raises(ValueError):
+        normalize_frame(df, CRIME_NORMALIZATION_SPEC)
@@ -0,0 +1,67 @@
+import numpy as np
+
+from event_bloom import EventBloomFilter, split_new_events
+
+"""
+Checks the event_id Bloom filter (no false negative, false positive rate of its sizing) and the verification of
+its probable hits:
+            python -m pytest -q
+"""
+
+
+class LoadedEvents:
+    """
+    The class LoadedEvents stands for the database connection of split_new_events(): its cursor answers the
+    event_id = ANY(%s) query from a set of loaded events and counts the event_id it was asked for.
+    """
+
+    def __init__(self, event_ids):
+        self.cur = self
+        self.loaded = set(event_ids)
+        self.asked = 0
+        self.rows = []
+
+    def execute(self, sql, params):
+        self.asked += len(params[0])
+        self.rows = [(event_id,) for event_id in params[0] if event_id in self.loaded]
+
+    def fetchall(self):
+        return self.rows
+
+
+def event_ids(start, stop):
+    return np.array([f"go-{number}" for number in range(start, stop)], dtype=object)
+
+
+def test_no_false_negative_and_false_positive_rate():
+    loaded = event_ids(0, 50000)
+    bloom = EventBloomFilter.build(loaded, 0.01)
+
+    assert bloom.might_contain(loaded).all()
+    false_positive_rate = bloom.might_contain(event_ids(50000, 150000)).mean()
+    assert false_positive_rate < 3 * max(bloom.expected_false_positive_rate(), 0.001)
+    assert bloom.hash_count == 7
+
+
+def test_save_and_load(tmp_path):
+    bloom = EventBloomFilter.build(event_ids(0, 1000), 0.01)
+    bloom.save(str(tmp_path / "event_bloom.npz"))
+
+    loaded = EventBloomFilter.load(str(tmp_path / "event_bloom.npz"))
+
+    assert (loaded.bits == bloom.bits).all()
+    assert (loaded.capacity, loaded.count, loaded.hash_count) == (bloom.capacity, bloom.count, bloom.hash_count)
+    values = event_ids(0, 2000)
+    assert (loaded.might_contain(values) == bloom.might_contain(values)).all()
+
+
+def test_split_new_events_only_verifies_the_probable_hits():
+    db = LoadedEvents(event_ids(0, 1000))
+    bloom = EventBloomFilter.build(event_ids(0, 1000), 0.01)
+    incoming = np.concatenate([event_ids(900, 1100), event_ids(950, 960)])
+
+    new_mask = split_new_events(db, bloom, incoming)
+
+    assert (new_mask == ~np.isin(incoming, list(db.loaded))).all()
+    assert db.asked < 150
+    assert len(split_new_events(db, bloom, np.array([], dtype=object))) == 0
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from external_dedup import DEFAULT_SETTINGS, ROW_ORDER_COLUMN, external_drop_duplicates, read_csv_deduplicated
+
+"""
+Checks the out-of-core deduplication of event_id against DataFrame.drop_duplicates(keep='first'):
+            python -m pytest -q
+"""
+
+
+def crime_frame(rows=3000, seed=5):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"event_id": np.char.add("GO-", rng.integers(0, rows // 3, rows).astype(str)),
+                         "hood_id": rng.integers(1, 141, rows), "occurrence_year": rng.integers(2016, 2022, rows)})
+
+
+@pytest.mark.parametrize("partitions, chunk_rows", [(1, 3000), (4, 250), (7, 97)])
+def test_external_drop_duplicates_matches_drop_duplicates(tmp_path, partitions, chunk_rows):
+    df = crime_frame()
+    settings = dict(DEFAULT_SETTINGS, partitions=partitions, chunk_rows=chunk_rows, spill_dir=str(tmp_path))
+    chunks = (df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows))
+    stats = {}
+
+    frames = list(external_drop_duplicates(chunks, ['event_id'], settings, stats=stats))
+
+    deduplicated = pd.concat(frames).drop(columns=[ROW_ORDER_COLUMN]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(deduplicated, df.drop_duplicates(subset=['event_id']).reset_index(drop=True))
+    assert stats["rows_in"] == len(df) and stats["rows_out"] == len(deduplicated)
+    # the spill files are removed
+    assert not list(tmp_path.iterdir())
+
+
+def test_read_csv_deduplicated_on_several_columns(tmp_path):
+    df = crime_frame(1000)
+    df.to_csv(tmp_path / "crimes.csv", index=False)
+    settings = dict(DEFAULT_SETTINGS, partitions=3, chunk_rows=128, spill_dir=str(tmp_path))
+
+    deduplicated = read_csv_deduplicated(str(tmp_path / "crimes.csv"), ['event_id', 'hood_id'], settings,
+                                         keep_rows=lambda rows: rows[rows.occurrence_year.isin([2017, 2018])])
+
+    expected = df.drop_duplicates(subset=['event_id', 'hood_id'])
+    expected = expected[expected.occurrence_year.isin([2017, 2018])].reset_index(drop=True)
+    pd.testing.assert_frame_equal(deduplicated, expected)
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from hourly_climate import asof_join_indices, attach_hourly_climate_key, station_join_keys, to_hour_numbers
+
+"""
+Checks the sorted as-of join of the hourly climate grain against a brute force search:
+            python -m pytest -q
+"""
+
+
+def brute_force_asof(left_times, right_times, tolerance, direction):
+    result = []
+    for left in left_times:
+        distances = right_times - left if direction == "forward" else left - right_times
+        if direction == "nearest":
+            distances = np.abs(distances)
+        candidates = [index for index in range(len(right_times)) if 0 <= distances[index] <= tolerance]
+        # the nearest observation, the earlier one on a tie
+        result.append(min(candidates, key=lambda index: (distances[index], right_times[index]), default=-1))
+    return np.array(result)
+
+
+@pytest.mark.parametrize("direction", ["nearest", "backward", "forward"])
+def test_asof_join_indices_matches_brute_force(direction):
+    rng = np.random.default_rng(1)
+    right_times = np.unique(rng.integers(0, 500, 120))
+    left_times = rng.integers(-10, 510, 400)
+
+    result = asof_join_indices(left_times, right_times, 3, direction)
+
+    expected = brute_force_asof(left_times, right_times, 3, direction)
+    assert (result == expected).all()
+
+
+def test_asof_join_indices_empty_sides():
+    assert (asof_join_indices([1, 2], [], 1) == -1).all()
+    assert len(asof_join_indices([], [1, 2], 1)) == 0
+
+
+def test_station_join_keys_unknown_station():
+    stations = np.array(["A", "C"])
+
+    keys = station_join_keys(["A", "B", "C", "D"], [5, 5, 5, 5], stations)
+
+    assert keys[0] == 5 and keys[2] > keys[0]
+    assert keys[1] == -1 and keys[3] == -1
+
+
+def test_attach_hourly_climate_key_stays_on_the_station_of_the_crime():
+    rng = np.random.default_rng(2)
+    observations = pd.DataFrame([(station, 2019, 3, day, hour) for station in ("A", "B")
+                                 for day in (1, 2) for hour in range(0, 24, 3)],
+                                columns=['climate_id', 'year', 'month', 'day', 'hour'])
+    observations.insert(0, 'hourly_climate_surrogate_key', range(1, len(observations) + 1))
+    crimes = pd.DataFrame({"climate_id": rng.choice(["A", "B", "C"], 200), "year": 2019, "month": 3,
+                           "day": rng.integers(1, 3, 200), "occurrence_hour": rng.integers(0, 24, 200)})
+
+    keys = attach_hourly_climate_key(crimes, observations)['hourly_climate_surrogate_key']
+
+    crime_times = to_hour_numbers(crimes['year'], crimes['month'], crimes['day'], crimes['occurrence_hour'])
+    observation_times = to_hour_numbers(observations['year'], observations['month'], observations['day'],
+                                        observations['hour'])
+    for index, crime in crimes.iterrows():
+        of_station = (observations['climate_id'] == crime['climate_id']).to_numpy()
+        match = brute_force_asof([crime_times[index]], observation_times[of_station], 1, "nearest")[0]
+        if match < 0:
+            assert pd.isna(keys[index])
+        else:
+            assert keys[index] == observations.loc[of_station, 'hourly_climate_surrogate_key'].iloc[match]
+
+
+def test_attach_hourly_climate_key_without_occurrence_hour():
+    crimes = pd.DataFrame({"climate_id": ["A"], "year": [2019], "month": [3], "day": [1]})
+    observations = pd.DataFrame({"hourly_climate_surrogate_key": [1], "climate_id": ["A"], "year": [2019],
+                                 "month": [3], "day": [1], "hour": [0]})
+
+    assert attach_hourly_climate_key(crimes, observations)['hourly_climate_surrogate_key'].isna().all()
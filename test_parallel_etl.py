@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from parallel_etl import PARTITION_KEYS, build_partition_star, merge_partitions
+
+"""
+Checks that the partitions built by the workers of the parallel load merge into one star (unique surrogate keys,
+fact rows referencing the rows of their crime) whatever keys the allocator hands out:
+            python -m pytest -q
+"""
+
+
+def crime_weather_rows(year, crimes, seed):
+    """A function which returns the crime_weather rows of one year: crimes of 3 neighbourhoods and 2 stations."""
+
+    rng = np.random.default_rng(seed)
+    dates = pd.to_datetime(f"{year}-01-01") + pd.to_timedelta(rng.integers(0, 20, crimes), unit="D")
+    df = pd.DataFrame({
+        "event_id": [f"GO-{year}{number:05d}" for number in rng.permutation(crimes)],
+        "crime_type": rng.choice(["assault", "robbery"], crimes),
+        "location_type": rng.choice(["house", "street"], crimes),
+        "year": dates.year, "month": dates.month, "day": dates.day,
+        "day_of_year": dates.dayofyear, "day_of_week": dates.dayofweek,
+        "hood_id": rng.integers(1, 4, crimes),
+    })
+    df['climate_id'] = np.where(df['hood_id'] == 1, "6158355", "6158731")
+    # the weather of a station and day
+    day_seed = df['day'] * 7 + (df['climate_id'] == "6158355")
+    df['temperature_min'] = (day_seed % 5 - 10).astype(float)
+    df['temperature_max'] = df['temperature_min'] + 8
+    df['temperature_mean'] = df['temperature_min'] + 4.5
+    df['weather'] = np.where(day_seed % 3 == 0, "Rain", "normal")
+    df['hourly_climate_surrogate_key'] = rng.integers(1, 50, crimes)
+    return df
+
+
+def partition_result(year, crimes, seed):
+    df_merge = crime_weather_rows(year, crimes, seed)
+    df_hourly_lookup = pd.DataFrame({"hourly_climate_surrogate_key": range(1, 50)})
+    frames = build_partition_star(df_merge)
+    return dict(frames, key=(year,), crime=df_merge, crime_weather=df_merge.copy(), weather=df_merge.head(0),
+                hourly_climate=df_hourly_lookup.copy(), hourly_climate_lookup=df_hourly_lookup,
+                stations=pd.DataFrame({"climate_id": ["6158355", "6158731"]}),
+                station_observations=df_merge['climate_id'].value_counts())
+
+
+def spaced_keys():
+    """A function which returns an allocate(key_name, count) function leaving a gap of 100 keys between blocks."""
+
+    next_keys = {}
+
+    def allocate(key_name, count):
+        first_key = next_keys.get(key_name, 5)
+        next_keys[key_name] = first_key + count + 100
+        return np.arange(first_key, first_key + count)
+
+    return allocate
+
+
+def test_merged_partitions_form_one_star():
+    results = [partition_result(2019, 400, 1), partition_result(2018, 300, 2), partition_result(2020, 1, 3)]
+    df_source = pd.concat([result["crime"] for result in sorted(results, key=lambda result: result["key"])],
+                          ignore_index=True)
+
+    frames = merge_partitions(results, spaced_keys())
+
+    for key_name, frame_names in PARTITION_KEYS.items():
+        keys = frames[frame_names[0]][key_name]
+        assert keys.is_unique, key_name
+        for frame_name in frame_names[1:]:
+            assert frames[frame_name][key_name].isin(keys).all(), (key_name, frame_name)
+
+    # every fact row references the date, event and station-day of its crime
+    df_fact = frames["fact"]
+    assert len(df_fact) == len(df_source)
+    df_fact = df_fact.merge(frames["event_lookup"], on='event_surrogate_key') \
+        .merge(frames["date_lookup"], on='date_surrogate_key') \
+        .merge(frames["climate_lookup"], on='climate_surrogate_key', suffixes=("", "_climate"))
+    df_expected = df_source.set_index('event_id').loc[df_fact['event_id']]
+    for column in ['year', 'month', 'day', 'hood_id', 'climate_id']:
+        assert (df_fact[column].to_numpy() == df_expected[column].to_numpy()).all(), column
+    assert (df_fact[['year', 'month', 'day']].to_numpy() == df_fact[['year_climate', 'month_climate',
+                                                                      'day_climate']].to_numpy()).all()
+
+    # the crime_number of a day counts its crimes over all the partitions
+    crimes_per_day = df_source.groupby(['year', 'month', 'day']).size()
+    assert (df_fact['crime_number'].to_numpy()
+            == crimes_per_day.loc[list(zip(df_fact['year'], df_fact['month'], df_fact['day']))].to_numpy()).all()
+    assert len(frames["climate"]) == len(frames["climate_lookup"]) == \
+        len(df_source.drop_duplicates(['climate_id', 'year', 'month', 'day']))
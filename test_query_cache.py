@@ -0,0 +1,105 @@
+import sqlite3
+
+import pytest
+
+from query_cache import DEFAULT_SETTINGS, EPOCH_TABLE, QueryResultCache, is_cacheable, normalize_sql
+
+"""
+Checks the read-only query detection and the load epoch invalidation of the query result cache, on an in-memory
+SQLite database:
+            python -m pytest -q
+"""
+
+
+class SqliteCursor:
+    """
+    The class SqliteCursor stands for the psycopg2 cursor of the cache over an in-memory SQLite database (to_regclass()
+    is answered from sqlite_master) and counts the queries it runs.
+    """
+
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("CREATE TABLE crimes (hood_id integer, crime_type text)")
+        self.connection.executemany("INSERT INTO crimes VALUES (?, ?)", [(1, "assault"), (2, "robbery")])
+        self.cursor = None
+        self.queries = []
+
+    def execute(self, sql, params=None):
+        self.queries.append(sql)
+        if "to_regclass" in sql:
+            sql, params = "SELECT count(*) > 0 FROM sqlite_master WHERE name = ?", (EPOCH_TABLE,)
+        self.cursor = self.connection.execute(sql, params or ())
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def set_epoch(self, epoch):
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {EPOCH_TABLE} (id integer PRIMARY KEY, epoch bigint)")
+        self.connection.execute(f"INSERT OR REPLACE INTO {EPOCH_TABLE} VALUES (1, ?)", (epoch,))
+
+
+@pytest.mark.parametrize("sql, cacheable", [
+    ("SELECT * FROM crimes", True),
+    ("  with t AS (SELECT 1) SELECT * FROM t;", True),
+    ("SELECT * FROM crimes WHERE crime_type = 'update into'", True),
+    ("SELECT * FROM crimes WHERE crime_type = 'it''s' AND hood_id = 1", True),
+    ("SELECT updated_at, inserted FROM crimes", True),
+    ("WITH moved AS (UPDATE crimes SET hood_id = 2 RETURNING *) SELECT * FROM moved", False),
+    ("WITH gone AS (DELETE FROM crimes RETURNING *) SELECT count(*) FROM gone", False),
+    ("SELECT * INTO crimes_copy FROM crimes", False),
+    ("SELECT * FROM crimes FOR UPDATE", False),
+    ("SELECT * FROM crimes FOR NO KEY UPDATE", False),
+    ("select * from crimes for share", False),
+    ("INSERT INTO crimes VALUES (3, 'theft')", False),
+    ("TRUNCATE crimes", False),
+])
+def test_only_read_only_queries_are_cacheable(sql, cacheable):
+    assert is_cacheable(sql) == cacheable
+
+
+def test_normalization_keeps_the_string_literals():
+    assert normalize_sql("SELECT  *\n FROM Crimes WHERE crime_type = 'Break  And Enter' ;") == \
+        "select * from crimes where crime_type = 'Break  And Enter'"
+
+
+def test_a_new_load_epoch_invalidates_the_cached_results():
+    cur = SqliteCursor()
+    cache = QueryResultCache(dict(DEFAULT_SETTINGS, enabled=True))
+    sql = "SELECT hood_id, crime_type FROM crimes ORDER BY hood_id"
+
+    assert cache.query(cur, sql) == (["hood_id", "crime_type"], [(1, "assault"), (2, "robbery")])
+    cur.connection.execute("INSERT INTO crimes VALUES (3, 'theft')")
+    # the same load: the cached result, the modifying query always runs
+    assert cache.query(cur, "select hood_id,  crime_type from crimes order by hood_id;")[1] == [(1, "assault"),
+                                                                                              (2, "robbery")]
+    cache.query(cur, "UPDATE crimes SET crime_type = crime_type RETURNING hood_id")
+    assert cache.counters["memory_hits"] == 1 and cache.counters["bypassed"] == 1
+
+    cur.set_epoch(1)
+    assert cache.query(cur, sql)[1] == [(1, "assault"), (2, "robbery"), (3, "theft")]
+    assert cache.epoch == 1 and cache.counters["invalidations"] == 1
+
+    # once the epoch table was seen, a hit reads the epoch with one query
+    del cur.queries[:]
+    cache.query(cur, sql)
+    assert len(cur.queries) == 1 and cache.counters["memory_hits"] == 2
+
+
+def test_the_lru_keeps_max_entries(tmp_path):
+    cur = SqliteCursor()
+    cache = QueryResultCache(dict(DEFAULT_SETTINGS, enabled=True, max_entries=2, disk_dir=str(tmp_path)))
+
+    for hood_id in (1, 2, 1, 3):
+        cache.query(cur, "SELECT crime_type FROM crimes WHERE hood_id = ?", (hood_id,))
+
+    assert len(cache.entries) == 2 and cache.counters["evictions"] == 1
+    # an evicted result is read back from the disk tier
+    cache.query(cur, "SELECT crime_type FROM crimes WHERE hood_id = ?", (2,))
+    assert cache.counters["disk_hits"] == 1 and cache.counters["misses"] == 3
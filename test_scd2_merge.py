@@ -0,0 +1,97 @@
+import datetime, hashlib, re, sqlite3
+
+from scd2_merge import ensure_scd2_table, scd2_merge
+from warehouse_schema import column_types
+
+"""
+Runs the set-based SCD type 2 merge of neighbourhood_dimension_table on an in-memory SQLite database (the few
+PostgreSQL constructs of scd2_merge.py are translated by SqliteConnection):
+            python -m pytest -q
+"""
+
+
+# PostgreSQL -> SQLite rewrites of the statements of scd2_merge.py
+TRANSLATIONS = [
+    (r"::text", ""),
+    (r"ADD COLUMN IF NOT EXISTS", "ADD COLUMN"),
+    (r"UPDATE (\w+) (\w) SET", r"UPDATE \1 AS \2 SET"),
+    (r"%\((\w+)\)s", r":\1"),
+    (r"%s", "?"),
+]
+
+
+class SqliteConnection:
+    """
+    The class SqliteConnection stands for the DbConnection of the merge (db.cur and db.raw_conn) over an in-memory
+    SQLite database, with the md5() and concat_ws() functions of PostgreSQL.
+    """
+
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.create_function("md5", 1, lambda text: hashlib.md5(text.encode()).hexdigest())
+        self.connection.create_function("concat_ws", -1, lambda separator, *values: separator.join(values))
+        self.cur = self
+        self.raw_conn = self
+        self.cursor = None
+
+    def execute(self, sql, params=None):
+        if "information_schema.columns" in sql:
+            self.cursor = self.connection.execute("SELECT name FROM pragma_table_info(?)", params)
+            return
+        for pattern, replacement in TRANSLATIONS:
+            sql = re.sub(pattern, replacement, sql)
+        if isinstance(params, dict):
+            params = {name: str(value) for name, value in params.items()}
+        elif params is not None:
+            params = [str(value) if isinstance(value, datetime.datetime) else value for value in params]
+        # several statements in one query string run one by one
+        for statement in filter(str.strip, sql.split(";")):
+            self.cursor = self.connection.execute(statement, params if params is not None else ())
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def commit(self):
+        self.connection.commit()
+
+
+def merge_load(db, neighbourhoods, load_time):
+    db.connection.execute("CREATE TABLE neighbourhood_staging_table (hood_id integer, neighbourhood_name text)")
+    db.connection.executemany("INSERT INTO neighbourhood_staging_table VALUES (?, ?)", neighbourhoods)
+    return scd2_merge(db, "neighbourhood_dimension_table", "neighbourhood_staging_table", ['hood_id'],
+                      ['neighbourhood_name'], load_time)
+
+
+def versions(db):
+    db.cur.execute("""SELECT hood_id, neighbourhood_name, valid_from, valid_to, is_current
+                        FROM neighbourhood_dimension_table ORDER BY hood_id, valid_from""")
+    return db.cur.fetchall()
+
+
+def test_scd2_merge_keeps_the_history_of_the_neighbourhoods():
+    db = SqliteConnection()
+    first_load, second_load, third_load = (datetime.datetime(2021, month, 1) for month in (1, 2, 3))
+    ensure_scd2_table(db, "neighbourhood_dimension_table", ['hood_id'], ['neighbourhood_name'],
+                      column_types("neighbourhood_dimension_table"))
+
+    assert merge_load(db, [(1, "annex"), (2, "high park")], first_load) == (0, 2)
+    # hood 1 is renamed, hood 2 is unchanged, hood 3 is new
+    assert merge_load(db, [(1, "the annex"), (2, "high park"), (3, "casa loma")], second_load) == (1, 2)
+    # a load without hood 1 and 3 keeps their current version
+    assert merge_load(db, [(2, "high park")], third_load) == (0, 0)
+
+    assert versions(db) == [
+        (1, "annex", str(first_load), str(second_load), 0),
+        (1, "the annex", str(second_load), None, 1),
+        (2, "high park", str(first_load), None, 1),
+        (3, "casa loma", str(second_load), None, 1),
+    ]
+    db.cur.execute("SELECT name FROM sqlite_master WHERE name = 'neighbourhood_staging_table'")
+    assert db.cur.fetchall() == []
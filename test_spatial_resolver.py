@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from spatial_resolver import NeighbourhoodResolver, points_in_edges, resolve_nsa_neighbourhoods, \
+    synthetic_neighbourhoods
+
+"""
+Checks the grid-indexed point-in-polygon test of the NSA resolution against a test of every polygon:
+            python -m pytest -q
+"""
+
+
+def brute_force_resolve(resolver, longitude, latitude):
+    result = np.full(len(longitude), -1, dtype=np.int64)
+    for polygon, edges in enumerate(resolver.edges):
+        result[points_in_edges(longitude, latitude, edges)] = polygon
+    return result
+
+
+def test_resolve_matches_every_polygon_test():
+    polygons = synthetic_neighbourhoods(count_per_side=6, vertices_per_side=20, seed=3)
+    rng = np.random.default_rng(3)
+    # the points around the bounding box fall outside every polygon
+    longitude = rng.uniform(-79.70, -79.05, 5000)
+    latitude = rng.uniform(43.55, 43.90, 5000)
+
+    for grid_size in (1, 16, 64):
+        resolver = NeighbourhoodResolver(polygons, grid_size)
+        assert (resolver.resolve(longitude, latitude) == brute_force_resolve(resolver, longitude, latitude)).all()
+
+
+def test_resolve_polygon_with_a_hole():
+    square = np.array([[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], dtype=float)
+    hole = np.array([[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]], dtype=float)
+    resolver = NeighbourhoodResolver([(7, "ring", [square, hole])], grid_size=8)
+
+    resolved = resolver.resolve([1.0, 5.0, 9.5, 11.0, np.nan], [1.0, 5.0, 9.5, 5.0, 1.0])
+
+    assert resolved.tolist() == [0, -1, 0, -1, -1]
+
+
+def test_resolve_nsa_neighbourhoods_keeps_the_known_names():
+    square = np.array([[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], dtype=float)
+    resolver = NeighbourhoodResolver([(7, "polygon name", [square])], grid_size=4)
+    settings = {"longitude_column": "long", "latitude_column": "lat"}
+    df = pd.DataFrame({"hood_id": ["7", "NSA", "NSA"], "neighbourhood_name": ["Annex", "NSA", "NSA"],
+                       "long": [1.0, 2.0, 20.0], "lat": [1.0, 2.0, 20.0]})
+
+    df = resolve_nsa_neighbourhoods(df, resolver, settings)
+
+    assert df['hood_id'].tolist() == ["7", "7", "NSA"]
+    assert df['neighbourhood_name'].tolist() == ["Annex", "Annex", "NSA"]
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from station_resolver import KDTree, assign_nearest_station, polygon_centroid
+
+"""
+Checks the nearest station assignment (KDTree, polygon centroids) against a brute force search:
+            python -m pytest -q
+"""
+
+
+def test_kdtree_matches_brute_force():
+    rng = np.random.default_rng(4)
+    points = rng.uniform(0, 100, (200, 2))
+    targets = rng.uniform(-10, 110, (500, 2))
+
+    indices, distances = KDTree(points).query(targets)
+
+    all_distances = np.sqrt(((targets[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    assert np.allclose(distances, all_distances.min(axis=1))
+    assert np.allclose(all_distances[np.arange(len(targets)), indices], distances)
+
+
+def test_kdtree_of_one_point():
+    indices, distances = KDTree([[1.0, 1.0]]).query([[4.0, 5.0]])
+
+    assert indices.tolist() == [0] and np.isclose(distances[0], 5.0)
+
+
+def test_polygon_centroid():
+    # the unit square around (10, 20), with a hole in its lower left quarter wound against the outer ring
+    outer = np.array([[9.5, 19.5], [10.5, 19.5], [10.5, 20.5], [9.5, 20.5], [9.5, 19.5]])
+    hole = np.array([[9.5, 19.5], [9.5, 20.0], [10.0, 20.0], [10.0, 19.5], [9.5, 19.5]])
+    edges_of = lambda ring: np.hstack([ring[:-1], ring[1:]])
+
+    assert np.allclose(polygon_centroid(edges_of(outer)), [10.0, 20.0])
+    # three quarters of the square left: the centroid moves away from the hole
+    assert np.allclose(polygon_centroid(np.vstack([edges_of(outer), edges_of(hole)])), [10 + 1 / 12, 20 + 1 / 12])
+
+
+def test_assign_nearest_station_by_neighbourhood_centroid():
+    df_stations = pd.DataFrame({"climate_id": ["A", "B"], "station_name": ["west", "east"],
+                                "longitude": [-79.6, -79.2], "latitude": [43.7, 43.7]})
+    df = pd.DataFrame({"hood_id": [1, 1, 2, 3], "long": [-79.55, -79.45, -79.25, 0.0],
+                       "lat": [43.70, 43.72, 43.68, 0.0]})
+
+    df, df_centroids = assign_nearest_station(df, df_stations, "long", "lat")
+
+    # hood 3 only has hidden (0, 0) locations: the station with the most observations (the first one)
+    assert df['climate_id'].tolist() == ["A", "A", "B", "A"]
+    assert pd.isna(df_centroids.set_index('hood_id').loc[3, 'station_distance_km'])
@@ -0,0 +1,84 @@
+import numpy as np
+
+from surrogate_keys import KeyAllocator, allocate_surrogate_keys, first_surrogate_key
+
+"""
+Checks the block-reserving surrogate key allocator against an in-memory key sequence:
+            python -m pytest -q
+"""
+
+
+class KeySequence:
+    """
+    The class KeySequence stands for the database connection of the allocator: its cursor runs the statements of
+    surrogate_keys.py on an in-memory sequence (next key per key name) and block table, shared by every allocator
+    given the same KeySequence.
+    """
+
+    def __init__(self):
+        self.cur = self
+        self.raw_conn = self
+        self.next_keys = {}
+        self.blocks = {}
+        self.row = None
+
+    def execute(self, sql, params=None):
+        if "DO UPDATE SET next_key = 1" in sql:
+            self.next_keys[params[0]] = 1
+            self.blocks = {block: used for block, used in self.blocks.items() if block[0] != params[0]}
+        elif "DO NOTHING" in sql:
+            self.next_keys.setdefault(params[0], 1)
+        elif "to_regclass" in sql:
+            # no surrogate table yet
+            self.row = (False,)
+        elif sql.lstrip().startswith("WITH reserved"):
+            first_key = self.next_keys[params["key_name"]]
+            self.next_keys[params["key_name"]] += params["size"]
+            self.blocks[(params["key_name"], first_key)] = 0
+            self.row = (first_key,)
+        elif "SET used_count" in sql:
+            used_count, key_name, first_key = params
+            self.blocks[(key_name, first_key)] = used_count
+
+    def fetchone(self):
+        return self.row
+
+    def commit(self):
+        pass
+
+
+def test_allocator_hands_out_consecutive_keys_from_its_blocks():
+    db = KeySequence()
+
+    with KeyAllocator(db, "climate_surrogate_key", block_size=10, reset=True) as allocator:
+        first, second = allocator.allocate(4), allocator.allocate(6)
+        # the 2 keys left in the first block are too few: a new block, the rest of the first one is a gap
+        third = allocator.allocate(3)
+        assert len(allocator.allocate(0)) == 0
+
+    assert first.tolist() == [1, 2, 3, 4] and second.tolist() == list(range(5, 11))
+    assert third.tolist() == [11, 12, 13]
+    assert db.blocks == {("climate_surrogate_key", 1): 10, ("climate_surrogate_key", 11): 3}
+
+
+def test_concurrent_allocators_never_share_a_key():
+    db = KeySequence()
+    allocators = [KeyAllocator(db, "event_surrogate_key", block_size=8, reset=index == 0) for index in range(3)]
+    rng = np.random.default_rng(9)
+
+    keys = np.concatenate([allocators[rng.integers(0, 3)].allocate(rng.integers(1, 12)) for _ in range(200)])
+
+    assert len(np.unique(keys)) == len(keys)
+    for allocator in allocators:
+        for first_key, size, used_count in allocator.blocks:
+            assert used_count <= size
+
+
+def test_bulk_assignment_restarts_from_one_on_a_full_load():
+    db = KeySequence()
+
+    assert allocate_surrogate_keys(db, "date_surrogate_key", 5, reset=True).tolist() == [1, 2, 3, 4, 5]
+    assert first_surrogate_key(db, "date_surrogate_key", 3) == 6
+    assert first_surrogate_key(db, "date_surrogate_key", 3, reset=True) == 1
+    assert first_surrogate_key(db, "date_surrogate_key", 0) == 1
+    assert list(db.blocks) == [("date_surrogate_key", 1)]
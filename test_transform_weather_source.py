@@ -0,0 +1,47 @@
+
+import glob, os
+
+import pandas as pd
+
+from A02_Team_V04 import transform_weather_source
+from hourly_climate import build_hourly_climate_tables
+
+"""
+Runs the weather cleaning of the extract stage over the weather files shipped in weather_dataset/ (their times are
+written HH:MM or H:MM):
+            python -m pytest -q
+"""
+
+
+WEATHER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "weather_dataset")
+
+
+def read_weather_files():
+    paths = sorted(glob.glob(os.path.join(WEATHER_DIR, "*.csv")))
+    assert paths
+    return pd.concat([pd.read_csv(path, dtype={"Climate ID": str}) for path in paths], axis=0, ignore_index=True)
+
+
+def test_transform_weather_source_on_shipped_files():
+    df_raw = read_weather_files()
+    df_weather, df_stations, df_weather_hourly = transform_weather_source(df_raw.copy())
+
+    # one daily row per station and day, every station known
+    assert not df_weather.duplicated(['climate_id', 'year', 'month', 'day']).any()
+    assert set(df_weather['climate_id']) <= set(df_stations['climate_id'])
+    assert set(df_weather['year']) == {2017, 2018, 2019, 2020}
+
+    # the hours without a weather description are "normal"
+    assert df_raw["Weather"].isna().any()
+    assert df_weather['weather'].notna().all()
+    assert df_weather_hourly['weather'].notna().all()
+
+    # every observed hour is parsed, whatever the time format of its file
+    assert df_weather_hourly['hour'].between(0, 23).all()
+    observed = df_raw.dropna(subset=["Temp (°C)"])
+    assert len(df_weather_hourly) == len(observed.drop_duplicates(["Climate ID", "Year", "Month", "Day", "Time"]))
+    short_times = observed["Time"].astype(str).str.len() < 5
+    assert short_times.any()
+
+    df_hourly_climate, df_hourly_climate_lookup = build_hourly_climate_tables(df_weather_hourly)
+    assert not df_hourly_climate_lookup.duplicated(['climate_id', 'year', 'month', 'day', 'hour']).any()
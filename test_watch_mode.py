@@ -0,0 +1,122 @@
+import os
+
+from watch_mode import DEFAULT_SETTINGS, BatchCoalescer, FileWatcher, quarantine_files
+
+"""
+Checks the file watcher, the micro-batch coalescer (with the retry backoff) and the quarantine of the watch mode:
+            python -m pytest -q
+"""
+
+
+def watch_settings(tmp_path, **settings):
+    for directory in ("weather_dataset", "crime_inbox"):
+        os.makedirs(tmp_path / directory, exist_ok=True)
+    return dict(DEFAULT_SETTINGS, weather_dir=str(tmp_path / "weather_dataset"),
+                crime_inbox=str(tmp_path / "crime_inbox"), state_path=str(tmp_path / "watch_state.json"),
+                quarantine_dir=str(tmp_path / "watch_quarantine"), **settings)
+
+
+def write_file(path, text, mtime):
+    with open(path, "w") as csv_file:
+        csv_file.write(text)
+    os.utime(path, (mtime, mtime))
+
+
+def test_file_watcher_returns_stable_files_once(tmp_path):
+    settings = watch_settings(tmp_path)
+    old_weather = os.path.join(settings["weather_dir"], "weather_2020-01_P1H.csv")
+    write_file(old_weather, "a\n", 1000)
+    watcher = FileWatcher(settings)
+
+    crimes = os.path.join(settings["crime_inbox"], "crimes.csv")
+    write_file(crimes, "a\n", 2000)
+    write_file(os.path.join(settings["crime_inbox"], "notes.txt"), "a\n", 2000)
+    # the weather files present at the first start were loaded by the full load
+    assert watcher.poll() == []
+    assert watcher.poll() == [(crimes, "crime", 2000)]
+
+    # a file still being written is not ready
+    write_file(crimes, "a\nb\n", 2100)
+    assert watcher.poll() == []
+    write_file(crimes, "a\nb\nc\n", 2200)
+    assert watcher.poll() == []
+    assert watcher.poll() == [(crimes, "crime", 2200)]
+
+    watcher.mark_processed([crimes])
+    assert watcher.poll() == [] and watcher.poll() == []
+    # the processed files survive a restart, a changed file is returned again
+    watcher = FileWatcher(settings)
+    write_file(old_weather, "a\nb\n", 3000)
+    watcher.poll()
+    assert watcher.poll() == [(old_weather, "weather", 3000)]
+
+
+def test_coalescer_closes_a_batch_after_the_quiet_time_or_the_limits():
+    coalescer = BatchCoalescer(dict(DEFAULT_SETTINGS, quiet_seconds=10, max_batch_seconds=60, max_batch_files=3))
+
+    assert not coalescer.ready(0)
+    coalescer.add([("a.csv", "crime", 1)], 0)
+    assert not coalescer.ready(5) and coalescer.ready(10)
+
+    # files arriving every 5 seconds: the batch is closed after max_batch_seconds
+    for now in range(5, 60, 5):
+        coalescer.add([(f"w{now}.csv", "weather", now)], now)
+        if len(coalescer.files) >= 3:
+            break
+    assert coalescer.ready(now)
+    assert len(coalescer.take()) == 3 and not coalescer.ready(now)
+
+    coalescer = BatchCoalescer(dict(DEFAULT_SETTINGS, quiet_seconds=10, max_batch_seconds=60, max_batch_files=50))
+    for now in range(0, 61, 5):
+        coalescer.add([(f"w{now}.csv", "weather", now)], now)
+        assert coalescer.ready(now) == (now >= 60)
+
+
+def test_coalescer_keeps_one_version_of_a_waiting_file():
+    coalescer = BatchCoalescer(DEFAULT_SETTINGS)
+
+    coalescer.add([("a.csv", "crime", 1)], 0)
+    # the watcher reports a waiting file again, or its new version
+    coalescer.add([("a.csv", "crime", 1)], 5)
+    assert coalescer.last_seen == 0
+    coalescer.add([("a.csv", "crime", 2), ("b.csv", "crime", 2)], 6)
+
+    assert coalescer.take() == [("a.csv", "crime", 2), ("b.csv", "crime", 2)]
+
+
+def test_failed_batches_are_retried_with_backoff_then_given_up():
+    coalescer = BatchCoalescer(dict(DEFAULT_SETTINGS, quiet_seconds=0, retry_seconds=30, max_retry_seconds=100,
+                                    max_retries=4))
+    files = [("a.csv", "crime", 1), ("b.csv", "weather", 1)]
+    coalescer.add(files, 0)
+
+    now, delays = 0, []
+    while True:
+        batch = coalescer.take()
+        given_up = coalescer.retry(batch, now)
+        if given_up:
+            break
+        delays.append(coalescer.retry_at - now)
+        assert not coalescer.ready(coalescer.retry_at - 1)
+        now = coalescer.retry_at
+        assert coalescer.ready(now)
+
+    assert delays == [30, 60, 100]
+    assert given_up == files and not coalescer.files and not coalescer.attempts
+
+    # a loaded file starts again from its first attempt
+    coalescer.add(files, now)
+    coalescer.retry(coalescer.take(), now)
+    coalescer.loaded(coalescer.take())
+    assert coalescer.attempts == {}
+
+
+def test_quarantine_moves_the_files_by_kind(tmp_path):
+    settings = watch_settings(tmp_path)
+    crimes = os.path.join(settings["crime_inbox"], "crimes.csv")
+    write_file(crimes, "a\n", 1000)
+
+    quarantine_files([(crimes, "crime", 1000), (str(tmp_path / "missing.csv"), "weather", 1000)], settings)
+
+    assert not os.path.exists(crimes)
+    assert os.listdir(os.path.join(settings["quarantine_dir"], "crime")) == ["crimes.csv"]
@@ -0,0 +1,179 @@
+
+from pipeline_config import load_section
+
+"""
+************************************  Typed DDL of the warehouse tables:  ************************************
+Tables created by DataFrame.to_sql() get the types inferred by pandas: bigint for year, month, day, hood_id and the
+surrogate keys, double precision for the temperatures, text for everything else, and climate_dimension_table even
+got the dataframe index as a column. TABLE_SCHEMAS declares every dimension, surrogate and fact table with compact
+explicit types instead:
+    - smallint for the date parts, hood_id, the temperatures of the climate dimension and the small codes,
+    - integer for the surrogate keys and crime_number (the key allocator never hands out more than 2^31 keys
+      per load, see surrogate_keys.py),
+    - real for the measured temperatures,
+    - varchar(n) for the identifiers of known format (climate_id, event_id), text for the free-form labels (the
+      storage of varchar and text is the same in PostgreSQL, the length is only checked).
+
+The loaders create the tables first and then append into them:
+            create_table(db, "climate_dimension_table")
+            df_climate.to_sql("climate_dimension_table", con=db.engine, if_exists="append", index=False)
+or, set-based:
+            create_table(db, "fact_table")
+            db.cur.execute("insert into fact_table (...) select ... from crime_weather_source_table")
+The primary and foreign keys are still added by the loaders once the rows are in.
+
+report_storage() prints, per table, the size of the rows with the compact types and with the types pandas would
+have inferred (a temporary copy cast to bigint / double precision / text), enabled in config.json with:
+            "storage_report": {"enabled": true}
+or on an already loaded warehouse with:
+            python warehouse_schema.py
+"""
+
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+}
+
+CLIMATE_ID = "varchar(16)"
+EVENT_ID = "varchar(32)"
+
+# table: [(column, type)], in the column order of the loaders
+TABLE_SCHEMAS = {
+    "weather_station_table": [
+        ("climate_id", CLIMATE_ID), ("station_name", "text"),
+        ("longitude", "double precision"), ("latitude", "double precision"),
+    ],
+    "hourly_climate_dimension_table": [
+        ("climate_id", CLIMATE_ID), ("year", "smallint"), ("month", "smallint"), ("day", "smallint"),
+        ("hour", "smallint"), ("temperature", "real"), ("weather", "text"),
+    ],
+    "hourly_climate_surrogate_table": [
+        ("hourly_climate_surrogate_key", "integer"), ("climate_id", CLIMATE_ID), ("year", "smallint"),
+        ("month", "smallint"), ("day", "smallint"), ("hour", "smallint"),
+    ],
+    "date_dimension_table": [
+        ("year", "smallint"), ("month", "smallint"), ("day", "smallint"), ("day_of_year", "smallint"),
+        ("day_of_week", "text"),
+    ],
+    "date_surrogate_table": [
+        ("date_surrogate_key", "integer"), ("year", "smallint"), ("month", "smallint"), ("day", "smallint"),
+    ],
+    "crime_event_dimension_table": [
+        ("event_id", EVENT_ID), ("crime_type", "text"), ("year", "smallint"), ("month", "smallint"),
+        ("day", "smallint"), ("day_of_year", "smallint"), ("day_of_week", "text"), ("location_type", "text"),
+    ],
+    "crime_event_surrogate_table": [
+        ("event_surrogate_key", "integer"), ("event_id", EVENT_ID),
+    ],
+    "climate_dimension_table": [
+        ("climate_id", CLIMATE_ID), ("day", "smallint"), ("month", "smallint"), ("year", "smallint"),
+        ("temperature_mean", "smallint"), ("temperature_min", "smallint"), ("temperature_max", "smallint"),
+        ("weather", "text"), ("temperature_band_key", "smallint"), ("weather_condition_mask", "smallint"),
+    ],
+    "climate_surrogate_table": [
+        ("climate_surrogate_key", "integer"), ("climate_id", CLIMATE_ID), ("year", "smallint"),
+        ("month", "smallint"), ("day", "smallint"),
+    ],
+    # versioned (SCD type 2), created once by ensure_scd2_table() and never replaced
+    "neighbourhood_dimension_table": [
+        ("hood_id", "smallint"), ("neighbourhood_name", "text"), ("attribute_hash", "text"),
+        ("valid_from", "timestamp"), ("valid_to", "timestamp"), ("is_current", "boolean"),
+    ],
+    "neighbourhood_surrogate_table": [
+        ("neighbourhood_surrogate_key", "integer"), ("hood_id", "smallint"), ("valid_from", "timestamp"),
+    ],
+    "fact_table": [
+        ("date_surrogate_key", "integer"), ("event_surrogate_key", "integer"), ("climate_surrogate_key", "integer"),
+        ("neighbourhood_surrogate_key", "integer"), ("crime_number", "integer"), ("temperature_mean", "real"),
+        ("temperature_min", "real"), ("temperature_max", "real"), ("hourly_climate_surrogate_key", "integer"),
+        ("temperature_band_key", "smallint"), ("weather_condition_mask", "smallint"),
+    ],
+}
+
+# Type given by DataFrame.to_sql() to the values of a compact type
+INFERRED_TYPES = {"smallint": "bigint", "integer": "bigint", "real": "double precision"}
+
+
+def column_types(table_name):
+    """A function which returns the {column: type} of a table of TABLE_SCHEMAS."""
+
+    return dict(TABLE_SCHEMAS[table_name])
+
+
+def create_table(db, table_name):
+    """A function which (re)creates an empty table with the types of TABLE_SCHEMAS (the previous table and the
+       constraints referencing it are dropped).
+    """
+
+    definitions = ", ".join(f"{column} {column_type}" for column, column_type in TABLE_SCHEMAS[table_name])
+    db.cur.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE; CREATE TABLE {table_name} ({definitions})")
+    db.raw_conn.commit()
+
+
+def inferred_type(column_type):
+    if column_type.startswith("varchar"):
+        return "text"
+    return INFERRED_TYPES.get(column_type, column_type)
+
+
+def storage_report_settings():
+    """A function which returns the storage_report settings of config.json, or None when disabled."""
+
+    settings = load_section("storage_report", DEFAULT_SETTINGS)
+    return settings if settings["enabled"] else None
+
+
+def table_storage(db, table_name):
+    """A function which returns the rows, the size of the rows, the size of the indexes of a table, and the size of
+       the same rows with the types pandas would have inferred (see the module description).
+    """
+
+    db.cur.execute(f"SELECT count(*), pg_relation_size(%s), pg_indexes_size(%s) FROM {table_name}",
+                   (table_name, table_name))
+    rows, typed_bytes, index_bytes = db.cur.fetchone()
+
+    casts = ", ".join(f"{column}::{inferred_type(column_type)} AS {column}"
+                      for column, column_type in TABLE_SCHEMAS[table_name])
+    if table_name == "climate_dimension_table":
+        # to_sql(index=True) added the dataframe index
+        casts = "(row_number() over ())::bigint AS index, " + casts
+    db.cur.execute(f"""DROP TABLE IF EXISTS storage_report_copy;
+                        CREATE TEMPORARY TABLE storage_report_copy AS SELECT {casts} FROM {table_name};
+                        SELECT pg_relation_size('storage_report_copy')""")
+    inferred_bytes = db.cur.fetchone()[0]
+    db.cur.execute("DROP TABLE storage_report_copy")
+    db.raw_conn.commit()
+    return {"table": table_name, "rows": rows, "inferred_bytes": inferred_bytes, "typed_bytes": typed_bytes,
+            "index_bytes": index_bytes}
+
+
+def report_storage(db, settings=None):
+    """A function which prints the size of every warehouse table with the inferred and the compact types, and
+       returns the rows. It does nothing when the storage report is disabled.
+    """
+
+    settings = settings or storage_report_settings()
+    if settings is None:
+        return None
+
+    report = []
+    for table_name in TABLE_SCHEMAS:
+        db.cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+        if db.cur.fetchone()[0]:
+            report.append(table_storage(db, table_name))
+
+    print(f"{'table':34} {'rows':>10} {'inferred MiB':>13} {'typed MiB':>10} {'saved':>7} {'index MiB':>10}")
+    for row in report + [{"table": "total", "rows": sum(row["rows"] for row in report),
+                          **{name: sum(row[name] for row in report)
+                             for name in ("inferred_bytes", "typed_bytes", "index_bytes")}}]:
+        saved = 1 - row["typed_bytes"] / row["inferred_bytes"] if row["inferred_bytes"] else 0.0
+        print(f"{row['table']:34} {row['rows']:10} {row['inferred_bytes'] / 2 ** 20:13.2f} "
+              f"{row['typed_bytes'] / 2 ** 20:10.2f} {saved:7.1%} {row['index_bytes'] / 2 ** 20:10.2f}")
+    return report
+
+
+if __name__ == "__main__":
+    from A02_Team_V04 import DbConnection
+
+    with DbConnection() as db:
+        report_storage(db, {"enabled": True})
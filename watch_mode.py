@@ -0,0 +1,617 @@
+
+import json, os, shutil, time, traceback
+
+from pipeline_config import load_section
+
+"""
+************************************  Watch mode (micro-batch loads):  ************************************
+The full load rebuilds the warehouse from every file. The watch mode keeps it up to date while new files are dropped
+in the weather directory and the crime inbox:
+            python A02_Team_V04.py watch
+            "watch_mode": {"weather_dir": "weather_dataset", "crime_inbox": "crime_inbox", "quiet_seconds": 10}
+
+    1. FileWatcher polls both directories every poll_seconds (no notification library needed). A file is ready once
+       its size and modification time did not change between two polls (a file still being copied is not read),
+    2. BatchCoalescer gathers the ready files into one micro-batch, closed when no file arrived for quiet_seconds,
+       when its first file waits for max_batch_seconds, or when it holds max_batch_files files,
+    3. process_batch() loads the batch incrementally:
+        - the weather files are cleaned like the full load (transform_weather_source) and appended to
+          weather_source_table, weather_station_table and the hourly climate tables (new keys only),
+        - the crime files are cleaned like the full load (without the year filter: a dropped file is loaded as it
+          is), the events already loaded are removed (Bloom filter when enabled, see event_bloom.py) and every crime
+          gets its station and hourly climate key,
+        - the date, crime event, climate and neighbourhood (SCD type 2 merge) dimensions get the new rows only, and
+          the fact rows are inserted with set-based SQL in one transaction,
+        - the crimes without weather for their station and day yet are kept in PENDING_TABLE (with their occurrence
+          hour) and retried with the next batch (the weather file usually arrives later than the crimes): their
+          hourly climate key is looked up again before they are staged,
+    4. the latency of every file (from its modification time to the commit of its fact rows) is printed and
+       appended to watch_reports/batches.jsonl.
+
+A file is recorded as processed only when its batch is loaded. The files of a failed batch (database outage, lock
+timeout, ...) go back to the coalescer and are retried after retry_seconds, doubled after every failure up to
+max_retry_seconds. A file whose batch failed max_retries times is moved to quarantine_dir/<kind>/.
+
+The processed files are recorded in state_path. On the first start the files already in the weather directory are
+taken as loaded by the full load, the files of the crime inbox are loaded.
+"""
+
+
+DEFAULT_SETTINGS = {
+    "weather_dir": "weather_dataset",
+    "crime_inbox": "crime_inbox",
+    "poll_seconds": 5,
+    "quiet_seconds": 10,
+    "max_batch_seconds": 60,
+    "max_batch_files": 50,
+    "state_path": "watch_state.json",
+    "report_dir": "watch_reports",
+    "retry_seconds": 30,
+    "max_retry_seconds": 600,
+    "max_retries": 5,
+    "quarantine_dir": "watch_quarantine",
+}
+
+CRIME_STAGING_TABLE = "watch_crime_staging_table"
+WEATHER_STAGING_TABLE = "watch_weather_staging_table"
+PENDING_TABLE = "watch_pending_crime_table"
+
+CRIME_STAGING_COLUMNS = ['event_id', 'location_type', 'year', 'month', 'day', 'day_of_year', 'day_of_week',
+                         'crime_type', 'hood_id', 'neighbourhood_name', 'climate_id', 'hourly_climate_surrogate_key',
+                         'occurrence_hour']
+
+# The key allocators of the watch process (key name -> KeyAllocator), kept from batch to batch so the keys of
+# many micro-batches come from one reserved block
+_key_allocators = {}
+
+DATE_MATCH = "{0}.year = {1}.year AND {0}.month = {1}.month AND {0}.day = {1}.day"
+CLIMATE_MATCH = "{0}.climate_id = {1}.climate_id AND " + DATE_MATCH
+
+
+class FileWatcher:
+    """
+    The class FileWatcher polls the weather directory and the crime inbox and returns the files which are complete
+    (size and modification time stable between two polls) and not processed yet.
+    """
+
+    def __init__(self, settings):
+        self.directories = {"weather": settings["weather_dir"], "crime": settings["crime_inbox"]}
+        self.state_path = settings["state_path"]
+        self.candidates = {}
+        try:
+            with open(self.state_path) as state_file:
+                self.processed = json.load(state_file)
+        except FileNotFoundError:
+            # The weather files present at the first start were loaded by the full load
+            self.processed = {path: signature for path, (kind, signature) in self.scan().items() if kind == "weather"}
+            self.save()
+
+    def scan(self):
+        files = {}
+        for kind, directory in self.directories.items():
+            if not os.path.isdir(directory):
+                continue
+            for file_name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, file_name)
+                if file_name.lower().endswith(".csv") and os.path.isfile(path):
+                    status = os.stat(path)
+                    files[path] = (kind, [status.st_size, status.st_mtime])
+        return files
+
+    def poll(self):
+        """A function which returns the (path, kind, arrival time) of the files which became ready since the last
+           poll. A file changed after being processed is returned again.
+        """
+
+        ready = []
+        files = self.scan()
+        for path, (kind, signature) in files.items():
+            if self.processed.get(path) == signature:
+                continue
+            if self.candidates.get(path) == signature:
+                ready.append((path, kind, signature[1]))
+            self.candidates[path] = signature
+        for path, _, _ in ready:
+            del self.candidates[path]
+        # forget the candidates deleted before being ready
+        self.candidates = {path: signature for path, signature in self.candidates.items() if path in files}
+        return ready
+
+    def mark_processed(self, paths):
+        for path in paths:
+            status = os.stat(path)
+            self.processed[path] = [status.st_size, status.st_mtime]
+        self.save()
+
+    def save(self):
+        with open(self.state_path, "w") as state_file:
+            json.dump(self.processed, state_file, indent=1)
+
+
+class BatchCoalescer:
+    """
+    The class BatchCoalescer gathers the ready files into micro-batches (see the module description).
+    """
+
+    def __init__(self, settings):
+        self.quiet_seconds = settings["quiet_seconds"]
+        self.max_batch_seconds = settings["max_batch_seconds"]
+        self.max_batch_files = settings["max_batch_files"]
+        self.retry_seconds = settings["retry_seconds"]
+        self.max_retry_seconds = settings["max_retry_seconds"]
+        self.max_retries = settings["max_retries"]
+        self.files = []
+        self.first_seen = self.last_seen = None
+        self.attempts = {}  # path -> failed batches
+        self.retry_at = None
+
+    def add(self, files, now):
+        # the watcher reports a waiting file again until it is processed, only a new or changed file counts
+        waiting = {(path, arrival) for path, _, arrival in self.files}
+        files = [file for file in files if (file[0], file[2]) not in waiting]
+        if not files:
+            return
+        if not self.files:
+            self.first_seen = now
+        # a file changed while waiting replaces its previous version
+        paths = {path for path, _, _ in files}
+        self.files = [file for file in self.files if file[0] not in paths] + list(files)
+        self.last_seen = now
+
+    def ready(self, now):
+        if not self.files or (self.retry_at is not None and now < self.retry_at):
+            return False
+        return (now - self.last_seen >= self.quiet_seconds or now - self.first_seen >= self.max_batch_seconds
+                or len(self.files) >= self.max_batch_files)
+
+    def take(self):
+        files, self.files = self.files, []
+        self.first_seen = self.last_seen = self.retry_at = None
+        return files
+
+    def loaded(self, files):
+        for path, _, _ in files:
+            self.attempts.pop(path, None)
+
+    def retry(self, files, now):
+        """A function which puts the files of a failed batch back, to be retried after the backoff delay. Returns
+           the files which failed max_retries times (they are not retried).
+        """
+
+        retried, given_up = [], []
+        for file in files:
+            attempts = self.attempts.get(file[0], 0) + 1
+            if attempts >= self.max_retries:
+                self.attempts.pop(file[0], None)
+                given_up.append(file)
+            else:
+                self.attempts[file[0]] = attempts
+                retried.append(file)
+        if retried:
+            self.add(retried, now)
+            attempts = max(self.attempts[path] for path, _, _ in retried)
+            self.retry_at = now + min(self.retry_seconds * 2 ** (attempts - 1), self.max_retry_seconds)
+        return given_up
+
+
+def watch_settings():
+    return load_section("watch_mode", DEFAULT_SETTINGS)
+
+
+def read_frame(db, sql, params=None):
+    """A function which reads a query into a DataFrame with db.cur, bypassing the query cache: the watch mode
+       reads the tables it has just written in the same batch.
+    """
+
+    import pandas as pd
+
+    db.cur.execute(sql, params)
+    return pd.DataFrame(db.cur.fetchall(), columns=[column[0] for column in db.cur.description])
+
+
+def table_exists(db, table_name):
+    db.cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+    return db.cur.fetchone()[0]
+
+
+def key_allocator(db, key_column):
+    """A function which returns the allocator of a key, reserving blocks of the configured block_size (see
+       surrogate_keys.py). An allocator whose blocks were released by a full load in the meantime is replaced.
+    """
+
+    from surrogate_keys import BLOCK_TABLE, KeyAllocator
+
+    allocator = _key_allocators.get(key_column)
+    if allocator is not None and allocator.blocks:
+        db.cur.execute(f"SELECT 1 FROM {BLOCK_TABLE} WHERE key_name = %s AND first_key = %s",
+                       (key_column, allocator.blocks[-1][0]))
+        if db.cur.fetchone() is None:
+            allocator = None
+    if allocator is None:
+        allocator = _key_allocators[key_column] = KeyAllocator(db, key_column)
+    allocator.db = db
+    return allocator
+
+
+def close_key_allocators():
+    """A function which records the keys used in the blocks of every allocator of the watch process."""
+
+    for allocator in _key_allocators.values():
+        allocator.close()
+
+
+def insert_new_keys(db, table_name, key_column, columns, source):
+    """A function which gives surrogate keys of the block of the key allocator (see key_allocator()) to the rows
+       of source (a table or a subquery with the columns) which are not in table_name yet. Returns the number of
+       inserted rows.
+    """
+
+    column_list = ", ".join(columns)
+    match = " AND ".join(f"t.{column} = s.{column}" for column in columns)
+    db.cur.execute(f"""DROP TABLE IF EXISTS watch_new_key_table;
+                        CREATE TEMPORARY TABLE watch_new_key_table AS
+                        SELECT s.* FROM (SELECT DISTINCT {column_list} FROM {source} x) s
+                        WHERE NOT EXISTS (SELECT 1 FROM {table_name} t WHERE {match})""")
+    count = db.cur.rowcount
+    if count > 0:
+        first_key = int(key_allocator(db, key_column).allocate(count)[0])
+        db.cur.execute(f"""INSERT INTO {table_name} ({key_column}, {column_list})
+                            SELECT %s - 1 + row_number() over (order by {column_list}), {column_list}
+                            FROM watch_new_key_table""", (first_key,))
+    db.cur.execute("DROP TABLE watch_new_key_table")
+    return max(count, 0)
+
+
+def load_weather_files(db, paths):
+    """A function which cleans the new weather files and appends them to the weather tables (new stations and
+       hourly observations only). Returns the number of daily weather rows.
+    """
+
+    import pandas as pd
+    from A02_Team_V04 import transform_weather_source
+    from hourly_climate import HOURLY_CLIMATE_COLUMNS, HOURLY_CLIMATE_KEY_COLUMNS, build_hourly_climate_tables
+
+    df_weather = pd.concat([pd.read_csv(path, dtype={"Climate ID": str}) for path in paths], axis=0, ignore_index=True)
+    df_weather, df_stations, df_weather_hourly = transform_weather_source(df_weather)
+    df_weather.to_sql("weather_source_table", con=db.engine, if_exists="append", index=False)
+
+    df_stations.to_sql("watch_station_staging_table", con=db.engine, if_exists="replace", index=False)
+    db.cur.execute("""INSERT INTO weather_station_table (climate_id, station_name, longitude, latitude)
+                        SELECT climate_id, station_name, longitude, latitude FROM watch_station_staging_table
+                        ON CONFLICT (climate_id) DO NOTHING;
+                        DROP TABLE watch_station_staging_table""")
+
+    df_hourly_climate, _ = build_hourly_climate_tables(df_weather_hourly)
+    df_hourly_climate.to_sql("watch_hourly_staging_table", con=db.engine, if_exists="replace", index=False)
+    db.cur.execute(f"""INSERT INTO hourly_climate_dimension_table ({", ".join(HOURLY_CLIMATE_COLUMNS)})
+                        SELECT {", ".join(HOURLY_CLIMATE_COLUMNS)} FROM watch_hourly_staging_table
+                        ON CONFLICT DO NOTHING""")
+    insert_new_keys(db, "hourly_climate_surrogate_table", "hourly_climate_surrogate_key", HOURLY_CLIMATE_KEY_COLUMNS,
+                    "watch_hourly_staging_table")
+    db.cur.execute("DROP TABLE watch_hourly_staging_table")
+    db.raw_conn.commit()
+    return len(df_weather)
+
+
+def read_crime_files(db, paths):
+    """A function which cleans the new crime files like the full load, removes the events already loaded and
+       attaches the station and the hourly climate key of every crime. Returns the crime staging dataframe.
+    """
+
+    import pandas as pd
+    from crime_normalization import CRIME_NORMALIZATION_SPEC, normalize_frame
+    from event_bloom import load_event_bloom, split_new_events
+    from hourly_climate import attach_hourly_climate_key, find_hour_column
+    from spatial_resolver import load_resolver, resolve_nsa_neighbourhoods
+    from station_resolver import assign_nearest_station
+
+    df = pd.concat([pd.read_csv(path) for path in paths], axis=0, ignore_index=True)
+    df.columns = df.columns.str.lower()
+    df = df.drop_duplicates(subset=['event_id'], keep='first')
+    resolver, resolver_settings = load_resolver()
+    if resolver is not None:
+        df = resolve_nsa_neighbourhoods(df, resolver, resolver_settings)
+    df, _ = normalize_frame(df, CRIME_NORMALIZATION_SPEC)
+
+    # Remove the events already loaded (the Bloom filter only sends its probable hits to the database)
+    bloom = load_event_bloom(db)
+    if bloom is not None:
+        df = df[split_new_events(db, bloom, df['event_id'])]
+    elif len(df):
+        db.cur.execute("SELECT event_id FROM crime_event_dimension_table WHERE event_id = ANY(%s)",
+                       (df['event_id'].astype(str).tolist(),))
+        df = df[~df['event_id'].isin({row[0] for row in db.cur.fetchall()})]
+    if df.empty:
+        return df
+
+    df_stations = read_frame(db, "SELECT climate_id, station_name, longitude, latitude FROM weather_station_table")
+    df, _ = assign_nearest_station(df, df_stations, resolver_settings["longitude_column"],
+                                   resolver_settings["latitude_column"], resolver)
+    df = attach_hourly_climate_key(df, hourly_climate_lookup(db, df))
+    hour_column = find_hour_column(df.columns)
+    df['occurrence_hour'] = (pd.to_numeric(df[hour_column], errors="coerce").astype("Int16") if hour_column
+                             else pd.array([pd.NA] * len(df), dtype="Int16"))
+    return df[CRIME_STAGING_COLUMNS]
+
+
+def hourly_climate_lookup(db, df):
+    """A function which reads the hourly climate keys of the stations and years of the crimes."""
+
+    from hourly_climate import HOURLY_CLIMATE_KEY_COLUMNS
+
+    return read_frame(db, f"""SELECT hourly_climate_surrogate_key, {", ".join(HOURLY_CLIMATE_KEY_COLUMNS)}
+                              FROM hourly_climate_surrogate_table
+                              WHERE climate_id = ANY(%s) AND year = ANY(%s)""",
+                      (df['climate_id'].astype(str).unique().tolist(), [int(year) for year in df['year'].unique()]))
+
+
+def refresh_pending_hourly_keys(db):
+    """A function which looks up again the hourly climate key of the pending crimes which have none (their weather
+       was missing when they were read). Returns the number of crimes which got a key.
+    """
+
+    from hourly_climate import attach_hourly_climate_key
+
+    # a pending table of an older version has no occurrence hour: its crimes keep a null key
+    db.cur.execute(f"ALTER TABLE {PENDING_TABLE} ADD COLUMN IF NOT EXISTS occurrence_hour smallint")
+    df = read_frame(db, f"""SELECT event_id, climate_id, year, month, day, occurrence_hour FROM {PENDING_TABLE}
+                             WHERE hourly_climate_surrogate_key IS NULL AND occurrence_hour IS NOT NULL""")
+    db.raw_conn.commit()
+    if df.empty:
+        return 0
+
+    df = attach_hourly_climate_key(df, hourly_climate_lookup(db, df))
+    df = df.loc[df['hourly_climate_surrogate_key'].notna(), ['event_id', 'hourly_climate_surrogate_key']]
+    if len(df):
+        df.to_sql("watch_pending_key_table", con=db.engine, if_exists="replace", index=False)
+        db.cur.execute(f"""UPDATE {PENDING_TABLE} p SET hourly_climate_surrogate_key = k.hourly_climate_surrogate_key
+                            FROM watch_pending_key_table k WHERE k.event_id = p.event_id;
+                            DROP TABLE watch_pending_key_table""")
+        db.raw_conn.commit()
+    return len(df)
+
+
+def stage_crimes(db, df_crime):
+    """A function which writes the crimes of the batch and the pending crimes of the previous batches to the crime
+       staging table. Returns False when there is no crime to load.
+    """
+
+    column_list = ", ".join(CRIME_STAGING_COLUMNS)
+    has_pending = table_exists(db, PENDING_TABLE)
+    if has_pending:
+        refresh_pending_hourly_keys(db)
+    db.cur.execute(f"DROP TABLE IF EXISTS {CRIME_STAGING_TABLE}")
+    db.raw_conn.commit()
+    if len(df_crime):
+        df_crime.to_sql(CRIME_STAGING_TABLE, con=db.engine, if_exists="replace", index=False)
+        if has_pending:
+            db.cur.execute(f"""INSERT INTO {CRIME_STAGING_TABLE} ({column_list})
+                                SELECT {column_list} FROM {PENDING_TABLE} p
+                                WHERE NOT EXISTS (SELECT 1 FROM {CRIME_STAGING_TABLE} s WHERE s.event_id = p.event_id)""")
+    elif has_pending:
+        db.cur.execute(f"CREATE TABLE {CRIME_STAGING_TABLE} AS SELECT {column_list} FROM {PENDING_TABLE}")
+    else:
+        return False
+    db.raw_conn.commit()
+    return True
+
+
+def load_dimensions(db):
+    """A function which adds the new rows of the staged crimes to the date, crime event, climate and neighbourhood
+       dimensions and their surrogate tables (set-based, existing rows are left as they are).
+    """
+
+    from climate_bands import round_temperature_sql, temperature_band_sql, weather_condition_mask_sql
+    from scd2_merge import scd2_merge
+
+    s = CRIME_STAGING_TABLE
+    # STEP#1 Date dimension
+    db.cur.execute(f"""INSERT INTO date_dimension_table (year, month, day, day_of_year, day_of_week)
+                        SELECT DISTINCT year, month, day, day_of_year, day_of_week FROM {s}
+                        ON CONFLICT DO NOTHING""")
+    insert_new_keys(db, "date_surrogate_table", "date_surrogate_key", ['year', 'month', 'day'], s)
+
+    # STEP#2 Crime event dimension
+    db.cur.execute(f"""INSERT INTO crime_event_dimension_table
+                            (event_id, crime_type, year, month, day, day_of_year, day_of_week, location_type)
+                        SELECT DISTINCT ON (event_id) event_id, crime_type, year, month, day, day_of_year, day_of_week,
+                               location_type FROM {s}
+                        ON CONFLICT DO NOTHING""")
+    insert_new_keys(db, "crime_event_surrogate_table", "event_surrogate_key", ['event_id'], s)
+
+    # STEP#3 Climate dimension: the daily weather of the station and day of the staged crimes, aggregated like
+    #        transform_weather_data()
+    db.cur.execute(f"""DROP TABLE IF EXISTS {WEATHER_STAGING_TABLE};
+                        CREATE TABLE {WEATHER_STAGING_TABLE} AS
+                        SELECT DISTINCT ON (w.climate_id, w.year, w.month, w.day)
+                               w.climate_id, w.year, w.month, w.day, w.temperature_mean, w.temperature_min,
+                               w.temperature_max, w.weather
+                        FROM weather_source_table w
+                        JOIN (SELECT DISTINCT climate_id, year, month, day FROM {s}) s ON {CLIMATE_MATCH.format('w', 's')}
+                        ORDER BY w.climate_id, w.year, w.month, w.day;
+                        INSERT INTO climate_dimension_table (climate_id, day, month, year, temperature_mean,
+                                                             temperature_min, temperature_max, weather,
+                                                             temperature_band_key, weather_condition_mask)
+                        SELECT climate_id, day, month, year, {round_temperature_sql('temperature_mean')}::int,
+                               trunc(temperature_min)::int, trunc(temperature_max)::int, weather,
+                               {temperature_band_sql(round_temperature_sql('temperature_mean'))},
+                               {weather_condition_mask_sql('weather')}
+                        FROM {WEATHER_STAGING_TABLE}
+                        ON CONFLICT DO NOTHING""")
+    insert_new_keys(db, "climate_surrogate_table", "climate_surrogate_key", ['climate_id', 'year', 'month', 'day'],
+                    WEATHER_STAGING_TABLE)
+    db.raw_conn.commit()
+
+    # STEP#4 Neighbourhood dimension (SCD type 2 merge), and a surrogate key for the new current versions
+    db.cur.execute(f"""DROP TABLE IF EXISTS neighbourhood_staging_table;
+                        CREATE TABLE neighbourhood_staging_table AS
+                        SELECT DISTINCT ON (hood_id) hood_id, neighbourhood_name FROM {s} ORDER BY hood_id""")
+    db.raw_conn.commit()
+    scd2_merge(db, "neighbourhood_dimension_table", "neighbourhood_staging_table", ['hood_id'], ['neighbourhood_name'])
+    insert_new_keys(db, "neighbourhood_surrogate_table", "neighbourhood_surrogate_key", ['hood_id', 'valid_from'],
+                    f"""(SELECT hood_id, valid_from FROM neighbourhood_dimension_table
+                         WHERE is_current AND hood_id IN (SELECT hood_id FROM {s}))""")
+    db.raw_conn.commit()
+
+
+def load_fact_rows(db):
+    """A function which inserts the fact rows of the staged crimes, updates the daily crime_number of their dates
+       and keeps the crimes without weather in PENDING_TABLE, in one transaction. Returns the number of inserted
+       fact rows, the number of pending crimes and the loaded event_id.
+    """
+
+    s = CRIME_STAGING_TABLE
+    db.cur.execute("BEGIN")
+    try:
+        db.cur.execute(f"""INSERT INTO fact_table (date_surrogate_key, event_surrogate_key, climate_surrogate_key,
+                                neighbourhood_surrogate_key, crime_number, temperature_mean, temperature_min,
+                                temperature_max, hourly_climate_surrogate_key, temperature_band_key,
+                                weather_condition_mask)
+                            SELECT ds.date_surrogate_key, es.event_surrogate_key, cs.climate_surrogate_key,
+                                   ns.neighbourhood_surrogate_key, 0, w.temperature_mean, w.temperature_min,
+                                   w.temperature_max, s.hourly_climate_surrogate_key, cd.temperature_band_key,
+                                   cd.weather_condition_mask
+                            FROM {s} s
+                            JOIN date_surrogate_table ds ON {DATE_MATCH.format('ds', 's')}
+                            JOIN crime_event_surrogate_table es ON es.event_id = s.event_id
+                            JOIN {WEATHER_STAGING_TABLE} w ON {CLIMATE_MATCH.format('w', 's')}
+                            JOIN climate_surrogate_table cs ON {CLIMATE_MATCH.format('cs', 's')}
+                            JOIN climate_dimension_table cd ON {CLIMATE_MATCH.format('cd', 's')}
+                            JOIN neighbourhood_dimension_table nd ON nd.hood_id = s.hood_id AND nd.is_current
+                            JOIN neighbourhood_surrogate_table ns ON ns.hood_id = nd.hood_id
+                                                                 AND ns.valid_from = nd.valid_from
+                            ON CONFLICT DO NOTHING""")
+        inserted = db.cur.rowcount
+
+        # the daily crime number of the touched dates, like the window count of etl_fact_table()
+        db.cur.execute(f"""UPDATE fact_table f SET crime_number = c.crime_number
+                            FROM (SELECT date_surrogate_key, count(*) AS crime_number FROM fact_table
+                                  WHERE date_surrogate_key IN (SELECT ds.date_surrogate_key FROM date_surrogate_table ds
+                                                               JOIN {s} s ON {DATE_MATCH.format('ds', 's')})
+                                  GROUP BY date_surrogate_key) c
+                            WHERE f.date_surrogate_key = c.date_surrogate_key""")
+
+        db.cur.execute(f"""DROP TABLE IF EXISTS {PENDING_TABLE};
+                            CREATE TABLE {PENDING_TABLE} AS
+                            SELECT s.* FROM {s} s
+                            WHERE NOT EXISTS (SELECT 1 FROM {WEATHER_STAGING_TABLE} w
+                                              WHERE {CLIMATE_MATCH.format('w', 's')})""")
+        db.cur.execute(f"SELECT count(*) FROM {PENDING_TABLE}")
+        pending = db.cur.fetchone()[0]
+        db.cur.execute(f"SELECT event_id FROM {s} EXCEPT SELECT event_id FROM {PENDING_TABLE}")
+        loaded_event_ids = [row[0] for row in db.cur.fetchall()]
+
+        db.cur.execute(f"DROP TABLE {s}; DROP TABLE {WEATHER_STAGING_TABLE}")
+        db.cur.execute("COMMIT")
+    except:
+        db.cur.execute("ROLLBACK")
+        raise
+    return inserted, pending, loaded_event_ids
+
+
+def process_batch(db, files):
+    """A function which loads one micro-batch of (path, kind, arrival time) files (see the module description).
+       Returns the report of the batch.
+    """
+
+    from bitmap_index import refresh_bitmap_index
+    from event_bloom import update_event_bloom
+    from query_cache import bump_load_epoch
+
+    import pandas as pd
+
+    report = {"started_at": time.strftime("%Y-%m-%d %H:%M:%S"), "files": [path for path, _, _ in files],
+              "seconds": {}}
+    weather_paths = [path for path, kind, _ in files if kind == "weather"]
+    crime_paths = [path for path, kind, _ in files if kind == "crime"]
+
+    start = time.perf_counter()
+    report["weather_rows"] = load_weather_files(db, weather_paths) if weather_paths else 0
+    report["seconds"]["weather"] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    df_crime = read_crime_files(db, crime_paths) if crime_paths else pd.DataFrame(columns=CRIME_STAGING_COLUMNS)
+    report["new_crimes"] = len(df_crime)
+    report["seconds"]["crime"] = round(time.perf_counter() - start, 3)
+
+    report["fact_rows"], report["pending_crimes"] = 0, 0
+    if stage_crimes(db, df_crime):
+        start = time.perf_counter()
+        load_dimensions(db)
+        report["seconds"]["dimensions"] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        report["fact_rows"], report["pending_crimes"], loaded_event_ids = load_fact_rows(db)
+        report["seconds"]["fact"] = round(time.perf_counter() - start, 3)
+        committed_at = time.time()
+
+        update_event_bloom(db, loaded_event_ids)
+        refresh_bitmap_index(db)
+    else:
+        committed_at = time.time()
+    close_key_allocators()
+    bump_load_epoch(db)
+
+    # latency of every file: from its arrival (modification time) to the commit of its fact rows
+    latencies = [committed_at - arrival for _, _, arrival in files]
+    report["latency_seconds"] = {"min": round(min(latencies), 3), "mean": round(sum(latencies) / len(latencies), 3),
+                                 "max": round(max(latencies), 3)}
+    return report
+
+
+def quarantine_files(files, settings):
+    """A function which moves the files given up after max_retries failed batches to quarantine_dir/<kind>/."""
+
+    for path, kind, _ in files:
+        if os.path.exists(path):
+            directory = os.path.join(settings["quarantine_dir"], kind)
+            os.makedirs(directory, exist_ok=True)
+            shutil.move(path, os.path.join(directory, os.path.basename(path)))
+            print(f"{path} moved to {directory} after {settings['max_retries']} failed batches")
+
+
+def write_batch_report(report, settings):
+    os.makedirs(settings["report_dir"], exist_ok=True)
+    with open(os.path.join(settings["report_dir"], "batches.jsonl"), "a") as report_file:
+        report_file.write(json.dumps(report) + "\n")
+    print(f"Batch of {len(report['files'])} files: {report['weather_rows']} weather days, {report['new_crimes']} new "
+          f"crimes, {report['fact_rows']} fact rows, {report['pending_crimes']} crimes waiting for weather, latency "
+          f"{report['latency_seconds']['mean']:.1f} s (max {report['latency_seconds']['max']:.1f} s), "
+          f"stages {report['seconds']}")
+
+
+def watch(settings=None, max_batches=None):
+    """A function which polls the weather directory and the crime inbox and loads the new files in micro-batches,
+       until interrupted (Ctrl+C) or after max_batches batches.
+    """
+
+    from A02_Team_V04 import DbConnection
+
+    settings = settings or watch_settings()
+    watcher = FileWatcher(settings)
+    coalescer = BatchCoalescer(settings)
+    print(f"Watching {settings['weather_dir']} and {settings['crime_inbox']} every {settings['poll_seconds']} seconds")
+
+    batches = 0
+    try:
+        while max_batches is None or batches < max_batches:
+            now = time.time()
+            coalescer.add(watcher.poll(), now)
+            if coalescer.ready(now):
+                files = coalescer.take()
+                try:
+                    with DbConnection() as db:
+                        report = process_batch(db, files)
+                except:
+                    print(traceback.format_exc())
+                    quarantine_files(coalescer.retry(files, time.time()), settings)
+                else:
+                    write_batch_report(report, settings)
+                    coalescer.loaded(files)
+                    watcher.mark_processed([path for path, _, _ in files if os.path.exists(path)])
+                batches += 1
+                continue
+            time.sleep(settings["poll_seconds"])
+    except KeyboardInterrupt:
+        print(f"Watch mode stopped after {batches} batches")
+    return batches